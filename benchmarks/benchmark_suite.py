@@ -0,0 +1,285 @@
+"""
+This script measures the throughput of the serial driver for every model shipped
+with QC Lab combined with mean-field dynamics and stochastic and deterministic
+surface hopping, sweeping over the batch size and the system size of the model.
+
+For each case it reports the number of update timesteps of the batch per second
+and the number of trajectories completed per second. The results can be stored
+as a baseline and later runs compared against it to catch regressions:
+
+    python benchmarks/benchmark_suite.py --save-baseline baseline.json
+    python benchmarks/benchmark_suite.py --baseline baseline.json
+
+When comparing, the script exits with a nonzero status if the throughput of any
+case dropped by more than the tolerance. Timings depend on the machine, so a
+baseline should be recorded on the same machine as the runs compared against it.
+Pass ``--quick`` for a reduced sweep.
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import numpy as np
+import qclab
+from qclab import Simulation, functions
+from qclab.models import (
+    SpinBoson,
+    HolsteinLattice,
+    HolsteinLatticeReciprocalSpace,
+    FMOComplex,
+    TullyProblemOne,
+    TullyProblemTwo,
+    TullyProblemThree,
+)
+from qclab.algorithms import MeanField, FewestSwitchesSurfaceHopping
+from qclab.dynamics import serial_driver
+
+# Model class, model constants, name of the constant setting the system size (or
+# None), system sizes of the full and quick sweeps, and the update timestep.
+MODELS = {
+    "SpinBoson": (SpinBoson, {}, "A", (10, 100, 400), (100,), 0.01),
+    "FMOComplex": (FMOComplex, {}, "N", (50, 200), (50,), 0.01),
+    "HolsteinLattice": (HolsteinLattice, {}, "N", (10, 20, 40), (10,), 0.01),
+    "HolsteinLatticeReciprocalSpace": (
+        HolsteinLatticeReciprocalSpace,
+        {},
+        "N",
+        (10, 20, 40),
+        (10,),
+        0.01,
+    ),
+    "TullyProblemOne": (
+        TullyProblemOne,
+        {"init_position": -5.0},
+        None,
+        (None,),
+        (None,),
+        0.5,
+    ),
+    "TullyProblemTwo": (
+        TullyProblemTwo,
+        {"init_position": -5.0},
+        None,
+        (None,),
+        (None,),
+        0.5,
+    ),
+    "TullyProblemThree": (
+        TullyProblemThree,
+        {"init_position": -5.0},
+        None,
+        (None,),
+        (None,),
+        0.5,
+    ),
+}
+
+ALGORITHMS = {
+    "MeanField": (MeanField, {}),
+    "FSSH": (FewestSwitchesSurfaceHopping, {}),
+    "FSSH (deterministic)": (
+        FewestSwitchesSurfaceHopping,
+        {"fssh_deterministic": True},
+    ),
+}
+
+BATCH_SIZES = (1, 10, 100)
+QUICK_BATCH_SIZES = (10,)
+
+
+def case_name(model_name, algorithm_name, batch_size, size):
+    """
+    Returns the name identifying a benchmark case in the results and baselines.
+    """
+    return f"{model_name}/{algorithm_name}/batch_size={batch_size}/size={size}"
+
+
+def make_simulation(model_name, algorithm_name, batch_size, size, num_steps):
+    """
+    Returns a simulation running ``batch_size`` trajectories of ``num_steps``
+    update timesteps in a single batch.
+    """
+    model_class, constants, size_name, _, _, dt_update = MODELS[model_name]
+    algorithm_class, algorithm_settings = ALGORITHMS[algorithm_name]
+    constants = dict(constants)
+    if size_name is not None:
+        constants[size_name] = size
+    sim = Simulation(
+        {
+            "num_trajs": batch_size,
+            "batch_size": batch_size,
+            "tmax": num_steps * dt_update,
+            "dt_update": dt_update,
+            "dt_collect": 10 * dt_update,
+            "progress_bar": False,
+        }
+    )
+    sim.model = model_class(constants)
+    sim.model.initialize_constants()
+    sim.algorithm = algorithm_class(algorithm_settings)
+    if algorithm_settings.get("fssh_deterministic"):
+        # Each trajectory has a branch for every quantum state.
+        sim.settings.num_trajs *= sim.model.constants.num_quantum_states
+        sim.settings.batch_size *= sim.model.constants.num_quantum_states
+    sim.initial_state["wf_db"] = np.zeros(
+        sim.model.constants.num_quantum_states, dtype=complex
+    )
+    sim.initial_state["wf_db"][0] = 1.0
+    return sim
+
+
+def run_case(model_name, algorithm_name, batch_size, size, num_steps, num_repeats):
+    """
+    Returns the throughput of a benchmark case as the best of ``num_repeats`` runs,
+    after a short run warming up the jit-compiled functions of the model.
+    """
+    sim = make_simulation(model_name, algorithm_name, batch_size, size, 10)
+    serial_driver(sim)
+    run_time = np.inf
+    for _ in range(num_repeats):
+        sim = make_simulation(model_name, algorithm_name, batch_size, size, num_steps)
+        start_time = time.perf_counter()
+        serial_driver(sim)
+        run_time = min(run_time, time.perf_counter() - start_time)
+    num_timesteps = len(sim.settings.t_update)
+    return {
+        "num_quantum_states": int(sim.model.constants.num_quantum_states),
+        "num_classical_coordinates": int(sim.model.constants.num_classical_coordinates),
+        "time": run_time,
+        "steps_per_s": num_timesteps / run_time,
+        "trajs_per_s": batch_size / run_time,
+    }
+
+
+def run_suite(models, algorithms, quick=False, num_steps=None, num_repeats=3):
+    """
+    Runs the benchmark cases of the given models and algorithms and returns a
+    dictionary mapping the name of each case to its throughput.
+    """
+    if num_steps is None:
+        num_steps = 50 if quick else 200
+    batch_sizes = QUICK_BATCH_SIZES if quick else BATCH_SIZES
+    functions.warm_up_jit_functions()
+    print(f"{'case':<78}{'nq':>5}{'nc':>6}{'steps/s':>12}{'trajs/s':>12}", flush=True)
+    results = {}
+    for model_name in models:
+        sizes = MODELS[model_name][4 if quick else 3]
+        for algorithm_name in algorithms:
+            for size in sizes:
+                for batch_size in batch_sizes:
+                    name = case_name(model_name, algorithm_name, batch_size, size)
+                    result = run_case(
+                        model_name,
+                        algorithm_name,
+                        batch_size,
+                        size,
+                        num_steps,
+                        num_repeats,
+                    )
+                    results[name] = result
+                    print(
+                        f"{name:<78}{result['num_quantum_states']:>5}"
+                        f"{result['num_classical_coordinates']:>6}"
+                        f"{result['steps_per_s']:>12.1f}{result['trajs_per_s']:>12.2f}",
+                        flush=True,
+                    )
+    return results
+
+
+def save_baseline(results, filename):
+    """
+    Saves the results of a run, along with a description of the machine and the
+    versions used, as a baseline.
+    """
+    baseline = {
+        "metadata": {
+            "qclab": qclab.__version__,
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2)
+    print(f"Saved baseline to {filename}.")
+
+
+def compare_to_baseline(results, filename, tolerance):
+    """
+    Compares the results of a run against the baseline stored in ``filename`` and
+    returns the names of the cases whose throughput dropped by more than
+    ``tolerance`` (a fraction of the baseline).
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {filename} ({baseline['metadata']['date']}):")
+    print(f"{'case':<78}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            print(f"{name:<78}{'-':>12}{result['steps_per_s']:>12.1f}{'-':>8}")
+            continue
+        baseline_steps = baseline["results"][name]["steps_per_s"]
+        ratio = result["steps_per_s"] / baseline_steps
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<78}{baseline_steps:>12.1f}{result['steps_per_s']:>12.1f}"
+            f"{ratio:>8.2f}{flag}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--models", nargs="+", default=list(MODELS), choices=list(MODELS)
+    )
+    parser.add_argument(
+        "--algorithms", nargs="+", default=list(ALGORITHMS), choices=list(ALGORITHMS)
+    )
+    parser.add_argument("--quick", action="store_true", help="Run a reduced sweep.")
+    parser.add_argument("--num-steps", type=int, default=None)
+    parser.add_argument("--num-repeats", type=int, default=3)
+    parser.add_argument("--save-baseline", metavar="FILE", default=None)
+    parser.add_argument("--baseline", metavar="FILE", default=None)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fractional drop in throughput reported as a regression.",
+    )
+    args = parser.parse_args(argv)
+    # Keep the output of the drivers out of the tables.
+    logging.getLogger("qclab").setLevel(logging.WARNING)
+    results = run_suite(
+        args.models,
+        args.algorithms,
+        quick=args.quick,
+        num_steps=args.num_steps,
+        num_repeats=args.num_repeats,
+    )
+    if args.save_baseline is not None:
+        save_baseline(results, args.save_baseline)
+    if args.baseline is not None:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print(
+                f"\n{len(regressions)} case(s) regressed by more than "
+                f"{100 * args.tolerance:.0f}%."
+            )
+            return 1
+        print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
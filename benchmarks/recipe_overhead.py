@@ -0,0 +1,65 @@
+"""
+This script measures the per-step cost of executing the update recipe of an
+algorithm with and without compiling it with ``Algorithm.compile_recipe``.
+
+The batch is kept small so that the timings are dominated by the per-task
+interpreter overhead rather than by the numerical work. Run it as:
+
+    python benchmarks/recipe_overhead.py
+"""
+
+import time
+import numpy as np
+from qclab import Simulation
+from qclab.models import SpinBoson
+from qclab.algorithms import MeanField, FewestSwitchesSurfaceHopping
+
+
+def time_update_recipe(sim, recipe, num_steps):
+    """
+    Returns the average time per step of executing ``recipe`` on a freshly
+    initialized batch.
+    """
+    sim.initialize_timesteps()
+    sim.t_ind = 0
+    state = {"seed": np.arange(sim.settings.batch_size)}
+    parameters = {}
+    state, parameters = sim.algorithm.execute_recipe(
+        sim, state, parameters, sim.algorithm.initialization_recipe
+    )
+    start_time = time.perf_counter()
+    for sim.t_ind in range(num_steps):
+        state, parameters = sim.algorithm.execute_recipe(sim, state, parameters, recipe)
+    return (time.perf_counter() - start_time) / num_steps
+
+
+def main(batch_size=4, num_steps=2000, num_repeats=3):
+    algorithms = {
+        "MeanField": MeanField(),
+        "MeanField (fused_update)": MeanField({"fused_update": True}),
+        "FewestSwitchesSurfaceHopping": FewestSwitchesSurfaceHopping(),
+    }
+    print(f"{'algorithm':<30}{'recipe [us/step]':>18}{'compiled [us/step]':>20}")
+    for name, algorithm in algorithms.items():
+        sim = Simulation({"batch_size": batch_size, "tmax": num_steps * 0.01})
+        sim.settings.dt_update = 0.01
+        sim.model = SpinBoson()
+        sim.algorithm = algorithm
+        sim.initial_state["wf_db"] = np.array([1.0, 0.0], dtype=complex)
+        compiled_recipe = algorithm.compile_recipe(sim, algorithm.update_recipe)
+        # Warm up the jit-compiled functions before timing.
+        time_update_recipe(sim, compiled_recipe, 10)
+        time_update_recipe(sim, algorithm.update_recipe, 10)
+        recipe_time = min(
+            time_update_recipe(sim, algorithm.update_recipe, num_steps)
+            for _ in range(num_repeats)
+        )
+        compiled_time = min(
+            time_update_recipe(sim, compiled_recipe, num_steps)
+            for _ in range(num_repeats)
+        )
+        print(f"{name:<30}{recipe_time * 1e6:>18.1f}{compiled_time * 1e6:>20.1f}")
+
+
+if __name__ == "__main__":
+    main()
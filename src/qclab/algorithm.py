@@ -4,6 +4,7 @@ This module contains the Algorithm class.
 
 import copy
 from qclab.constants import Constants
+from qclab import tasks
 
 
 class Algorithm:
@@ -28,10 +29,26 @@ class Algorithm:
         self.initialization_recipe = copy.deepcopy(self.initialization_recipe)
         self.update_recipe = copy.deepcopy(self.update_recipe)
         self.collect_recipe = copy.deepcopy(self.collect_recipe)
+        self.energy_recipe = copy.deepcopy(self.energy_recipe)
+        self.frozen_collect_recipe = copy.deepcopy(self.frozen_collect_recipe)
 
     initialization_recipe = []
     update_recipe = []
     collect_recipe = []
+    # Recipe that stores the classical and quantum energies of each trajectory in
+    # the state, used to control the adaptive time step.
+    energy_recipe = []
+    # Recipe executed at each collect step for the trajectories frozen by the stop
+    # condition, whose outputs are otherwise kept from the time they were frozen.
+    # It collects the outputs that change with the time alone, such as the time.
+    frozen_collect_recipe = []
+    # Names of the arrays in the state and the output dictionary whose first axis
+    # runs over the trajectories rather than the entries of the batch, which
+    # differ when trajectories have several branches.
+    trajectory_keys = ()
+    # Names of the arrays in the state that do not run over the batch, such as the
+    # indices of the hopping trajectories, which compaction leaves unchanged.
+    unbatched_keys = ()
 
     def execute_recipe(self, sim, state, parameters, recipe):
         """
@@ -57,3 +74,24 @@ class Algorithm:
         for func in recipe:
             state, parameters = func(sim, state, parameters)
         return state, parameters
+
+    def compile_recipe(self, sim, recipe):
+        """
+        Compile the given recipe for the simulation by resolving the keyword
+        arguments, ingredients and settings of its tasks ahead of time.
+
+        This is called by the dynamics core once per batch before the time loop.
+        The compiled recipe gives the same results as ``recipe`` as long as the
+        model, algorithm and settings of ``sim`` are not changed.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing settings and parameters.
+        recipe: list
+            The list of functions to compile.
+
+        .. rubric:: Returns
+        compiled_recipe: list
+            The list of compiled functions.
+        """
+        return [tasks.compile_task(sim, task) for task in recipe]
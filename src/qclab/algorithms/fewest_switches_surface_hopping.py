@@ -70,9 +70,7 @@ class FewestSwitchesSurfaceHopping(Algorithm):
             z_name="z_1",
             wf_changed=False,
         ),
-        partial(
-            tasks.update_z_rk4_k123, z_name="z", z_k_name="z_2", k_name="z_rk4_k2"
-        ),
+        partial(tasks.update_z_rk4_k123, z_name="z", z_k_name="z_2", k_name="z_rk4_k2"),
         partial(tasks.update_classical_force, z_name="z_2"),
         partial(
             tasks.update_quantum_classical_force,
@@ -130,3 +128,29 @@ class FewestSwitchesSurfaceHopping(Algorithm):
         tasks.collect_quantum_energy,
         tasks.collect_classical_energy,
     ]
+
+    energy_recipe = [
+        tasks.update_quantum_energy_act_surf,
+        tasks.update_classical_energy_fssh,
+    ]
+
+    frozen_collect_recipe = [
+        tasks.update_t,
+        tasks.collect_t,
+    ]
+
+    trajectory_keys = (
+        "hop_prob_rand_vals",
+        "init_act_surf_rand_vals",
+        "classical_energy",
+    )
+
+    unbatched_keys = (
+        "hop_ind",
+        "hop_dest",
+        "hop_successful",
+        "z_shift",
+        "z_traj",
+        "resc_dir_z_traj",
+        "z_shift_traj",
+    )
@@ -4,18 +4,36 @@ This module contains the MeanField algorithm class.
 
 from functools import partial
 from qclab.algorithm import Algorithm
-from qclab import tasks
+from qclab import tasks, ingredients
+
+
+def _task_signature(task):
+    """
+    Returns a tuple identifying a task by its function and bound arguments.
+    """
+    if isinstance(task, partial):
+        return (task.func, task.args, tuple(sorted(task.keywords.items())))
+    return (task, (), ())
 
 
 class MeanField(Algorithm):
     """
     Mean-field dynamics algorithm class.
+
+    .. rubric:: Settings
+    fused_update : bool, default: False
+        If True, the update recipe is compiled into the single task
+        ``update_mean_field_harmonic_diagonal_linear`` for models with the
+        ``h_c_harmonic``, ``dh_c_dzc_harmonic``, ``h_qc_diagonal_linear`` and
+        ``dh_qc_dzc_diagonal_linear`` ingredients and a constant quantum Hamiltonian,
+        provided that the update recipe has not been modified. Otherwise the update
+        recipe is executed as usual.
     """
 
     def __init__(self, settings=None):
         if settings is None:
             settings = {}
-        self.default_settings = {}
+        self.default_settings = {"fused_update": False}
         super().__init__(self.default_settings, settings)
 
     initialization_recipe = [
@@ -72,3 +90,66 @@ class MeanField(Algorithm):
         tasks.collect_classical_energy,
         tasks.collect_quantum_energy,
     ]
+
+    energy_recipe = [
+        tasks.update_classical_energy,
+        tasks.update_quantum_energy_wf,
+    ]
+
+    frozen_collect_recipe = [
+        tasks.update_t,
+        tasks.collect_t,
+    ]
+
+    def use_fused_update(self, sim, recipe):
+        """
+        Determines whether ``recipe`` can be carried out by the fused update task.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing the model.
+        recipe: list
+            The recipe to be executed.
+
+        .. rubric:: Returns
+        use_fused_update: bool
+            True if the fused update is enabled, ``recipe`` is the unmodified update
+            recipe and the model has the required ingredients.
+        """
+        if not self.settings.get("fused_update", False):
+            return False
+        if recipe is not self.update_recipe:
+            return False
+        if [_task_signature(task) for task in recipe] != [
+            _task_signature(task) for task in MeanField.update_recipe
+        ]:
+            return False
+        required_ingredients = {
+            "h_c": ingredients.h_c_harmonic,
+            "dh_c_dzc": ingredients.dh_c_dzc_harmonic,
+            "h_qc": ingredients.h_qc_diagonal_linear,
+            "dh_qc_dzc": ingredients.dh_qc_dzc_diagonal_linear,
+        }
+        for name, ingredient in required_ingredients.items():
+            if sim.model.get(name)[0] is not ingredient:
+                return False
+        return not sim.model.update_h_q
+
+    def compile_recipe(self, sim, recipe):
+        """
+        Compile the given recipe for the simulation, replacing the update recipe by
+        the fused update task if ``use_fused_update`` allows.
+
+        .. rubric:: Args
+        sim: Simulation
+            The simulation object containing settings and parameters.
+        recipe: list
+            The list of functions to compile.
+
+        .. rubric:: Returns
+        compiled_recipe: list
+            The list of compiled functions.
+        """
+        if self.use_fused_update(sim, recipe):
+            return [tasks.update_mean_field_harmonic_diagonal_linear]
+        return super().compile_recipe(sim, recipe)
@@ -4,13 +4,56 @@ This module contains the Data class.
 
 import logging
 import numpy as np
-from qclab.utils import DISABLE_H5PY
+from qclab.utils import DISABLE_H5PY, SeedRuns
+from qclab.profiler import merge_profiles, profile_summary, save_chrome_trace
+from qclab.streaming import StreamWriter, STAGED_GROUP
+from qclab.trajectory_store import TrajectoryStore
+from qclab.lazy_data import load_lazy
 
 if not DISABLE_H5PY:
     import h5py
 
 logger = logging.getLogger(__name__)
 
+# Suffix of the keys holding the sum of squared deviations from the mean of each
+# output, which are kept if sim.settings.variance is True.
+M2_SUFFIX = "_m2"
+
+
+def _sum_sq_dev(val, num_samples, norm_factor):
+    """
+    Returns the sum over the ``num_samples`` trajectories of a batch of the squared
+    deviations of their output from its mean over the batch.
+
+    The rows of ``val`` belonging to a trajectory, such as the branches of
+    deterministic surface hopping, are consecutive in the batch. The output of a
+    trajectory is scaled such that the mean of the outputs of the trajectories is
+    the sum of ``val`` divided by ``norm_factor``, as in the data dictionary.
+    """
+    samples = np.reshape(val, (num_samples, -1, *np.shape(val)[1:])).sum(axis=1)
+    samples = samples * (num_samples / norm_factor)
+    return np.sum(np.abs(samples - np.mean(samples, axis=0)) ** 2, axis=0)
+
+
+def _is_variance_key(key):
+    """
+    Returns True if ``key`` holds a quantity used to compute the variance.
+    """
+    return key == "num_samples" or key.endswith(M2_SUFFIX)
+
+
+def _check_stream_settings(sim):
+    """
+    Raises a ValueError if the settings of ``sim`` do not allow writing the
+    outputs to ``sim.settings.output_file`` while the simulation runs.
+    """
+    if getattr(sim.settings, "checkpoint_dir", None) is not None:
+        logger.error("Streaming output is not supported with checkpointing.")
+        raise ValueError("Streaming output is not supported with checkpointing.")
+    if getattr(sim.settings, "variance", False):
+        logger.error("Streaming output is not supported with the variance.")
+        raise ValueError("Streaming output is not supported with the variance.")
+
 
 class Data:
     """
@@ -18,12 +61,85 @@ class Data:
     """
 
     def __init__(self, seeds=None):
-        if seeds is None:
-            seeds = np.array([], dtype=int)
-        self.data_dict = {"seed": seeds, "norm_factor": 0}
+        self.data_dict = {"seed": None, "norm_factor": 0}
+        self._set_seeds(seeds)
         # Store log messages captured during a simulation run. This attribute is
         # populated by the drivers when they return the Data object.
         self.log = ""
+        # Store the logs of worker processes, keyed by worker, if
+        # sim.settings.worker_logs is True.
+        self.worker_logs = {}
+        # Store the profile of the tasks recorded by the dynamics core if
+        # sim.settings.profile is True.
+        self.profile = None
+        # Stream writer that the outputs are written to instead of being kept in
+        # memory, set by open_stream.
+        self.stream = None
+        # Trajectory store that the outputs in sim.settings.trajectory_outputs are
+        # written to for every trajectory, opened by add_output_to_data_dict.
+        self.trajectory_store = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The spare capacity of the seed buffer is not pickled; _append_seeds
+        # allocates a new buffer when needed.
+        state["_seed_buffer"] = None
+        return state
+
+    def _set_seeds(self, seeds):
+        """
+        Sets ``self.data_dict["seed"]`` to a copy of ``seeds`` held in a buffer
+        that ``_append_seeds`` extends.
+        """
+        if seeds is None:
+            seeds = []
+        seeds = np.asarray(seeds, dtype=int).reshape(-1)
+        self._seed_runs = SeedRuns(seeds)
+        self._seed_buffer = seeds.copy()
+        self._set_seed_view(len(seeds))
+
+    def _set_seed_view(self, num_seeds):
+        """
+        Sets ``self.data_dict["seed"]`` to the first ``num_seeds`` seeds of the
+        seed buffer. The view is read-only so that the seeds cannot change
+        without updating ``self.seed_runs``.
+        """
+        seed_view = self._seed_buffer[:num_seeds]
+        seed_view.flags.writeable = False
+        self._seed_view = seed_view
+        self.data_dict["seed"] = seed_view
+
+    def _append_seeds(self, seeds):
+        """
+        Appends ``seeds`` to ``self.data_dict["seed"]``.
+
+        The seeds are written into a buffer whose capacity grows geometrically,
+        so merging many batches takes time proportional to the total number of
+        seeds rather than reallocating and copying the seeds for every batch.
+        """
+        seed_runs = self.seed_runs
+        seeds = np.asarray(seeds, dtype=int).reshape(-1)
+        num_seeds = len(self._seed_view)
+        new_num_seeds = num_seeds + len(seeds)
+        if self._seed_buffer is None or new_num_seeds > len(self._seed_buffer):
+            seed_buffer = np.empty(max(new_num_seeds, 2 * num_seeds), dtype=int)
+            seed_buffer[:num_seeds] = self._seed_view
+            self._seed_buffer = seed_buffer
+        self._seed_buffer[num_seeds:new_num_seeds] = seeds
+        seed_runs.append(seeds)
+        self._set_seed_view(new_num_seeds)
+
+    @property
+    def seed_runs(self):
+        """
+        The seeds of ``self.data_dict["seed"]`` as a ``qclab.utils.SeedRuns``,
+        whose number of seeds, largest seed and membership are available without
+        scanning the seeds. It is updated by ``add_data`` as batches are merged
+        and rebuilt if ``self.data_dict["seed"]`` is replaced.
+        """
+        if self.data_dict["seed"] is not getattr(self, "_seed_view", None):
+            self._set_seeds(self.data_dict["seed"])
+        return self._seed_runs
 
     def add_output_to_data_dict(self, sim, state, t_ind):
         """
@@ -51,7 +167,35 @@ class Data:
                 "Setting norm_factor to %s from state object.", state["norm_factor"]
             )
             self.data_dict["norm_factor"] = state["norm_factor"]
+        collect_ind = t_ind // sim.settings.dt_collect_n
+        track_variance = getattr(sim.settings, "variance", False)
+        if track_variance:
+            num_branches = 1
+            if sim.algorithm.settings.get("fssh_deterministic"):
+                num_branches = sim.model.constants.num_quantum_states
+            self.data_dict["num_samples"] = (
+                int(self.data_dict["norm_factor"]) // num_branches
+            )
+        trajectory_rows = None
+        if getattr(sim.settings, "trajectory_outputs", None):
+            if self.trajectory_store is None:
+                self.trajectory_store = TrajectoryStore(sim.settings.trajectory_dir)
+            trajectory_rows = self.trajectory_store.rows(
+                np.asarray(self.data_dict["seed"])
+            )
+            if "batch_ind" in state:
+                trajectory_rows = trajectory_rows[state["batch_ind"]]
         for key, val in state["output_dict"].items():
+            if trajectory_rows is not None and key in self.trajectory_store.keys:
+                self.trajectory_store.write(key, trajectory_rows, collect_ind, val)
+            if self.stream is not None:
+                self.stream.write_row(
+                    key,
+                    collect_ind,
+                    np.sum(val, axis=0) / self.data_dict["norm_factor"],
+                    self.data_dict["norm_factor"],
+                )
+                continue
             if not key in self.data_dict:
                 # If the key is not in the data_dict, initialize it with zeros.
                 self.data_dict[key] = np.zeros(
@@ -63,9 +207,20 @@ class Data:
                     self.data_dict[key].shape,
                 )
             # Store the data in the data_dict at the correct time index.
-            self.data_dict[key][t_ind // sim.settings.dt_collect_n] = (
+            self.data_dict[key][collect_ind] = (
                 np.sum(val, axis=0) / self.data_dict["norm_factor"]
             )
+            if track_variance:
+                m2_key = key + M2_SUFFIX
+                if not m2_key in self.data_dict:
+                    self.data_dict[m2_key] = np.zeros(
+                        self.data_dict[key].shape, dtype=float
+                    )
+                self.data_dict[m2_key][collect_ind] = _sum_sq_dev(
+                    val, self.data_dict["num_samples"], self.data_dict["norm_factor"]
+                )
+        if self.stream is not None:
+            self.stream.flush()
 
     def add_data(self, new_data):
         """
@@ -78,12 +233,19 @@ class Data:
         new_norm_factor = (
             new_data.data_dict["norm_factor"] + self.data_dict["norm_factor"]
         )
-        for key, val in new_data.data_dict.items():
+        self._merge_variance(new_data)
+        new_items = new_data.data_dict.items()
+        if self.stream is not None:
+            # Merge the outputs into the stream and only keep the seeds in memory.
+            if getattr(new_data, "stream", None) is self.stream:
+                self.stream.commit_batch(new_data.data_dict["seed"])
+            else:
+                self.stream.add_data(new_data)
+            new_items = [("seed", new_data.data_dict["seed"])]
+        for key, val in new_items:
             if key == "seed":
-                self.data_dict[key] = np.concatenate(
-                    (self.data_dict[key], val.flatten()), axis=0
-                )
-            elif key != "norm_factor":
+                self._append_seeds(val)
+            elif key != "norm_factor" and not _is_variance_key(key):
                 if key in self.data_dict:
                     self.data_dict[key] = (
                         self.data_dict[key] * self.data_dict["norm_factor"]
@@ -95,6 +257,175 @@ class Data:
         # Append any log messages stored in new_data to this instance's log.
         if getattr(new_data, "log", ""):
             self.log += new_data.log
+        self.worker_logs.update(getattr(new_data, "worker_logs", {}))
+        self.profile = merge_profiles(
+            getattr(self, "profile", None), getattr(new_data, "profile", None)
+        )
+
+    def _merge_variance(self, new_data):
+        """
+        Merges the sums of squared deviations of the outputs of ``new_data`` into
+        ``self.data_dict`` with the parallel algorithm of Chan et al. Must be
+        called before the means of the outputs are merged.
+
+        .. rubric:: Args
+        new_data: Data
+            A Data instance containing the new data to merge.
+        """
+        num_samples = self.data_dict.get("num_samples", 0)
+        new_num_samples = new_data.data_dict.get("num_samples", 0)
+        if new_data.data_dict["norm_factor"] == 0:
+            return
+        if self.data_dict["norm_factor"] == 0:
+            num_samples = new_num_samples
+        elif (num_samples == 0) != (new_num_samples == 0):
+            logger.warning(
+                "Discarding the variance, which is only tracked by one of the merged "
+                "data objects."
+            )
+            for key in list(self.data_dict):
+                if _is_variance_key(key):
+                    del self.data_dict[key]
+            return
+        elif num_samples > 0:
+            total_num_samples = num_samples + new_num_samples
+            for key, val in new_data.data_dict.items():
+                if not key.endswith(M2_SUFFIX) or key not in self.data_dict:
+                    continue
+                mean_key = key[: -len(M2_SUFFIX)]
+                delta = new_data.data_dict[mean_key] - self.data_dict[mean_key]
+                self.data_dict[key] = (
+                    self.data_dict[key]
+                    + val
+                    + np.abs(delta) ** 2
+                    * (num_samples * new_num_samples / total_num_samples)
+                )
+            num_samples = total_num_samples
+        for key, val in new_data.data_dict.items():
+            if key.endswith(M2_SUFFIX) and key not in self.data_dict:
+                self.data_dict[key] = val
+        if num_samples > 0:
+            self.data_dict["num_samples"] = num_samples
+
+    def get_variance(self, key):
+        """
+        Returns the sample variance over the trajectories of the output ``key``,
+        which is kept if ``sim.settings.variance`` is True.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+
+        .. rubric:: Returns
+        variance: ndarray
+            The variance of each element of the output at each collect time.
+        """
+        if key + M2_SUFFIX not in self.data_dict:
+            logger.error(
+                "No variance was recorded for %s; set sim.settings.variance = True.",
+                key,
+            )
+            raise ValueError(f"No variance was recorded for {key}.")
+        num_samples = self.data_dict["num_samples"]
+        return self.data_dict[key + M2_SUFFIX] / max(num_samples - 1, 1)
+
+    def get_standard_error(self, key):
+        """
+        Returns the standard error of the mean of the output ``key``, which is kept
+        if ``sim.settings.variance`` is True.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+
+        .. rubric:: Returns
+        standard_error: ndarray
+            The standard error of each element of the output at each collect time.
+        """
+        return np.sqrt(self.get_variance(key) / self.data_dict["num_samples"])
+
+    def open_stream(self, filename, sim):
+        """
+        Starts streaming the outputs to the HDF5 file ``filename`` instead of
+        keeping them in memory.
+
+        Outputs already in ``self.data_dict`` are written to the file first. From
+        then on, ``add_data`` merges the outputs of each batch into the file and
+        ``add_output_to_data_dict`` writes each collect time to the file, while
+        ``self.data_dict`` only holds the seeds and ``norm_factor``. Streaming is
+        not supported together with checkpointing, since a resumed batch would add
+        the collect times before the failure to the file a second time.
+
+        .. rubric:: Args
+        filename: str
+            The file name of the HDF5 file, which is overwritten.
+        sim: Simulation
+            The simulation object with initialized timesteps.
+        """
+        _check_stream_settings(sim)
+        self.stream = StreamWriter(filename, len(sim.settings.t_collect))
+        self.stream.add_data(self)
+        self.data_dict = {
+            "seed": self.data_dict["seed"],
+            "norm_factor": self.data_dict["norm_factor"],
+        }
+
+    def close_stream(self):
+        """
+        Writes the seeds and log to the file opened by ``open_stream`` and closes
+        it. The outputs can then be read with ``Data().load(filename)``.
+        """
+        if self.stream is not None:
+            self.stream.close(self.data_dict["seed"], self.log)
+            self.stream = None
+
+    def get_log(self, include_workers=False):
+        """
+        Returns the log of the simulation.
+
+        .. rubric:: Args
+        include_workers: bool, default: False
+            If True, the logs of the worker processes in ``self.worker_logs`` are
+            appended to the log, each under a header naming the worker.
+
+        .. rubric:: Returns
+        log: str
+            The log.
+        """
+        if not include_workers:
+            return self.log
+        return self.log + "".join(
+            f"--- {key} ---\n{log}" for key, log in self.worker_logs.items()
+        )
+
+    def profile_summary(self):
+        """
+        Returns a table of the wall time, number of calls and megabytes newly
+        stored in the state by each task, summed over all batches.
+
+        .. rubric:: Returns
+        summary: str
+            The table as a string.
+        """
+        if getattr(self, "profile", None) is None:
+            logger.error("No profile was recorded; set sim.settings.profile = True.")
+            raise ValueError("No profile was recorded.")
+        return profile_summary(self.profile)
+
+    def save_profile_trace(self, filename):
+        """
+        Save the recorded task timings to ``filename`` as a JSON file in the Chrome
+        trace event format, which can be viewed in ``chrome://tracing`` or
+        Perfetto. Each batch appears under the process that ran it.
+
+        .. rubric:: Args
+        filename : str
+            The file name to save the trace to.
+        """
+        if getattr(self, "profile", None) is None:
+            logger.error("No profile was recorded; set sim.settings.profile = True.")
+            raise ValueError("No profile was recorded.")
+        save_chrome_trace(self.profile, filename)
 
     def save(self, filename, disable_h5py=DISABLE_H5PY):
         """
@@ -116,20 +447,34 @@ class Data:
                 self._recursive_save(h5file, "/", self.data_dict)
                 h5file.attrs["log"] = self.log
 
-    def load(self, filename, disable_h5py=DISABLE_H5PY):
+    def load(self, filename, disable_h5py=DISABLE_H5PY, lazy=False):
         """
         Load a Data object from ``filename``.
 
+        If ``lazy`` is True, the outputs are not read into memory. Instead, the
+        entries of ``data_dict`` are read-only proxies that read the slices that
+        are accessed from disk, such as ``data_dict["dm_db"][100:200]`` for a time
+        window: ``qclab.lazy_data.LazyDataset`` for an HDF5 file and ``np.memmap``
+        for an npz file. Lazy loading requires an empty Data object.
+
         .. rubric:: Args
         filename : str
             The file name to load the data from.
         disable_h5py : bool, default: qclab.utils.DISABLE_H5PY
             If True, h5py is not used even if available.
+        lazy : bool, default: False
+            If True, the outputs are read from disk on demand.
 
         .. rubric:: Returns
         Data : Data
             The loaded Data object.
         """
+        if lazy:
+            if self.data_dict["norm_factor"] != 0 or len(self.data_dict["seed"]) > 0:
+                logger.error("Lazy loading requires an empty Data object.")
+                raise ValueError("Lazy loading requires an empty Data object.")
+            self.data_dict, self.log = load_lazy(filename, disable_h5py)
+            return self
         new_data = Data()
         if disable_h5py:
             loaded = np.load(filename, allow_pickle=True)
@@ -141,6 +486,8 @@ class Data:
             return self
         with h5py.File(filename, "r") as h5file:
             new_data._recursive_load(h5file, "/", new_data.data_dict)
+            # Rows staged by an output stream for a batch that was not completed.
+            new_data.data_dict.pop(STAGED_GROUP, None)
             new_data.log = h5file.attrs["log"]
             self.add_data(new_data)
         return self
@@ -2,9 +2,15 @@
 This module imports the dynamics drivers to qclab.dynamics.
 """
 
+from qclab.dynamics.worker_pool import WorkerPool
 from qclab.dynamics.parallel_driver_multiprocessing import (
     parallel_driver_multiprocessing,
 )
+from qclab.dynamics.parallel_driver_threads import parallel_driver_threads
 from qclab.dynamics.parallel_driver_mpi import parallel_driver_mpi
 from qclab.dynamics.serial_driver import serial_driver
+from qclab.dynamics.convergence_driver import convergence_driver
 from qclab.dynamics.dynamics import run_dynamics
+from qclab.dynamics.compaction import position_window
+from qclab.dynamics.memory_planner import estimate_batch_memory, plan_batch_size
+from qclab.dynamics.autotune import autotune
@@ -0,0 +1,156 @@
+"""
+This module contains the autotuner, which measures the throughput of short probe
+simulations to choose the batch size and number of worker processes.
+"""
+
+import copy
+import time
+import logging
+import multiprocessing
+from qclab.dynamics.serial_driver import serial_driver
+from qclab.dynamics.parallel_driver_multiprocessing import (
+    parallel_driver_multiprocessing,
+)
+from qclab.dynamics.worker_pool import WorkerPool
+from qclab.dynamics.memory_planner import plan_batch_size, _num_branches
+from qclab.dynamics.tuning_cache import save_to_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _default_num_tasks_list():
+    """
+    Returns the powers of two up to the number of CPU cores and the number of CPU
+    cores itself.
+    """
+    cpu_count = multiprocessing.cpu_count()
+    num_tasks_list = [1]
+    while 2 * num_tasks_list[-1] < cpu_count:
+        num_tasks_list.append(2 * num_tasks_list[-1])
+    if cpu_count > 1:
+        num_tasks_list.append(cpu_count)
+    return num_tasks_list
+
+
+def _probe_throughput(probe_sim, batch_size, num_tasks, pool):
+    """
+    Runs one batch of ``batch_size`` entries per task and returns the number of
+    trajectory timesteps per second.
+    """
+    probe_sim.settings.batch_size = batch_size
+    probe_sim.settings.num_trajs = batch_size * num_tasks
+    start_time = time.perf_counter()
+    if pool is None:
+        serial_driver(probe_sim)
+    else:
+        parallel_driver_multiprocessing(probe_sim, pool=pool)
+    run_time = time.perf_counter() - start_time
+    num_trajs = batch_size * num_tasks // _num_branches(probe_sim)
+    return num_trajs * len(probe_sim.settings.t_update) / run_time
+
+
+def autotune(
+    sim,
+    batch_sizes=(8, 16, 32, 64, 128, 256),
+    num_tasks_list=None,
+    probe_steps=50,
+    cache_file=None,
+):
+    """
+    Measures the throughput of short probe simulations of ``sim`` for each
+    combination of candidate batch size and number of worker processes, and stores
+    the fastest configuration in the local autotune cache under the signature of
+    ``sim`` (see ``qclab.dynamics.tuning_cache.simulation_signature``).
+
+    Each probe runs one batch per worker for ``probe_steps`` update timesteps on a
+    copy of ``sim``, using ``serial_driver`` for a single task and
+    ``parallel_driver_multiprocessing`` with a ``WorkerPool`` otherwise; starting
+    the workers is not included in the timings. Batch sizes that exceed the
+    memory budget ``sim.settings.memory_budget``, if set, are skipped.
+
+    If ``sim.settings.autotune`` is True, the drivers then use the stored batch
+    size and, for ``parallel_driver_multiprocessing`` without an explicit number
+    of tasks, the stored number of tasks.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    batch_sizes: iterable of int, default: (8, 16, 32, 64, 128, 256)
+        The candidate batch sizes in trajectories. A trajectory of deterministic
+        surface hopping occupies one entry of the batch for each branch.
+    num_tasks_list: iterable of int, optional
+        The candidate numbers of worker processes. If None, the powers of two up to
+        the number of CPU cores and the number of CPU cores are used.
+    probe_steps: int, default: 50
+        The number of update timesteps of each probe.
+    cache_file: str, optional
+        The cache file. If None, ``sim.settings.autotune_cache`` is used, or
+        ``default_cache_file()`` if that is None as well.
+
+    .. rubric:: Returns
+    tuned: dict
+        Dictionary with the fastest "batch_size" (in entries of the batch, as in
+        ``sim.settings.batch_size``), "num_tasks" and its "throughput" in
+        trajectory timesteps per second, along with the "results" of all probes.
+    """
+    if num_tasks_list is None:
+        num_tasks_list = _default_num_tasks_list()
+    if cache_file is None:
+        cache_file = getattr(sim.settings, "autotune_cache", None)
+    sim.model.initialize_constants()
+    num_branches = _num_branches(sim)
+    probe_sim = copy.deepcopy(sim)
+    probe_sim.settings.progress_bar = False
+    probe_sim.settings.autotune = False
+    probe_sim.settings.memory_budget = None
+    probe_sim.settings.checkpoint_dir = None
+    probe_sim.settings.profile = False
+    probe_sim.settings.tmax = probe_steps * sim.settings.dt_update
+    probe_sim.settings.dt_collect = min(
+        sim.settings.dt_collect, probe_sim.settings.tmax
+    )
+    candidates = sorted(
+        set(int(batch_size) * num_branches for batch_size in batch_sizes)
+    )
+    if getattr(sim.settings, "memory_budget", None) is not None:
+        max_sim = copy.deepcopy(sim)
+        max_sim.settings.batch_size = max(candidates)
+        max_batch_size = plan_batch_size(max_sim)
+        candidates = [
+            batch_size for batch_size in candidates if batch_size <= max_batch_size
+        ] or [max_batch_size]
+    # Compile the jit functions of the model before timing, also for the workers
+    # forked afterwards.
+    _probe_throughput(probe_sim, candidates[0], 1, None)
+    results = []
+    for num_tasks in num_tasks_list:
+        pool = WorkerPool(num_tasks).start() if num_tasks > 1 else None
+        try:
+            for batch_size in candidates:
+                throughput = _probe_throughput(probe_sim, batch_size, num_tasks, pool)
+                logger.info(
+                    "Autotune probe with batch_size=%s and num_tasks=%s: %.1f "
+                    "trajectory timesteps per second.",
+                    batch_size,
+                    num_tasks,
+                    throughput,
+                )
+                results.append(
+                    {
+                        "batch_size": batch_size,
+                        "num_tasks": num_tasks,
+                        "throughput": throughput,
+                    }
+                )
+        finally:
+            if pool is not None:
+                pool.close()
+    best = max(results, key=lambda result: result["throughput"])
+    logger.info(
+        "Fastest configuration: batch_size=%s and num_tasks=%s.",
+        best["batch_size"],
+        best["num_tasks"],
+    )
+    tuned = {**best, "results": results, "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    save_to_cache(sim, tuned, cache_file)
+    return tuned
@@ -0,0 +1,237 @@
+"""
+This module contains the functions used by the dynamics core to remove finished
+trajectories from the active batch.
+"""
+
+import logging
+import numpy as np
+from qclab import functions
+
+logger = logging.getLogger(__name__)
+
+
+def position_window(q_min, q_max, z_name="z"):
+    """
+    Returns a stop condition under which a trajectory is finished once each of its
+    classical coordinates has left the interval ``[q_min, q_max]`` and is moving
+    away from it, as in scattering models such as ``TullyProblemOne``.
+
+    .. rubric:: Args
+    q_min: float
+        The lower bound of the position window.
+    q_max: float
+        The upper bound of the position window.
+    z_name: str, default: "z"
+        Name of the classical coordinates in the state object.
+
+    .. rubric:: Returns
+    stop_condition: callable
+        A function ``stop_condition(sim, state, parameters)`` returning a boolean
+        array that is True for each finished trajectory.
+    """
+
+    def stop_condition(sim, state, parameters):
+        m = sim.model.constants.classical_coordinate_mass[np.newaxis, :]
+        h = sim.model.constants.classical_coordinate_weight[np.newaxis, :]
+        z = state[z_name]
+        q = functions.z_to_q(z, m, h)
+        p = functions.z_to_p(z, m, h)
+        return np.all(((q < q_min) & (p < 0)) | ((q > q_max) & (p > 0)), axis=1)
+
+    return stop_condition
+
+
+def _trajectory_index(state):
+    """
+    Returns the index of the trajectory that each entry of the batch belongs to and
+    the number of trajectories in the batch.
+
+    Entries of the batch that share a seed are branches of the same trajectory, as
+    in deterministic surface hopping. Trajectories are numbered in the order in
+    which they appear in the batch.
+    """
+    _, first_ind, inverse_ind = np.unique(
+        state["seed"], return_index=True, return_inverse=True
+    )
+    rank = np.empty(len(first_ind), dtype=int)
+    rank[np.argsort(first_ind)] = np.arange(len(first_ind))
+    return rank[inverse_ind], len(first_ind)
+
+
+def _select_entry(key, val, trajectory_keys, branch_mask, traj_mask):
+    """
+    Returns the part of the array or sparse array ``val`` stored under ``key``
+    selected by ``branch_mask`` if it runs over the entries of the batch or by
+    ``traj_mask`` if ``key`` is in ``trajectory_keys``.
+    """
+    mask = traj_mask if key in trajectory_keys else branch_mask
+    if isinstance(val, tuple):
+        # Sparse array (inds, mels, shape) whose first index runs over the batch.
+        inds, mels, shape = val
+        keep = mask[inds[0]]
+        new_ind = np.cumsum(mask) - 1
+        new_inds = (new_ind[inds[0][keep]], *(ind[keep] for ind in inds[1:]))
+        return new_inds, mels[keep], (int(np.sum(mask)), *shape[1:])
+    if len(val) != len(mask):
+        logger.error(
+            "The entry %s of the state has length %s, which does not match the "
+            "%s entries or %s trajectories of the batch.",
+            key,
+            len(val),
+            len(branch_mask),
+            len(traj_mask),
+        )
+        raise ValueError(
+            f"The entry {key} of the state has length {len(val)} but is expected "
+            f"to run over the {len(mask)} "
+            + ("trajectories" if key in trajectory_keys else "entries")
+            + " of the batch. Entries that run over the trajectories must be "
+            "listed in sim.algorithm.trajectory_keys and entries that do not run "
+            "over the batch in sim.algorithm.unbatched_keys."
+        )
+    new_val = val[mask]
+    if not val.flags.writeable:
+        new_val.flags.writeable = False
+    return new_val
+
+
+def _select_trajectories(sim, state, branch_mask, traj_mask, keep_output=True):
+    """
+    Returns the part of the state selected by ``branch_mask`` and ``traj_mask``.
+
+    Arrays run over the entries of the batch and are indexed with ``branch_mask``,
+    except for those named in ``sim.algorithm.trajectory_keys``, which run over
+    the trajectories of the batch and are indexed with ``traj_mask``, and those
+    named in ``sim.algorithm.unbatched_keys``, which are kept. Tuples are
+    sparse arrays ``(inds, mels, shape)`` over the entries of the batch, such as
+    ``dh_qc_dzc``. The outputs in the output dictionary are selected in the same
+    way if ``keep_output`` is True, otherwise the output dictionary is emptied.
+    All other entries are kept.
+    """
+    trajectory_keys = getattr(sim.algorithm, "trajectory_keys", ())
+    unbatched_keys = getattr(sim.algorithm, "unbatched_keys", ())
+    new_state = {}
+    for key, val in state.items():
+        if key in unbatched_keys:
+            new_state[key] = val
+        elif (isinstance(val, np.ndarray) and val.ndim > 0) or isinstance(val, tuple):
+            new_state[key] = _select_entry(
+                key, val, trajectory_keys, branch_mask, traj_mask
+            )
+        elif key == "output_dict":
+            new_state[key] = {}
+            if keep_output:
+                for output_key, output_val in val.items():
+                    new_state[key][output_key] = _select_entry(
+                        output_key, output_val, trajectory_keys, branch_mask, traj_mask
+                    )
+        else:
+            new_state[key] = val
+    return new_state
+
+
+def _concatenate_entry(val_a, val_b):
+    """
+    Returns the array or sparse array ``val_a`` followed by ``val_b``.
+    """
+    if isinstance(val_a, tuple):
+        inds_a, mels_a, shape_a = val_a
+        inds_b, mels_b, shape_b = val_b
+        inds = (
+            np.concatenate((inds_a[0], inds_b[0] + shape_a[0])),
+            *(np.concatenate(ind_pair) for ind_pair in zip(inds_a[1:], inds_b[1:])),
+        )
+        return (
+            inds,
+            np.concatenate((mels_a, mels_b)),
+            (
+                shape_a[0] + shape_b[0],
+                *shape_a[1:],
+            ),
+        )
+    new_val = np.concatenate((val_a, val_b))
+    if not val_a.flags.writeable:
+        new_val.flags.writeable = False
+    return new_val
+
+
+def _concatenate_states(sim, state_a, state_b):
+    """
+    Returns the state holding the trajectories of ``state_a`` followed by those of
+    ``state_b``, including their outputs. Arrays and sparse arrays that are only
+    in one of the states are dropped. Entries that are not batched are taken from
+    ``state_a``.
+    """
+    unbatched_keys = getattr(sim.algorithm, "unbatched_keys", ())
+    new_state = {}
+    for key, val in state_a.items():
+        if key in unbatched_keys:
+            new_state[key] = val
+        elif (isinstance(val, np.ndarray) and val.ndim > 0) or isinstance(val, tuple):
+            if key in state_b:
+                new_state[key] = _concatenate_entry(val, state_b[key])
+        elif key == "output_dict":
+            new_state[key] = {
+                output_key: _concatenate_entry(output_val, state_b[key][output_key])
+                for output_key, output_val in val.items()
+            }
+        else:
+            new_state[key] = val
+    return new_state
+
+
+def compact_batch(sim, state, parameters, frozen_state):
+    """
+    Moves the trajectories that meet ``sim.settings.stop_condition`` from the
+    active batch ``state`` into ``frozen_state`` along with the outputs collected
+    for them at the current time, and sets ``sim.settings.batch_size`` to the
+    size of the remaining batch.
+
+    A trajectory with several branches is only moved once all of its branches meet
+    the stop condition.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the stop condition.
+    state: dict
+        The state of the active batch.
+    parameters: dict
+        The parameters object.
+    frozen_state: dict | None
+        The state of the trajectories frozen so far, or None if there are none.
+
+    .. rubric:: Returns
+    state: dict
+        The state of the remaining active batch.
+    frozen_state: dict | None
+        The state of all frozen trajectories.
+    """
+    if len(state["seed"]) == 0:
+        return state, frozen_state
+    traj_ind, num_trajs = _trajectory_index(state)
+    finished = np.asarray(
+        sim.settings.stop_condition(sim, state, parameters), dtype=bool
+    )
+    if len(finished) == num_trajs and num_trajs != len(traj_ind):
+        finished = finished[traj_ind]
+    # A trajectory is finished once all of its branches are finished.
+    traj_finished = np.bincount(traj_ind, weights=~finished, minlength=num_trajs) == 0
+    if not np.any(traj_finished):
+        return state, frozen_state
+    branch_finished = traj_finished[traj_ind]
+    # The outputs of the finished trajectories were collected at this time and are
+    # kept with them, so that they are not collected again.
+    new_frozen_state = _select_trajectories(sim, state, branch_finished, traj_finished)
+    state = _select_trajectories(
+        sim, state, ~branch_finished, ~traj_finished, keep_output=False
+    )
+    if frozen_state is not None:
+        new_frozen_state = _concatenate_states(sim, frozen_state, new_frozen_state)
+    sim.settings.batch_size = len(state["seed"])
+    logger.info(
+        "Froze %s trajectories at t_ind=%s, %s remain active.",
+        np.sum(traj_finished),
+        sim.t_ind,
+        num_trajs - np.sum(traj_finished),
+    )
+    return state, new_frozen_state
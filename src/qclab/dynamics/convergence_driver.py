@@ -0,0 +1,225 @@
+"""
+This module contains the convergence driver.
+"""
+
+import logging
+import numpy as np
+from qclab.dynamics.serial_driver import serial_driver
+from qclab.dynamics.parallel_driver_mpi import parallel_driver_mpi
+from qclab.utils import get_log_output, reset_log_output
+from qclab import Data
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of rounds for estimating the standard error from the spread of
+# the means of the rounds, which is too noisy to decide convergence on with fewer
+# rounds.
+MIN_BATCH_MEANS_ROUNDS = 10
+
+
+def _standard_errors(round_means, round_norm_factors):
+    """
+    Estimates the standard error of the mean of each observable from the means of
+    the rounds using the weighted batch means method.
+
+    .. rubric:: Args
+    round_means: dict
+        Dictionary mapping each observable to a list of its means in each round.
+    round_norm_factors: list
+        The ``norm_factor`` of each round.
+
+    .. rubric:: Returns
+    standard_errors: dict
+        Dictionary mapping each observable to an array of its standard error.
+    """
+    weights = np.asarray(round_norm_factors, dtype=float)
+    num_rounds = len(weights)
+    weights = weights / np.sum(weights)
+    standard_errors = {}
+    for key, means in round_means.items():
+        means = np.asarray(means)
+        mean = np.tensordot(weights, means, axes=1)
+        deviations = np.abs(means - mean) ** 2
+        standard_errors[key] = np.sqrt(
+            np.tensordot(weights**2, deviations, axes=1) * num_rounds / (num_rounds - 1)
+        )
+    return standard_errors
+
+
+def convergence_driver(
+    sim,
+    observables,
+    tolerance,
+    max_trajs,
+    data=None,
+    driver=None,
+    min_rounds=2,
+    **driver_kwargs,
+):
+    """
+    Driver that runs rounds of ``sim.settings.num_trajs`` trajectories until the
+    standard error of the selected observables drops below ``tolerance`` or until
+    ``max_trajs`` trajectories have been run.
+
+    Each round is run by ``driver`` with seeds that continue from the largest seed
+    in ``data``, and the results are merged into ``data``. The rounds are run with
+    ``sim.settings.variance`` set to True, so the standard error of the mean of
+    each observable is computed from the variance over all trajectories run so
+    far with ``Data.get_standard_error``. If ``data`` is passed in with results
+    that do not track the variance, the standard error is instead estimated from
+    the spread of the means of the rounds (including the contents of ``data``),
+    and convergence is only checked after at least ``MIN_BATCH_MEANS_ROUNDS``
+    rounds since the estimate from fewer round means is too noisy. The same
+    estimate is used if ``use_shared_memory`` is passed in ``driver_kwargs``,
+    since shared memory does not support the variance. The largest standard error
+    over all elements of an observable is compared to the tolerance. The settings
+    of ``sim`` are restored when the driver returns or raises.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    observables: list of str
+        The keys of the outputs in the data dictionary to converge, for example
+        ``["dm_db", "quantum_energy"]``.
+    tolerance: float | dict
+        The target standard error, either for all observables or as a dictionary
+        mapping each observable to its target.
+    max_trajs: int
+        The maximum number of trajectories to run.
+    data: Data, optional
+        A Data object to add the results to. If None, a new Data object will be
+        created.
+    driver: callable, optional
+        The driver used to run each round, called as
+        ``driver(sim, seeds=seeds, **driver_kwargs)``. If None, ``serial_driver``
+        is used.
+    min_rounds: int, default: 2
+        The minimum number of rounds (including ``data`` passed in, if it is not
+        empty) before convergence is checked. Must be at least 1.
+    driver_kwargs:
+        Additional keyword arguments passed to ``driver``, such as ``num_tasks``.
+
+    .. rubric:: Returns
+    data: Data
+        The updated Data object containing collected output data. Its attribute
+        ``standard_error`` is a dictionary mapping each observable to an array of
+        its estimated standard error, or None if no error could be estimated.
+    """
+    if driver is None:
+        driver = serial_driver
+    if min_rounds < 1:
+        raise ValueError("min_rounds must be at least 1.")
+    for name in ("output_file", "trajectory_outputs"):
+        if getattr(sim.settings, name, None):
+            # Every round would overwrite the files of the previous round.
+            raise ValueError(f"The convergence driver does not support {name}.")
+    if not isinstance(tolerance, dict):
+        tolerance = {key: tolerance for key in observables}
+    use_mpi = driver is parallel_driver_mpi
+    if use_mpi:
+        from mpi4py import MPI
+
+        rank = MPI.COMM_WORLD.Get_rank()
+    else:
+        rank = 0
+    if data is None:
+        data = Data()
+    # The drivers adjust the number of trajectories and the batch size to the
+    # seeds they are given, so these are restored for every round.
+    round_trajs = sim.settings.num_trajs
+    batch_size = sim.settings.batch_size
+    variance = getattr(sim.settings, "variance", False)
+    if driver_kwargs.get("use_shared_memory", False):
+        logger.warning(
+            "Shared memory does not support the variance; estimating the standard "
+            "error from the means of at least %s rounds.",
+            MIN_BATCH_MEANS_ROUNDS,
+        )
+        use_variance = False
+    elif data.data_dict["norm_factor"] > 0 and "num_samples" not in data.data_dict:
+        logger.warning(
+            "The data passed in does not track the variance; estimating the "
+            "standard error from the means of at least %s rounds.",
+            MIN_BATCH_MEANS_ROUNDS,
+        )
+        use_variance = False
+    else:
+        use_variance = True
+    if not use_variance:
+        min_rounds = max(min_rounds, MIN_BATCH_MEANS_ROUNDS)
+    round_means = {key: [] for key in observables}
+    round_norm_factors = []
+    if data.data_dict["norm_factor"] > 0:
+        # Treat the existing data as the first round.
+        for key in observables:
+            round_means[key].append(data.data_dict[key])
+        round_norm_factors.append(data.data_dict["norm_factor"])
+    num_trajs = 0
+    standard_errors = None
+    converged = False
+    try:
+        sim.settings.variance = use_variance
+        while not converged and num_trajs < max_trajs:
+            # Continue the seeds from the largest seed in the data.
+            if len(data.data_dict["seed"]) > 0:
+                offset = data.seed_runs.max() + 1
+            else:
+                offset = 0
+            seeds = offset + np.arange(
+                min(round_trajs, max_trajs - num_trajs), dtype=int
+            )
+            logger.info(
+                "Running round %s with %s trajectories.",
+                len(round_norm_factors) + 1,
+                len(seeds),
+            )
+            sim.settings.batch_size = batch_size
+            new_data = driver(sim, seeds=seeds, **driver_kwargs)
+            num_trajs += len(seeds)
+            if rank == 0:
+                for key in observables:
+                    round_means[key].append(new_data.data_dict[key])
+                round_norm_factors.append(new_data.data_dict["norm_factor"])
+                data.add_data(new_data)
+                if use_variance:
+                    standard_errors = {
+                        key: data.get_standard_error(key) for key in observables
+                    }
+                elif len(round_norm_factors) >= 2:
+                    standard_errors = _standard_errors(round_means, round_norm_factors)
+                if len(round_norm_factors) >= min_rounds:
+                    converged = all(
+                        np.max(standard_errors[key]) <= tolerance[key]
+                        for key in observables
+                    )
+            else:
+                # Keep the seeds in step with rank 0 to compute the offset.
+                data.data_dict["seed"] = np.concatenate((data.data_dict["seed"], seeds))
+            if use_mpi:
+                converged = MPI.COMM_WORLD.bcast(converged, root=0)
+    finally:
+        sim.settings.num_trajs = round_trajs
+        sim.settings.batch_size = batch_size
+        sim.settings.variance = variance
+    # The logs of the rounds were merged into the data by add_data.
+    reset_log_output()
+    if rank == 0:
+        if standard_errors is None:
+            logger.warning("No standard error could be estimated.")
+        else:
+            for key in observables:
+                logger.info(
+                    "Standard error of %s: %s (tolerance %s).",
+                    key,
+                    np.max(standard_errors[key]),
+                    tolerance[key],
+                )
+        if converged:
+            logger.info("Converged after %s trajectories.", num_trajs)
+        else:
+            logger.warning(
+                "Not converged after the maximum of %s trajectories.", max_trajs
+            )
+    data.standard_error = standard_errors
+    data.log += get_log_output()
+    return data
@@ -2,14 +2,459 @@
 This module contains the dynamics core.
 """
 
+import os
+import hashlib
+import logging
 import numpy as np
 from tqdm import tqdm
+from qclab.dynamics.compaction import compact_batch
+from qclab.profiler import Profiler
+
+logger = logging.getLogger(__name__)
+
+
+def _get_checkpoint_file(sim, data):
+    """
+    Returns the checkpoint file of the batch collected in ``data``, or None if
+    checkpointing is disabled.
+
+    The file name is determined by the first seed and the number of seeds of the
+    batch so that a rerun of the same simulation finds the checkpoints of its
+    batches.
+    """
+    checkpoint_dir = getattr(sim.settings, "checkpoint_dir", None)
+    if checkpoint_dir is None:
+        return None
+    seeds = data.data_dict["seed"]
+    if len(seeds) == 0:
+        return None
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    return os.path.join(checkpoint_dir, f"checkpoint_{seeds[0]}_{len(seeds)}.npz")
+
+
+# Settings of the simulation, besides the timesteps and seeds, that change the
+# results of a batch and so must match for a checkpoint to be resumed.
+_CHECKPOINT_SETTINGS = (
+    "dt_update",
+    "adaptive_tol",
+    "adaptive_dt_max",
+    "stop_condition",
+    "variance",
+)
+
+
+def _checkpoint_signature(sim):
+    """
+    Returns a hash of the model and algorithm classes, the model constants, the
+    algorithm settings, the initial state and the settings in
+    ``_CHECKPOINT_SETTINGS`` of ``sim``, so that a checkpoint is only resumed by a
+    simulation that produces the same results.
+    """
+    items = [
+        ("model", type(sim.model).__name__),
+        ("algorithm", type(sim.algorithm).__name__),
+    ]
+    for prefix, values in [
+        ("model_constants", vars(sim.model.constants)),
+        ("algorithm_settings", vars(sim.algorithm.settings)),
+        ("initial_state", sim.initial_state),
+        (
+            "settings",
+            {key: getattr(sim.settings, key, None) for key in _CHECKPOINT_SETTINGS},
+        ),
+    ]:
+        items += [
+            (f"{prefix}.{key}", val)
+            for key, val in sorted(values.items())
+            if not key.startswith("_")
+        ]
+    digest = hashlib.sha1()
+    for key, val in items:
+        digest.update(key.encode("utf-8"))
+        if isinstance(val, np.ndarray) and not val.dtype.hasobject:
+            digest.update(f"{val.dtype}{val.shape}".encode("utf-8"))
+            digest.update(np.ascontiguousarray(val).tobytes())
+        elif callable(val):
+            name = (
+                f"{getattr(val, '__module__', '')}.{getattr(val, '__qualname__', '')}"
+            )
+            digest.update(name.encode("utf-8"))
+        else:
+            digest.update(repr(val).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _save_checkpoint(
+    checkpoint_file,
+    sim,
+    t_ind,
+    state,
+    parameters,
+    data,
+    step_n=1,
+    frozen_state=None,
+):
+    """
+    Saves the state, parameters and partially filled data of a batch so that it
+    can be resumed at time index ``t_ind``. ``step_n`` is the current step of the
+    adaptive time stepping in units of ``dt_update`` and ``frozen_state`` is the
+    state of the trajectories removed from the batch by the stop condition.
+
+    The checkpoint is first written to a temporary file which then replaces the
+    previous checkpoint, so that a job killed while writing does not leave a
+    corrupted checkpoint behind.
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.savez(
+            f,
+            t_ind=t_ind,
+            tmax_n=sim.settings.tmax_n,
+            dt_collect_n=sim.settings.dt_collect_n,
+            signature=_checkpoint_signature(sim),
+            seed=data.data_dict["seed"],
+            step_n=step_n,
+            state=np.array(state, dtype=object),
+            parameters=np.array(parameters, dtype=object),
+            frozen_state=np.array(frozen_state, dtype=object),
+            data_dict=np.array(data.data_dict, dtype=object),
+        )
+    os.replace(tmp_file, checkpoint_file)
+    logger.info("Saved checkpoint %s at t_ind=%s.", checkpoint_file, t_ind)
+
+
+def _load_checkpoint(checkpoint_file, sim, data):
+    """
+    Loads a checkpoint saved by ``_save_checkpoint``.
+
+    Returns None if the checkpoint does not belong to the batch, timesteps, model,
+    algorithm and settings of the current simulation (see
+    ``_checkpoint_signature``), otherwise the time index to resume at along with
+    the saved state, parameters, adaptive step and frozen state. The saved output
+    data is restored into ``data``.
+    """
+    with np.load(checkpoint_file, allow_pickle=True) as checkpoint:
+        if (
+            "signature" not in checkpoint.files
+            or str(checkpoint["signature"]) != _checkpoint_signature(sim)
+            or checkpoint["tmax_n"] != sim.settings.tmax_n
+            or checkpoint["dt_collect_n"] != sim.settings.dt_collect_n
+            or not np.array_equal(checkpoint["seed"], data.data_dict["seed"])
+        ):
+            logger.warning(
+                "Ignoring checkpoint %s which does not match the simulation.",
+                checkpoint_file,
+            )
+            return None
+        t_ind = int(checkpoint["t_ind"])
+        step_n = int(checkpoint["step_n"]) if "step_n" in checkpoint.files else 1
+        state = checkpoint["state"][()]
+        parameters = checkpoint["parameters"][()]
+        frozen_state = None
+        if "frozen_state" in checkpoint.files:
+            frozen_state = checkpoint["frozen_state"][()]
+        data.data_dict = checkpoint["data_dict"][()]
+    logger.info("Resuming from checkpoint %s at t_ind=%s.", checkpoint_file, t_ind)
+    return t_ind, state, parameters, step_n, frozen_state
+
+
+def _copy_state(state):
+    """
+    Returns a copy of the state in which every writeable array is copied, so that
+    a rejected adaptive step can be undone.
+    """
+    return {
+        key: val.copy() if isinstance(val, np.ndarray) and val.flags.writeable else val
+        for key, val in state.items()
+    }
+
+
+def _total_energy(state):
+    """
+    Returns the total energy of each trajectory as computed by the energy recipe
+    of the algorithm. The quantum energy is summed over the branches of each
+    trajectory.
+    """
+    classical_energy = np.asarray(state["classical_energy"])
+    quantum_energy = np.asarray(state["quantum_energy"])
+    return classical_energy + np.sum(
+        quantum_energy.reshape((len(classical_energy), -1)), axis=-1
+    )
+
+
+def _prepare_recipe(sim, recipe, recipe_name, profiler, compile_recipe=True):
+    """
+    Compiles ``recipe`` unless ``compile_recipe`` is False and instruments its
+    tasks if ``profiler`` is not None.
+    """
+    if compile_recipe:
+        recipe = sim.algorithm.compile_recipe(sim, recipe)
+    if profiler is not None:
+        recipe = profiler.instrument_recipe(recipe, recipe_name)
+    return recipe
+
+
+def _collect_output(
+    sim,
+    state,
+    parameters,
+    frozen_state,
+    data,
+    collect_recipe,
+    frozen_collect_recipe,
+):
+    """
+    Executes the collect recipe for the active trajectories and adds their output
+    along with that of the frozen trajectories to ``data`` at the current time
+    index.
+
+    If ``sim.settings.stop_condition`` is set, the trajectories that meet it are
+    then removed from the active batch together with their outputs, so that the
+    output of each trajectory is collected up to the time at which it is frozen
+    and carried forward from there. Only the frozen collect recipe, which
+    collects the outputs that change with the time alone, is executed for the
+    frozen trajectories.
+
+    .. rubric:: Returns
+    state: dict
+        The state of the active batch.
+    parameters: dict
+        The parameters object.
+    frozen_state: dict | None
+        The state of the frozen trajectories.
+    """
+    output_dicts = []
+    if len(state["seed"]) > 0:
+        state, parameters = sim.algorithm.execute_recipe(
+            sim, state, parameters, collect_recipe
+        )
+        output_dicts.append(state["output_dict"])
+    if frozen_state is not None:
+        batch_size = sim.settings.batch_size
+        sim.settings.batch_size = len(frozen_state["seed"])
+        try:
+            frozen_state, parameters = sim.algorithm.execute_recipe(
+                sim, frozen_state, parameters, frozen_collect_recipe
+            )
+        finally:
+            sim.settings.batch_size = batch_size
+        output_dicts.append(frozen_state["output_dict"])
+    if len(output_dicts) == 1:
+        output_state = {
+            "norm_factor": state["norm_factor"],
+            "output_dict": output_dicts[0],
+        }
+    else:
+        output_state = {
+            "norm_factor": state["norm_factor"],
+            "output_dict": {
+                key: np.concatenate([output_dict[key] for output_dict in output_dicts])
+                for key in output_dicts[0]
+            },
+        }
+    if frozen_state is not None and "batch_ind" in frozen_state:
+        # Index of each row of the output in the batch, which compaction reorders.
+        output_state["batch_ind"] = np.concatenate(
+            (state["batch_ind"], frozen_state["batch_ind"])
+        )
+    data.add_output_to_data_dict(sim, output_state, sim.t_ind)
+    if getattr(sim.settings, "stop_condition", None) is not None:
+        state, frozen_state = compact_batch(sim, state, parameters, frozen_state)
+    return state, parameters, frozen_state
+
+
+def _run_adaptive_time_loop(
+    sim,
+    state,
+    parameters,
+    data,
+    t_ind_start,
+    step_n,
+    frozen_state,
+    collect_recipe,
+    frozen_collect_recipe,
+    checkpoint_file,
+    checkpoint_interval_n,
+    profiler,
+):
+    """
+    Time loop of ``run_dynamics`` with adaptive time steps.
+
+    Each step advances the time index by ``step_n`` update timesteps by executing
+    the update recipe with ``sim.settings.dt_update`` multiplied by ``step_n``. A
+    step that changes the total energy of any trajectory by more than
+    ``sim.settings.adaptive_tol`` is undone and retried with half the step, down
+    to a single update timestep, which is always accepted. After a step whose
+    energy change is small enough that twice the step is expected to be
+    accepted, the step is doubled up to ``sim.settings.adaptive_dt_max``. Steps
+    never cross a collect timestep, so the output is collected at the same times
+    as with a fixed time step.
+
+    .. rubric:: Returns
+    state: dict
+        The state at the end of the batch.
+    parameters: dict
+        The parameters at the end of the batch.
+    step_n: int
+        The adaptive step at the end of the batch.
+    frozen_state: dict | None
+        The state of the frozen trajectories at the end of the batch.
+    """
+    if len(sim.algorithm.energy_recipe) == 0:
+        raise ValueError(
+            "Adaptive time stepping requires an algorithm with an energy recipe."
+        )
+    dt_update = sim.settings.dt_update
+    tmax_n = sim.settings.tmax_n
+    dt_collect_n = sim.settings.dt_collect_n
+    adaptive_tol = sim.settings.adaptive_tol
+    adaptive_dt_max = getattr(sim.settings, "adaptive_dt_max", None)
+    max_step_n = dt_collect_n
+    if adaptive_dt_max is not None:
+        max_step_n = min(max_step_n, max(1, int(adaptive_dt_max / dt_update)))
+    step_n = min(step_n, max_step_n)
+    energy_recipe = _prepare_recipe(
+        sim, sim.algorithm.energy_recipe, "energy", profiler
+    )
+    # Update recipes compiled for each multiple of dt_update.
+    update_recipes = {}
+    progress_bar = None
+    if getattr(sim.settings, "progress_bar", True):
+        progress_bar = tqdm(total=max(tmax_n - t_ind_start, 0))
+    energy = None
+    num_steps = 0
+    num_rejected = 0
+    t_ind = t_ind_start
+    while t_ind <= tmax_n:
+        sim.t_ind = t_ind
+        if t_ind == 0:
+            # Execute initialization recipe.
+            state, parameters = sim.algorithm.execute_recipe(
+                sim,
+                state,
+                parameters,
+                _prepare_recipe(
+                    sim,
+                    sim.algorithm.initialization_recipe,
+                    "initialization",
+                    profiler,
+                    compile_recipe=False,
+                ),
+            )
+        # Detect collect timesteps.
+        if np.mod(t_ind, dt_collect_n) == 0:
+            batch_size = sim.settings.batch_size
+            state, parameters, frozen_state = _collect_output(
+                sim,
+                state,
+                parameters,
+                frozen_state,
+                data,
+                collect_recipe,
+                frozen_collect_recipe,
+            )
+            if sim.settings.batch_size != batch_size:
+                energy = None
+        if t_ind == tmax_n:
+            break
+        # Do not step past the next collect timestep.
+        next_collect_ind = (t_ind // dt_collect_n + 1) * dt_collect_n
+        if len(state["seed"]) == 0:
+            # All trajectories are frozen.
+            if progress_bar is not None:
+                progress_bar.update(next_collect_ind - t_ind)
+            t_ind = next_collect_ind
+            continue
+        if energy is None:
+            state, parameters = sim.algorithm.execute_recipe(
+                sim, state, parameters, energy_recipe
+            )
+            energy = _total_energy(state)
+        while True:
+            n = min(step_n, next_collect_ind - t_ind)
+            previous_state = _copy_state(state) if n > 1 else None
+            sim.settings.dt_update = n * dt_update
+            try:
+                if n not in update_recipes:
+                    update_recipes[n] = _prepare_recipe(
+                        sim, sim.algorithm.update_recipe, "update", profiler
+                    )
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim, state, parameters, update_recipes[n]
+                )
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim, state, parameters, energy_recipe
+                )
+            finally:
+                sim.settings.dt_update = dt_update
+            new_energy = _total_energy(state)
+            error = np.max(np.abs(new_energy - energy))
+            if error <= adaptive_tol or n == 1:
+                break
+            # Undo the step and retry with half the step.
+            num_rejected += 1
+            state = previous_state
+            step_n = max(1, n // 2)
+        energy = new_energy
+        num_steps += 1
+        # The energy error of a step of the RK4 integrators scales with the fifth
+        # power of the step, so it grows by 32 when the step is doubled.
+        if n == step_n and 32 * error <= adaptive_tol:
+            step_n = min(2 * step_n, max_step_n)
+        if progress_bar is not None:
+            progress_bar.update(n)
+        # Save a checkpoint to resume from at the next timestep.
+        if (
+            checkpoint_file is not None
+            and (t_ind + n) // checkpoint_interval_n > t_ind // checkpoint_interval_n
+        ):
+            _save_checkpoint(
+                checkpoint_file,
+                sim,
+                t_ind + n,
+                state,
+                parameters,
+                data,
+                step_n,
+                frozen_state,
+            )
+        t_ind += n
+    if progress_bar is not None:
+        progress_bar.close()
+    logger.info(
+        "Adaptive time stepping took %s steps (%s rejected) for %s update timesteps.",
+        num_steps,
+        num_rejected,
+        max(tmax_n - t_ind_start, 0),
+    )
+    return state, parameters, step_n, frozen_state
 
 
 def run_dynamics(sim, state, parameters, data):
     """
     Dynamics core for QC Lab.
 
+    If ``sim.settings.checkpoint_dir`` is set, the state, parameters and collected
+    data of the batch are saved to a checkpoint file in that directory every
+    ``sim.settings.checkpoint_interval`` units of time and at the end of the
+    batch. If a matching checkpoint already exists, the batch is resumed from it
+    instead of being started from the beginning.
+
+    If ``sim.settings.adaptive_tol`` is set, the update recipe is executed with
+    adaptive time steps that are multiples of ``sim.settings.dt_update``, chosen
+    such that the total energy of each trajectory, as computed by the energy
+    recipe of the algorithm, changes by at most ``adaptive_tol`` per step.
+
+    If ``sim.settings.stop_condition`` is set, it is evaluated at every collect
+    timestep and the trajectories that meet it are frozen: they are removed from
+    the arrays of the state, so that later timesteps only propagate the remaining
+    trajectories, while their output at later collect timesteps is computed from
+    their frozen state.
+
+    If ``sim.settings.profile`` is True, the wall time, number of calls and number
+    of bytes newly stored in the state by each task are recorded in
+    ``data.profile``.
+
     .. rubric:: Args
     sim: Simulation
         The simulation object containing the model, algorithm, and settings.
@@ -24,28 +469,130 @@ def run_dynamics(sim, state, parameters, data):
     data: Data
         The updated data object containing collected output data.
     """
-    # Define an update iterator using tqdm if progress_bar is True.
-    t_update_iterator = sim.settings.t_update_n
-    if getattr(sim.settings, "progress_bar", True):
-        t_update_iterator = tqdm(t_update_iterator)
-
-    # Iterate over each time step.
-    for sim.t_ind in t_update_iterator:
-        if sim.t_ind == 0:
-            # Execute initialization recipe.
-            state, parameters = sim.algorithm.execute_recipe(
-                sim, state, parameters, sim.algorithm.initialization_recipe
-            )
-        # Detect collect timesteps.
-        if np.mod(sim.t_ind, sim.settings.dt_collect_n) == 0:
-            # Calculate output variables.
-            state, parameters = sim.algorithm.execute_recipe(
-                sim, state, parameters, sim.algorithm.collect_recipe
+    # Resume from a checkpoint of this batch if there is one.
+    t_ind_start = 0
+    step_n = 1
+    frozen_state = None
+    batch_size = sim.settings.batch_size
+    checkpoint_interval_n = None
+    checkpoint_file = _get_checkpoint_file(sim, data)
+    if checkpoint_file is not None:
+        checkpoint_interval = getattr(sim.settings, "checkpoint_interval", None)
+        if checkpoint_interval is None:
+            checkpoint_interval_n = len(sim.settings.t_update_n)
+        else:
+            checkpoint_interval_n = max(
+                1, int(np.round(checkpoint_interval / sim.settings.dt_update))
             )
-            # Collect totals in output dictionary.
-            data.add_output_to_data_dict(sim, state, sim.t_ind)
-        # Execute update recipe.
-        state, parameters = sim.algorithm.execute_recipe(
-            sim, state, parameters, sim.algorithm.update_recipe
+        if os.path.exists(checkpoint_file):
+            checkpoint = _load_checkpoint(checkpoint_file, sim, data)
+            if checkpoint is not None:
+                t_ind_start, state, parameters, step_n, frozen_state = checkpoint
+                sim.settings.batch_size = len(state["seed"])
+    if (
+        t_ind_start == 0
+        and getattr(sim.settings, "stop_condition", None) is not None
+        and getattr(sim.settings, "trajectory_outputs", None)
+    ):
+        # Track the entries of the batch through compaction to store the outputs
+        # of each trajectory in its row.
+        state["batch_ind"] = np.arange(len(state["seed"]))
+
+    # Record the cost of each task if profiling is enabled.
+    profiler = Profiler() if getattr(sim.settings, "profile", False) else None
+    # Compile the update and collect recipes once for the whole time loop.
+    update_recipe = _prepare_recipe(
+        sim, sim.algorithm.update_recipe, "update", profiler
+    )
+    collect_recipe = _prepare_recipe(
+        sim, sim.algorithm.collect_recipe, "collect", profiler
+    )
+    frozen_collect_recipe = _prepare_recipe(
+        sim, sim.algorithm.frozen_collect_recipe, "frozen_collect", profiler
+    )
+
+    if getattr(sim.settings, "adaptive_tol", None) is not None:
+        state, parameters, step_n, frozen_state = _run_adaptive_time_loop(
+            sim,
+            state,
+            parameters,
+            data,
+            t_ind_start,
+            step_n,
+            frozen_state,
+            collect_recipe,
+            frozen_collect_recipe,
+            checkpoint_file,
+            checkpoint_interval_n,
+            profiler,
+        )
+    else:
+        # Define an update iterator using tqdm if progress_bar is True.
+        t_update_iterator = sim.settings.t_update_n[t_ind_start:]
+        if getattr(sim.settings, "progress_bar", True):
+            t_update_iterator = tqdm(t_update_iterator)
+
+        # Iterate over each time step.
+        for sim.t_ind in t_update_iterator:
+            if sim.t_ind == 0:
+                # Execute initialization recipe.
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim,
+                    state,
+                    parameters,
+                    _prepare_recipe(
+                        sim,
+                        sim.algorithm.initialization_recipe,
+                        "initialization",
+                        profiler,
+                        compile_recipe=False,
+                    ),
+                )
+            # Detect collect timesteps.
+            if np.mod(sim.t_ind, sim.settings.dt_collect_n) == 0:
+                # Calculate output variables and collect totals in output
+                # dictionary.
+                state, parameters, frozen_state = _collect_output(
+                    sim,
+                    state,
+                    parameters,
+                    frozen_state,
+                    data,
+                    collect_recipe,
+                    frozen_collect_recipe,
+                )
+            # Execute update recipe unless all trajectories are frozen.
+            if len(state["seed"]) > 0:
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim, state, parameters, update_recipe
+                )
+            # Save a checkpoint to resume from at the next timestep.
+            if (
+                checkpoint_file is not None
+                and np.mod(sim.t_ind + 1, checkpoint_interval_n) == 0
+            ):
+                _save_checkpoint(
+                    checkpoint_file,
+                    sim,
+                    sim.t_ind + 1,
+                    state,
+                    parameters,
+                    data,
+                    frozen_state=frozen_state,
+                )
+    # Save a final checkpoint so that a completed batch is not rerun.
+    if checkpoint_file is not None and t_ind_start < len(sim.settings.t_update_n):
+        _save_checkpoint(
+            checkpoint_file,
+            sim,
+            len(sim.settings.t_update_n),
+            state,
+            parameters,
+            data,
+            step_n,
+            frozen_state,
         )
+    sim.settings.batch_size = batch_size
+    if profiler is not None:
+        data.profile = profiler.get_profile()
     return data
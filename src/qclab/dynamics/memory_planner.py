@@ -0,0 +1,163 @@
+"""
+This module contains the memory planner, which chooses a batch size that fits a
+memory budget.
+"""
+
+import copy
+import logging
+import tracemalloc
+import numpy as np
+from qclab.profiler import _nbytes
+
+logger = logging.getLogger(__name__)
+
+# Numbers of trajectories of the dry runs that the memory per trajectory is fitted
+# to. They are far apart so that the difference of the traced peaks is not
+# dominated by the noise of the allocations that do not depend on the batch size.
+PROBE_NUM_TRAJS = (1, 16)
+
+
+def _num_branches(sim):
+    """
+    Returns the number of entries of the batch that each trajectory occupies.
+    """
+    if sim.algorithm.settings.get("fssh_deterministic"):
+        return sim.model.constants.num_quantum_states
+    return 1
+
+
+def _probe_memory(sim, num_trajs):
+    """
+    Returns the peak number of bytes allocated while executing the initialization
+    recipe, a single step of the update recipe and the collect recipe for a batch
+    of ``num_trajs`` trajectories, and the number of bytes held by the arrays of
+    the final state.
+
+    The peak is measured with ``tracemalloc``, which traces the arrays allocated by
+    numpy. Arrays allocated inside jit-compiled functions are not traced, so the
+    peak is at least the number of bytes held by the final state.
+    """
+    probe_sim = copy.deepcopy(sim)
+    probe_sim.settings.batch_size = num_trajs * _num_branches(sim)
+    probe_sim.t_ind = 0
+    state = {"seed": np.arange(probe_sim.settings.batch_size, dtype=int)}
+    parameters = {}
+    tracemalloc.start()
+    try:
+        for recipe in (
+            probe_sim.algorithm.initialization_recipe,
+            probe_sim.algorithm.update_recipe,
+            probe_sim.algorithm.collect_recipe,
+        ):
+            state, parameters = probe_sim.algorithm.execute_recipe(
+                probe_sim, state, parameters, recipe
+            )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    state_bytes = sum(_nbytes(val) for val in state.values())
+    return max(peak, state_bytes), state_bytes
+
+
+def estimate_batch_memory(sim):
+    """
+    Estimates the memory needed to run a batch of the simulation ``sim`` as a fixed
+    number of bytes plus a number of bytes per trajectory.
+
+    The estimate is obtained from dry runs of one timestep for batches of the
+    numbers of trajectories in ``PROBE_NUM_TRAJS`` on a copy of ``sim``, so it
+    accounts for every quantity that the recipes of the algorithm store in the
+    state, such as the eigenvectors, the sparse or dense ``dh_qc_dzc`` and the
+    random numbers drawn for every timestep by surface hopping, as well as for
+    temporary arrays. The bytes per trajectory are the slope of the peak memory
+    between the dry runs, but at least the slope of the bytes held by the arrays
+    of the final state, which also covers arrays allocated by jit-compiled
+    functions that are not traced. If the peak memory does not grow with the
+    batch size, a warning is logged and the estimate from the arrays of the state
+    is used. A trajectory of deterministic surface hopping includes all of its
+    branches.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+
+    .. rubric:: Returns
+    fixed_bytes: int
+        The estimated number of bytes that does not depend on the batch size.
+    bytes_per_traj: int
+        The estimated number of bytes per trajectory.
+    """
+    sim.model.initialize_constants()
+    sim.initialize_timesteps()
+    # The first dry run compiles any jit functions that have not been compiled
+    # yet, whose allocations would be traced, so it is discarded.
+    num_trajs_small, num_trajs_large = PROBE_NUM_TRAJS
+    _probe_memory(sim, num_trajs_small)
+    memory_small, state_bytes_small = _probe_memory(sim, num_trajs_small)
+    memory_large, state_bytes_large = _probe_memory(sim, num_trajs_large)
+    num_trajs_diff = num_trajs_large - num_trajs_small
+    peak_per_traj = (memory_large - memory_small) / num_trajs_diff
+    state_bytes_per_traj = (state_bytes_large - state_bytes_small) / num_trajs_diff
+    if peak_per_traj <= 0:
+        logger.warning(
+            "The traced memory does not grow with the batch size; estimating the "
+            "memory per trajectory from the arrays of the state."
+        )
+    bytes_per_traj = max(int(np.ceil(max(peak_per_traj, state_bytes_per_traj))), 1)
+    fixed_bytes = max(memory_small - num_trajs_small * bytes_per_traj, 0)
+    logger.info(
+        "Estimated memory per batch: %s bytes plus %s bytes per trajectory.",
+        fixed_bytes,
+        bytes_per_traj,
+    )
+    return fixed_bytes, bytes_per_traj
+
+
+def plan_batch_size(sim, memory_budget=None):
+    """
+    Returns the largest batch size not exceeding ``sim.settings.batch_size`` whose
+    estimated memory, as given by ``estimate_batch_memory``, fits in
+    ``memory_budget``.
+
+    The batch size is a multiple of the number of branches of each trajectory in
+    deterministic surface hopping. If even a single trajectory does not fit in
+    the budget, a warning is logged and the batch size of a single trajectory is
+    returned.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+    memory_budget: float, optional
+        The memory available to each batch in bytes. If None,
+        ``sim.settings.memory_budget`` is used.
+
+    .. rubric:: Returns
+    batch_size: int
+        The planned batch size.
+    """
+    if memory_budget is None:
+        memory_budget = sim.settings.memory_budget
+    if memory_budget is None:
+        logger.error("No memory budget was given.")
+        raise ValueError("No memory budget was given.")
+    num_branches = _num_branches(sim)
+    fixed_bytes, bytes_per_traj = estimate_batch_memory(sim)
+    max_trajs = int((memory_budget - fixed_bytes) // bytes_per_traj)
+    if max_trajs < 1:
+        logger.warning(
+            "A single trajectory needs an estimated %s bytes, which exceeds the "
+            "memory budget of %s bytes.",
+            fixed_bytes + bytes_per_traj,
+            memory_budget,
+        )
+        max_trajs = 1
+    batch_size = min(sim.settings.batch_size, max_trajs * num_branches)
+    batch_size = max(batch_size - batch_size % num_branches, num_branches)
+    if batch_size < sim.settings.batch_size:
+        logger.warning(
+            "Reducing batch_size from %s to %s to fit the memory budget of %s bytes.",
+            sim.settings.batch_size,
+            batch_size,
+            memory_budget,
+        )
+    return batch_size
@@ -6,13 +6,373 @@ import logging
 import copy
 import numpy as np
 import qclab.dynamics as dynamics
-from qclab.utils import get_log_output, reset_log_output
+from qclab.dynamics.memory_planner import plan_batch_size
+from qclab.dynamics.tuning_cache import apply_tuned_settings
+from qclab.utils import (
+    get_log_output,
+    reset_log_output,
+    SeedSummary,
+    DISABLE_H5PY,
+)
+from qclab.trajectory_store import TrajectoryStore
 from qclab import Data
+from qclab.data import M2_SUFFIX, _is_variance_key, _check_stream_settings
+from qclab.profiler import merge_profiles
+
+if not DISABLE_H5PY:
+    import h5py
 
 logger = logging.getLogger(__name__)
 
 
-def parallel_driver_mpi(sim, seeds=None, data=None, num_tasks=None):
+def _parallel_hdf5_available():
+    """
+    Returns whether h5py was built with MPI support, which is required to write
+    a file from all ranks at once.
+    """
+    return not DISABLE_H5PY and h5py.get_config().mpi
+
+
+def _batch_input(sim, batch_seeds):
+    """
+    Creates the input arguments of the dynamics core for a single batch.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object with initialized timesteps.
+    batch_seeds: ndarray
+        The seeds of the batch, padded with NaN if the batch is incomplete.
+
+    .. rubric:: Returns
+    input_data: tuple
+        The simulation, state, parameters and data objects of the batch.
+    """
+    seeds = batch_seeds[~np.isnan(batch_seeds)].astype(int)
+    batch_sim = copy.deepcopy(sim)
+    # Determine the batch size from the seeds in the state object.
+    batch_sim.settings.batch_size = len(seeds)
+    return batch_sim, {"seed": seeds}, {}, Data(seeds)
+
+
+def _add_in_batch_order(data, new_data, batch_seeds):
+    """
+    Adds ``new_data``, into which the results of the batches were merged in order
+    of completion, to ``data`` with its seeds restored to the order of the
+    batches, whose seeds are ``batch_seeds``.
+    """
+    new_data.data_dict["seed"] = np.concatenate(
+        [seeds for seeds in batch_seeds if seeds is not None]
+    )
+    data.add_data(new_data)
+
+
+def _run_static(sim, comm, rank, size, batch_seeds_list, data, reduction):
+    """
+    Runs the batches split into equal contiguous chunks over the tasks.
+
+    If ``reduction`` is "send", the results are collected sequentially into ``data``
+    on rank 0, in the order of the batches, and None is returned. If it is
+    "collective", the results of each rank are merged locally and returned for a
+    subsequent collective reduction.
+    """
+    from mpi4py import MPI
+
+    num_batches = len(batch_seeds_list)
+    # Split the batches into chunks for each MPI process.
+    chunk_inds = np.linspace(0, num_batches, size + 1, dtype=int)
+    start = chunk_inds[rank]
+    end = chunk_inds[rank + 1]
+    # Create the input data for each local simulation.
+    local_input_data = [
+        _batch_input(sim, batch_seeds_list[n]) for n in range(start, end)
+    ]
+    for i, input_data in enumerate(local_input_data):
+        logger.info(
+            "Running batch %s with seeds %s.",
+            i + 1 + start,
+            SeedSummary(input_data[1]["seed"]),
+        )
+    # Execute the local batches.
+    logger.info("Starting dynamics calculation.")
+    if reduction == "collective":
+        local_data = Data()
+        for input_data in local_input_data:
+            local_data.add_data(dynamics.run_dynamics(*input_data))
+        logger.info("Dynamics calculation completed.")
+        return local_data
+    local_results = [dynamics.run_dynamics(*x) for x in local_input_data]
+    comm.Barrier()
+    logger.info("Dynamics calculation completed.")
+    # Collect results sequentially on rank 0.
+    tag_data, tag_done = 1, 2
+    if rank == 0:
+        logger.info("Collecting results from all tasks.")
+        # Merge the results as they arrive and restore the order of the seeds
+        # afterwards.
+        new_data = Data()
+        new_data.stream = data.stream
+        batch_seeds = [None] * num_batches
+        for batch_ind, result in enumerate(local_results, start=start):
+            batch_seeds[batch_ind] = result.data_dict["seed"]
+            new_data.add_data(result)
+        remaining = size - 1
+        status = MPI.Status()
+        while remaining:
+            msg = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == tag_done:
+                remaining -= 1
+            else:
+                batch_ind, result = msg
+                batch_seeds[batch_ind] = result.data_dict["seed"]
+                new_data.add_data(result)
+        _add_in_batch_order(data, new_data, batch_seeds)
+    else:
+        for batch_ind, result in enumerate(local_results, start=start):
+            comm.send((batch_ind, result), dest=0, tag=tag_data)
+        comm.send(None, dest=0, tag=tag_done)
+    return None
+
+
+def _run_dynamic(sim, comm, rank, size, batch_seeds_list, data, reduction):
+    """
+    Runs the batches with rank 0 acting as a scheduler that hands out batch indices
+    on demand.
+
+    Each worker rank sends a request and receives either the index of its next
+    batch or -1 when no batches remain. If ``reduction`` is "send", each request
+    carries the index and result of the previous batch (or None for the first
+    request), which rank 0 merges as it arrives; the seeds are restored to the
+    order of the batches once all batches are merged into ``data``, and None is
+    returned. If it is "collective", the results of each rank are merged locally
+    and returned for a subsequent collective reduction.
+
+    Rank 0 only schedules and merges, so the batches run on ``size - 1`` ranks.
+    """
+    from mpi4py import MPI
+
+    num_batches = len(batch_seeds_list)
+    tag_request, tag_batch = 3, 4
+    local_data = Data()
+    if rank == 0:
+        logger.info("Scheduling %s batches dynamically.", num_batches)
+        new_data = Data()
+        new_data.stream = data.stream
+        batch_seeds = [None] * num_batches
+        next_batch = 0
+        remaining = size - 1
+        status = MPI.Status()
+        while remaining:
+            msg = comm.recv(source=MPI.ANY_SOURCE, tag=tag_request, status=status)
+            if msg is not None:
+                batch_ind, result = msg
+                batch_seeds[batch_ind] = result.data_dict["seed"]
+                new_data.add_data(result)
+            if next_batch < num_batches:
+                comm.send(next_batch, dest=status.Get_source(), tag=tag_batch)
+                next_batch += 1
+            else:
+                comm.send(-1, dest=status.Get_source(), tag=tag_batch)
+                remaining -= 1
+        logger.info("Dynamics calculation completed.")
+        if reduction == "send":
+            _add_in_batch_order(data, new_data, batch_seeds)
+    elif rank < size:
+        msg = None
+        while True:
+            comm.send(msg, dest=0, tag=tag_request)
+            batch_ind = comm.recv(source=0, tag=tag_batch)
+            if batch_ind < 0:
+                break
+            input_data = _batch_input(sim, batch_seeds_list[batch_ind])
+            logger.info(
+                "Running batch %s with seeds %s.",
+                batch_ind + 1,
+                SeedSummary(input_data[1]["seed"]),
+            )
+            result = dynamics.run_dynamics(*input_data)
+            if reduction == "collective":
+                local_data.add_data(result)
+            else:
+                msg = (batch_ind, result)
+    comm.Barrier()
+    if reduction == "collective":
+        return local_data
+    return None
+
+
+def _local_outputs(local_data):
+    """
+    Returns the outputs in ``local_data``, excluding the seeds, the norm factor
+    and the variance.
+    """
+    return {
+        key: val
+        for key, val in local_data.data_dict.items()
+        if key not in ("seed", "norm_factor") and not _is_variance_key(key)
+    }
+
+
+def _output_specs(comm, local_outputs):
+    """
+    Returns the shape and dtype of every output of any rank, which all ranks agree
+    on since ranks that ran no batches have no outputs.
+    """
+    output_specs = {}
+    for rank_specs in comm.allgather(
+        {
+            key: (np.shape(val), np.asarray(val).dtype.str)
+            for key, val in local_outputs.items()
+        }
+    ):
+        output_specs.update(rank_specs)
+    return output_specs
+
+
+def _reduce_collective(comm, rank, local_data, data, seeds):
+    """
+    Reduces the locally merged data of every rank into ``data`` on rank 0.
+
+    The outputs are weighted by the local ``norm_factor`` and summed with
+    buffer-based ``comm.Reduce`` calls so that rank 0 never receives the data
+    objects of the other ranks. Only the profiles are gathered; the seeds of the
+    reduced data are ``seeds``, the seeds of all batches in order, since the
+    ranks may have run the batches in any order with dynamic scheduling. If the
+    variance is tracked, the means are broadcast back to the ranks, which then
+    reduce their sums of squared deviations from these means.
+    """
+    from mpi4py import MPI
+
+    local_norm_factor = local_data.data_dict["norm_factor"]
+    local_outputs = _local_outputs(local_data)
+    output_specs = _output_specs(comm, local_outputs)
+    norm_factor = comm.reduce(local_norm_factor, op=MPI.SUM, root=0)
+    profiles = comm.gather(local_data.profile, root=0)
+    if rank == 0:
+        logger.info("Reducing results from all tasks.")
+        reduced_data = Data(seeds)
+        reduced_data.data_dict["norm_factor"] = norm_factor
+        for profile in profiles:
+            reduced_data.profile = merge_profiles(reduced_data.profile, profile)
+    for key in sorted(output_specs):
+        shape, dtype = output_specs[key]
+        if key in local_outputs:
+            send_buffer = np.ascontiguousarray(
+                local_outputs[key] * local_norm_factor, dtype=dtype
+            )
+        else:
+            send_buffer = np.zeros(shape, dtype=dtype)
+        recv_buffer = np.empty(shape, dtype=dtype) if rank == 0 else None
+        comm.Reduce(send_buffer, recv_buffer, op=MPI.SUM, root=0)
+        if rank == 0:
+            reduced_data.data_dict[key] = recv_buffer / norm_factor
+    local_num_samples = local_data.data_dict.get("num_samples", 0)
+    num_samples = comm.allreduce(local_num_samples, op=MPI.SUM)
+    if num_samples > 0:
+        means = None
+        if rank == 0:
+            means = {key: reduced_data.data_dict[key] for key in output_specs}
+        means = comm.bcast(means, root=0)
+        for key in sorted(output_specs):
+            shape, _ = output_specs[key]
+            send_buffer = np.zeros(shape, dtype=float)
+            if key + M2_SUFFIX in local_data.data_dict:
+                # Shift the sum of squared deviations of the rank to the mean
+                # over all ranks.
+                send_buffer += local_data.data_dict[key + M2_SUFFIX] + (
+                    local_num_samples * np.abs(local_outputs[key] - means[key]) ** 2
+                )
+            recv_buffer = np.empty(shape, dtype=float) if rank == 0 else None
+            comm.Reduce(send_buffer, recv_buffer, op=MPI.SUM, root=0)
+            if rank == 0:
+                reduced_data.data_dict[key + M2_SUFFIX] = recv_buffer
+        if rank == 0:
+            reduced_data.data_dict["num_samples"] = num_samples
+    if rank == 0:
+        data.add_data(reduced_data)
+
+
+def _write_parallel(comm, rank, local_data, data, filename, seeds):
+    """
+    Writes the locally merged data of every rank to the HDF5 file ``filename``
+    with parallel HDF5, opening it on all ranks with ``driver="mpio"``.
+
+    The seeds in the file are the seeds already in ``data`` followed by
+    ``seeds``, the seeds of all batches in order, and each rank writes an equal
+    slice of them. The outputs are split into equal contiguous slices of collect times, one per
+    rank: the weighted sums of the ranks are reduced with ``comm.Reduce_scatter``
+    such that each rank receives the sums of its slice, which it writes to the
+    file. Rank 0 therefore neither receives nor writes the outputs of the other
+    ranks. As when streaming output, ``data`` on rank 0 is left with only the
+    seeds and ``norm_factor``; outputs already in ``data`` are written to the
+    file ahead of the new ones.
+    """
+    from mpi4py import MPI
+
+    size = comm.Get_size()
+    if rank == 0:
+        rank_data = Data()
+        rank_data.add_data(data)
+        rank_data.add_data(local_data)
+        local_data = rank_data
+    local_norm_factor = local_data.data_dict["norm_factor"]
+    local_outputs = _local_outputs(local_data)
+    output_specs = _output_specs(comm, local_outputs)
+    norm_factor = comm.allreduce(local_norm_factor, op=MPI.SUM)
+    prior_seeds = comm.bcast(
+        np.asarray(data.data_dict["seed"], dtype=int) if rank == 0 else None, root=0
+    )
+    all_seeds = np.concatenate((prior_seeds, np.asarray(seeds, dtype=int)))
+    seed_bounds = np.linspace(0, len(all_seeds), size + 1, dtype=int)
+    seed_slice = slice(seed_bounds[rank], seed_bounds[rank + 1])
+    profiles = comm.gather(local_data.profile, root=0)
+    logger.info("Writing results from all tasks to %s.", filename)
+    with h5py.File(filename, "w", driver="mpio", comm=comm) as h5file:
+        # Datasets are created collectively, so every rank creates all of them.
+        h5file.attrs["log"] = ""
+        seed_dataset = h5file.create_dataset("seed", shape=(len(all_seeds),), dtype=int)
+        h5file.create_dataset("norm_factor", data=float(norm_factor))
+        if seed_slice.stop > seed_slice.start:
+            seed_dataset[seed_slice] = all_seeds[seed_slice]
+        for key in sorted(output_specs):
+            shape, dtype = output_specs[key]
+            dataset = h5file.create_dataset(key, shape=shape, dtype=dtype)
+            bounds = np.linspace(0, shape[0], size + 1, dtype=int)
+            row_size = int(np.prod(shape[1:], dtype=int))
+            if key in local_outputs:
+                send_buffer = np.ascontiguousarray(
+                    local_outputs[key] * local_norm_factor, dtype=dtype
+                )
+            else:
+                send_buffer = np.zeros(shape, dtype=dtype)
+            recv_buffer = np.empty(
+                (bounds[rank + 1] - bounds[rank], *shape[1:]), dtype=dtype
+            )
+            comm.Reduce_scatter(
+                send_buffer,
+                recv_buffer,
+                recvcounts=[int(n) * row_size for n in np.diff(bounds)],
+                op=MPI.SUM,
+            )
+            if len(recv_buffer) > 0:
+                dataset[bounds[rank] : bounds[rank + 1]] = recv_buffer / norm_factor
+    if rank == 0:
+        data.data_dict = {
+            "seed": all_seeds,
+            "norm_factor": norm_factor,
+        }
+        data.profile = None
+        for profile in profiles:
+            data.profile = merge_profiles(data.profile, profile)
+
+
+def parallel_driver_mpi(
+    sim,
+    seeds=None,
+    data=None,
+    num_tasks=None,
+    scheduling="static",
+    reduction="send",
+):
     """
     Parallel driver for the dynamics core using the mpi4py library.
 
@@ -28,6 +388,26 @@ def parallel_driver_mpi(sim, seeds=None, data=None, num_tasks=None):
     num_tasks: int, optional
         The number of tasks to use for parallel processing. If None, the
         number of available tasks will be used.
+    scheduling: str, default: "static"
+        How batches are assigned to the tasks. If "static", the batches are split
+        into equal contiguous chunks, one per task. If "dynamic", rank 0 hands out
+        batches on demand to the other ranks and merges their results as they
+        finish, which balances the load when the cost per batch varies (for
+        example in surface hopping with many frustrated hops). Since rank 0 does
+        not run batches itself, the batches run on one rank fewer than with static
+        scheduling. Dynamic scheduling requires at least two tasks and falls back
+        to static scheduling otherwise. With either scheduling, the seeds of the
+        returned data are in the order of the batches.
+    reduction: str, default: "send"
+        How the results are combined on rank 0. If "send", the data object of each
+        batch is sent to rank 0 and merged there one at a time. If "collective",
+        each rank first merges its own batches and the outputs are then summed
+        across ranks with buffer-based MPI reductions, which avoids funneling every
+        batch through rank 0 when running on many ranks. If, in addition,
+        ``sim.settings.output_file`` is set and h5py was built with MPI support,
+        all ranks write the outputs to the file together with parallel HDF5, each
+        writing its own slice of the collect times; otherwise rank 0 writes the
+        file.
 
     .. rubric:: Returns
     data: Data
@@ -49,7 +429,7 @@ def parallel_driver_mpi(sim, seeds=None, data=None, num_tasks=None):
         offset = 0
         if data is not None:
             if len(data.data_dict["seed"]) > 0:
-                offset = np.max(data.data_dict["seed"]) + 1
+                offset = data.seed_runs.max() + 1
         else:
             data = Data()
         seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
@@ -70,6 +450,18 @@ def parallel_driver_mpi(sim, seeds=None, data=None, num_tasks=None):
     else:
         size = num_tasks
     logger.info("Using %s tasks for parallel processing.", size)
+    # Use the batch size stored by autotune and cap it to fit the memory budget
+    # of each batch, as determined by rank 0 so that all ranks agree on the
+    # batches.
+    if getattr(sim.settings, "autotune", False) or (
+        getattr(sim.settings, "memory_budget", None) is not None
+    ):
+        if rank == 0:
+            if getattr(sim.settings, "autotune", False):
+                apply_tuned_settings(sim, num_tasks=size)
+            if getattr(sim.settings, "memory_budget", None) is not None:
+                sim.settings.batch_size = plan_batch_size(sim)
+        sim.settings.batch_size = comm.bcast(sim.settings.batch_size, root=0)
     # Determine the number of batches required to execute the total number
     # of trajectories.
     if num_trajs % sim.settings.batch_size == 0:
@@ -86,56 +478,68 @@ def parallel_driver_mpi(sim, seeds=None, data=None, num_tasks=None):
     )
     batch_seeds_list[:num_trajs] = seeds
     batch_seeds_list = batch_seeds_list.reshape((num_batches, sim.settings.batch_size))
-    # Split the batches into chunks for each MPI process.
-    chunk_inds = np.linspace(0, num_batches, size + 1, dtype=int)
-    start = chunk_inds[rank]
-    end = chunk_inds[rank + 1]
-    chunk_size = end - start
-    # Create the input data for each local simulation.
     sim.initialize_timesteps()
-    local_input_data = [
-        (
-            copy.deepcopy(sim),
-            {"seed": batch_seeds_list[n][~np.isnan(batch_seeds_list[n])].astype(int)},
-            {},
-            Data(batch_seeds_list[n][~np.isnan(batch_seeds_list[n])].astype(int)),
+    if scheduling not in ("static", "dynamic"):
+        raise ValueError(f"Invalid scheduling value: {scheduling}")
+    if reduction not in ("send", "collective"):
+        raise ValueError(f"Invalid reduction value: {reduction}")
+    if scheduling == "dynamic" and size < 2:
+        logger.warning(
+            "Dynamic scheduling requires at least two tasks; using static scheduling."
         )
-        for n in np.arange(num_batches)[start:end]
-    ]
-    # Set the batch size for each local batch.
-    for i in range(chunk_size):
-        local_input_data[i][0].settings.batch_size = len(local_input_data[i][1]["seed"])
-        logger.info(
-            "Running batch %s with seeds %s.",
-            i + 1 + start,
-            local_input_data[i][1]["seed"],
+        scheduling = "static"
+    # Store the outputs of every trajectory in memory-mapped arrays created by
+    # rank 0, which the ranks write to once they are created.
+    if getattr(sim.settings, "trajectory_outputs", None):
+        if rank == 0:
+            TrajectoryStore.create(
+                sim.settings.trajectory_dir,
+                sim,
+                seeds,
+                sim.settings.trajectory_outputs,
+            )
+        comm.barrier()
+    # Write the output file from all ranks with parallel HDF5 if the outputs are
+    # reduced collectively, and otherwise stream the outputs merged on rank 0 to
+    # the output file.
+    parallel_output = False
+    if getattr(sim.settings, "output_file", None) is not None:
+        if reduction == "collective" and _parallel_hdf5_available():
+            _check_stream_settings(sim)
+            parallel_output = True
+        else:
+            if reduction == "collective":
+                logger.info(
+                    "h5py was built without MPI support; writing the output file "
+                    "from rank 0."
+                )
+            if rank == 0:
+                data.open_stream(sim.settings.output_file, sim)
+    if scheduling == "dynamic":
+        local_data = _run_dynamic(
+            sim, comm, rank, size, batch_seeds_list, data, reduction
         )
-    # Execute the local batches.
-    logger.info("Starting dynamics calculation.")
-    local_results = [dynamics.run_dynamics(*x) for x in local_input_data]
-    comm.Barrier()
-    logger.info("Dynamics calculation completed.")
-    # Collect results sequentially on rank 0.
-    tag_data, tag_done = 1, 2
-    if rank == 0:
-        logger.info("Collecting results from all tasks.")
-        for result in local_results:
-            data.add_data(result)
-        remaining = size - 1
-        status = MPI.Status()
-        while remaining:
-            msg = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-            if status.Get_tag() == tag_done:
-                remaining -= 1
-            else:
-                data.add_data(msg)
     else:
-        for result in local_results:
-            comm.send(result, dest=0, tag=tag_data)
-        comm.send(None, dest=0, tag=tag_done)
+        local_data = _run_static(
+            sim, comm, rank, size, batch_seeds_list, data, reduction
+        )
+    if parallel_output:
+        _write_parallel(comm, rank, local_data, data, sim.settings.output_file, seeds)
+    elif reduction == "collective":
+        _reduce_collective(comm, rank, local_data, data, seeds)
     logger.info("Simulation complete.")
-    # Collect logs from all ranks and attach combined output on root rank.
-    gathered_logs = comm.gather(get_log_output(), root=0)
+    # Attach the log of rank 0 and, if requested, gather the logs of the other
+    # ranks.
+    if getattr(sim.settings, "worker_logs", False):
+        gathered_logs = comm.gather(get_log_output(), root=0)
+        if rank == 0:
+            for n, log in enumerate(gathered_logs[1:], start=1):
+                if log:
+                    data.worker_logs[f"rank {n}"] = log
     if rank == 0:
-        data.log = "".join(log for log in gathered_logs if log)
+        data.log = get_log_output()
+        data.close_stream()
+        if parallel_output:
+            with h5py.File(sim.settings.output_file, "r+") as h5file:
+                h5file.attrs["log"] = data.log
     return data
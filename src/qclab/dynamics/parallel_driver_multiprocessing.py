@@ -2,18 +2,164 @@
 This module contains the parallel driver using the multiprocessing library.
 """
 
+import os
 import multiprocessing
+from multiprocessing import shared_memory
 import logging
 import copy
 import numpy as np
 import qclab.dynamics as dynamics
-from qclab.utils import get_log_output, reset_log_output
+from qclab.dynamics.worker_pool import WorkerPool, get_worker_lock
+from qclab.dynamics.memory_planner import plan_batch_size
+from qclab.dynamics.tuning_cache import apply_tuned_settings
+from qclab.utils import get_log_output, reset_log_output, SeedSummary
+from qclab.trajectory_store import TrajectoryStore
 from qclab import Data
 
 logger = logging.getLogger(__name__)
 
 
-def parallel_driver_multiprocessing(sim, seeds=None, data=None, num_tasks=None):
+def _probe_output_specs(sim, seeds):
+    """
+    Determines the shape and dtype of each output in the data dictionary by
+    executing the initialization and collect recipes for a single batch.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object with initialized timesteps.
+    seeds: ndarray
+        The seeds of the batch used for the probe.
+
+    .. rubric:: Returns
+    output_specs: dict
+        Dictionary mapping each output name to a tuple ``(shape, dtype)`` of its
+        array in the data dictionary.
+    """
+    probe_sim = copy.deepcopy(sim)
+    probe_sim.settings.batch_size = len(seeds)
+    probe_sim.t_ind = 0
+    state, parameters = {"seed": seeds}, {}
+    state, parameters = probe_sim.algorithm.execute_recipe(
+        probe_sim, state, parameters, probe_sim.algorithm.initialization_recipe
+    )
+    state, parameters = probe_sim.algorithm.execute_recipe(
+        probe_sim, state, parameters, probe_sim.algorithm.collect_recipe
+    )
+    num_collect = len(sim.settings.t_collect)
+    return {
+        key: ((num_collect, *np.shape(val)[1:]), np.asarray(val).dtype)
+        for key, val in state["output_dict"].items()
+    }
+
+
+def _run_dynamics_shared_memory(sim, state, parameters, data, buffer_specs):
+    """
+    Runs the dynamics core for a batch and adds its ``norm_factor``-weighted
+    outputs to the shared memory buffers described by ``buffer_specs``.
+
+    The outputs that were added to a buffer are removed from the returned data
+    object so that only the seeds, ``norm_factor`` and log are sent back to the
+    parent process. The ``norm_factor`` itself is added to the buffer named
+    "norm_factor" so that the buffers always hold a consistent partial sum.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object for the batch.
+    state: dict
+        The state object containing the batch seeds.
+    parameters: dict
+        The parameters object.
+    data: Data
+        The data object for the batch.
+    buffer_specs: dict
+        Dictionary mapping output names to tuples ``(name, shape, dtype)`` of the
+        shared memory blocks holding their weighted sums.
+
+    .. rubric:: Returns
+    data: Data
+        The data object of the batch without the outputs stored in shared memory.
+    """
+    data = dynamics.run_dynamics(sim, state, parameters, data)
+    norm_factor = data.data_dict["norm_factor"]
+    lock = get_worker_lock()
+    if lock is not None:
+        lock.acquire()
+    try:
+        for key, (name, shape, dtype) in buffer_specs.items():
+            if key == "norm_factor":
+                weighted_val = norm_factor
+            elif key in data.data_dict:
+                weighted_val = data.data_dict.pop(key) * norm_factor
+            else:
+                continue
+            shm = shared_memory.SharedMemory(name=name)
+            buffer = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            buffer += weighted_val
+            del buffer
+            shm.close()
+    finally:
+        if lock is not None:
+            lock.release()
+    return data
+
+
+def _read_shared_memory(new_data, buffers, output_specs, lock=None):
+    """
+    Sets the outputs of ``new_data`` to the weighted sums in the shared memory
+    buffers divided by the summed ``norm_factor`` in the buffers.
+
+    .. rubric:: Args
+    new_data: Data
+        The data object to set the outputs of.
+    buffers: dict
+        Dictionary mapping output names to their shared memory blocks, including
+        the block holding the summed ``norm_factor``.
+    output_specs: dict
+        Dictionary mapping output names to tuples ``(shape, dtype)``.
+    lock: multiprocessing.Lock, optional
+        The lock of the workers writing to the buffers, held while reading.
+    """
+    if lock is not None:
+        lock.acquire()
+    try:
+        norm_factor = np.ndarray((), dtype=float, buffer=buffers["norm_factor"].buf)
+        norm_factor = float(norm_factor)
+        for key, (shape, dtype) in output_specs.items():
+            buffer = np.ndarray(shape, dtype=dtype, buffer=buffers[key].buf)
+            if norm_factor > 0:
+                new_data.data_dict[key] = buffer / norm_factor
+            else:
+                new_data.data_dict[key] = np.zeros(shape, dtype=dtype)
+            del buffer
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def _run_batch_capturing_log(run_batch, sim, state, parameters, data, *args):
+    """
+    Runs ``run_batch`` for a batch in a worker process and stores the log output of
+    the worker for the batch in ``data.worker_logs``.
+    """
+    # Discard the log output of earlier batches and of the parent process, which
+    # is inherited by forked workers.
+    reset_log_output()
+    data = run_batch(sim, state, parameters, data, *args)
+    key = f"pid {os.getpid()}, seeds {SeedSummary(data.data_dict['seed'])}"
+    data.worker_logs[key] = get_log_output()
+    reset_log_output()
+    return data
+
+
+def parallel_driver_multiprocessing(
+    sim,
+    seeds=None,
+    data=None,
+    num_tasks=None,
+    pool=None,
+    use_shared_memory=False,
+    callback=None,
+):
     """
     Parallel driver for the dynamics core using the python library multiprocessing.
 
@@ -28,7 +174,20 @@ def parallel_driver_multiprocessing(sim, seeds=None, data=None, num_tasks=None):
         will be created.
     num_tasks: int, optional
         The number of tasks to use for parallel processing. If None, the
-        number of available tasks will be used.
+        number of available tasks will be used. Ignored if ``pool`` is provided.
+    pool: WorkerPool, optional
+        A persistent worker pool to run the batches on. If None, a temporary
+        pool with ``num_tasks`` workers is started and closed by the driver.
+    use_shared_memory: bool, default: False
+        If True, the workers add the ``norm_factor``-weighted outputs of each batch
+        directly into shared memory buffers instead of sending a Data object per
+        batch back to the parent process. The buffers are allocated from the
+        outputs of a probe that runs the initialization and collect recipes once.
+    callback: callable, optional
+        A function called as ``callback(new_data)`` each time a batch completes,
+        where ``new_data`` is a Data object holding the merged results of the
+        batches of this call that have completed so far. This can be used to
+        monitor the convergence of a simulation while it is running.
 
     .. rubric:: Returns
     data: Data
@@ -42,7 +201,7 @@ def parallel_driver_multiprocessing(sim, seeds=None, data=None, num_tasks=None):
         data = Data()
     if seeds is None:
         if len(data.data_dict["seed"]) > 0:
-            offset = np.max(data.data_dict["seed"]) + 1
+            offset = data.seed_runs.max() + 1
         else:
             offset = 0
         seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
@@ -54,11 +213,28 @@ def parallel_driver_multiprocessing(sim, seeds=None, data=None, num_tasks=None):
             num_trajs,
         )
         sim.settings.num_trajs = num_trajs
-    if num_tasks is None:
+    # Use the batch size and number of tasks stored by autotune.
+    if getattr(sim.settings, "autotune", False):
+        if pool is None:
+            num_tasks = apply_tuned_settings(sim, num_tasks=num_tasks)
+        else:
+            apply_tuned_settings(sim, num_tasks=pool.num_tasks)
+    if pool is not None:
+        if num_tasks is not None and num_tasks != pool.num_tasks:
+            logger.warning(
+                "Ignoring num_tasks=%s in favor of the %s tasks of the provided pool.",
+                num_tasks,
+                pool.num_tasks,
+            )
+        size = pool.num_tasks
+    elif num_tasks is None:
         size = multiprocessing.cpu_count()
     else:
         size = num_tasks
     logger.info("Using %s tasks for parallel processing.", size)
+    # Cap the batch size to fit the memory budget of each batch.
+    if getattr(sim.settings, "memory_budget", None) is not None:
+        sim.settings.batch_size = plan_batch_size(sim)
     # Determine the number of batches required to execute the total number
     # of trajectories.
     if num_trajs % sim.settings.batch_size == 0:
@@ -90,16 +266,78 @@ def parallel_driver_multiprocessing(sim, seeds=None, data=None, num_tasks=None):
         # Determine the batch size from the seeds in the state object.
         local_input_data[i][0].settings.batch_size = len(local_input_data[i][1]["seed"])
         logger.info(
-            "Running batch %s with seeds %s.", i + 1, local_input_data[i][1]["seed"]
+            "Running batch %s with seeds %s.",
+            i + 1,
+            SeedSummary(local_input_data[i][1]["seed"]),
         )
-    logger.info("Starting dynamics calculation.")
-    with multiprocessing.Pool(processes=size) as pool:
-        results = pool.starmap(dynamics.run_dynamics, local_input_data)
-    logger.info("Dynamics calculation completed.")
-    logger.info("Collecting results from all tasks.")
-    for result in results:
-        data.add_data(result)
+    # Store the outputs of every trajectory in memory-mapped arrays.
+    if getattr(sim.settings, "trajectory_outputs", None):
+        TrajectoryStore.create(
+            sim.settings.trajectory_dir, sim, seeds, sim.settings.trajectory_outputs
+        )
+    # Stream the outputs to the output file as the batches complete.
+    if getattr(sim.settings, "output_file", None) is not None:
+        data.open_stream(sim.settings.output_file, sim)
+    buffers = {}
+    try:
+        if use_shared_memory:
+            if getattr(sim.settings, "variance", False):
+                # The workers only add the means of the outputs to the buffers.
+                logger.error("Shared memory is not supported with the variance.")
+                raise ValueError("Shared memory is not supported with the variance.")
+            # Allocate a zeroed shared memory buffer for each output.
+            output_specs = _probe_output_specs(sim, local_input_data[0][1]["seed"])
+            buffer_specs = {}
+            output_specs_norm = {**output_specs, "norm_factor": ((), np.dtype(float))}
+            for key, (shape, dtype) in output_specs_norm.items():
+                nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+                buffers[key] = shared_memory.SharedMemory(create=True, size=nbytes)
+                np.ndarray(shape, dtype=dtype, buffer=buffers[key].buf)[...] = 0
+                buffer_specs[key] = (buffers[key].name, shape, dtype.str)
+                logger.info(
+                    "Allocated shared memory buffer for %s with shape %s.", key, shape
+                )
+            run_batch = _run_dynamics_shared_memory
+            local_input_data = [(*x, buffer_specs) for x in local_input_data]
+        else:
+            run_batch = dynamics.run_dynamics
+        if getattr(sim.settings, "worker_logs", False):
+            local_input_data = [(run_batch, *x) for x in local_input_data]
+            run_batch = _run_batch_capturing_log
+        logger.info("Starting dynamics calculation.")
+        local_pool = WorkerPool(num_tasks=size) if pool is None else pool
+        try:
+            # Merge the results as the batches complete so that only one result
+            # is held at a time.
+            new_data = Data()
+            if not use_shared_memory:
+                new_data.stream = data.stream
+            batch_seeds = [None] * num_batches
+            for n, result in local_pool.starmap_unordered(run_batch, local_input_data):
+                batch_seeds[n] = result.data_dict["seed"]
+                new_data.add_data(result)
+                if callback is not None:
+                    if use_shared_memory:
+                        _read_shared_memory(
+                            new_data, buffers, output_specs, local_pool.lock
+                        )
+                    callback(new_data)
+        finally:
+            if pool is None:
+                local_pool.close()
+        logger.info("Dynamics calculation completed.")
+        logger.info("Collecting results from all tasks.")
+        if use_shared_memory:
+            _read_shared_memory(new_data, buffers, output_specs)
+        # Restore the order of the seeds, which were merged in order of completion.
+        new_data.data_dict["seed"] = np.concatenate(batch_seeds)
+        data.add_data(new_data)
+    finally:
+        for shm in buffers.values():
+            shm.close()
+            shm.unlink()
     logger.info("Simulation complete.")
     # Attach collected log output.
     data.log = get_log_output()
+    data.close_stream()
     return data
@@ -0,0 +1,181 @@
+"""
+This module contains the parallel driver using a pool of threads.
+"""
+
+import multiprocessing
+import threading
+import functools
+import logging
+import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import qclab.dynamics as dynamics
+from qclab.dynamics.memory_planner import plan_batch_size
+from qclab.dynamics.tuning_cache import apply_tuned_settings
+from qclab.utils import get_log_output, reset_log_output, SeedSummary
+from qclab.trajectory_store import TrajectoryStore
+from qclab import Data, functions
+
+logger = logging.getLogger(__name__)
+
+# Lock serializing the initialization recipes, which seed numpy's global
+# random number generator.
+_initialization_lock = threading.Lock()
+
+
+def _execute_recipe_locked(sim, state, parameters, recipe):
+    """
+    Executes ``recipe`` while holding the initialization lock.
+    """
+    with _initialization_lock:
+        return sim.algorithm.execute_recipe(sim, state, parameters, recipe)
+
+
+def _batch_sim(sim, batch_size):
+    """
+    Returns a shallow copy of ``sim`` for a batch of ``batch_size`` trajectories.
+
+    The settings are copied so that each batch can set its own batch size and time
+    index, while the model and its constants are shared between the batches. The
+    initialization recipe of the copied algorithm is executed under the
+    initialization lock.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object with initialized timesteps and model constants.
+    batch_size: int
+        The number of trajectories in the batch.
+
+    .. rubric:: Returns
+    batch_sim: Simulation
+        The simulation object for the batch.
+    """
+    batch_sim = copy.copy(sim)
+    batch_sim.settings = copy.copy(sim.settings)
+    batch_sim.settings.batch_size = batch_size
+    batch_sim.algorithm = copy.copy(sim.algorithm)
+    batch_sim.algorithm.initialization_recipe = [
+        functools.partial(
+            _execute_recipe_locked, recipe=sim.algorithm.initialization_recipe
+        )
+    ]
+    return batch_sim
+
+
+def parallel_driver_threads(sim, seeds=None, data=None, num_tasks=None):
+    """
+    Parallel driver for the dynamics core using a pool of threads.
+
+    The batches run concurrently in a single process and share the model and its
+    constants, which avoids copying and pickling the simulation for each batch.
+    Concurrency relies on the numba kernels and the numpy linear algebra routines
+    releasing the global interpreter lock, so the speedup depends on the fraction
+    of time the algorithm spends in them.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, initial state, and settings.
+    seeds: ndarray, optional
+        An array of integer seeds for the trajectories. If None, seeds will be
+        generated automatically.
+    data: Data, optional
+        A Data object for collecting output data. If None, a new Data object
+        will be created.
+    num_tasks: int, optional
+        The number of threads to use for parallel processing. If None, the
+        number of available CPU cores will be used.
+
+    .. rubric:: Returns
+    data: Data
+        The updated Data object containing collected output data.
+    """
+    # Clear any in-memory log output from previous runs.
+    reset_log_output()
+    # First initialize the model constants.
+    sim.model.initialize_constants()
+    if data is None:
+        data = Data()
+    if seeds is None:
+        if len(data.data_dict["seed"]) > 0:
+            offset = data.seed_runs.max() + 1
+        else:
+            offset = 0
+        seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
+        num_trajs = sim.settings.num_trajs
+    else:
+        num_trajs = len(seeds)
+        logger.warning(
+            "Setting sim.settings.num_trajs to the number of provided seeds: %s",
+            num_trajs,
+        )
+        sim.settings.num_trajs = num_trajs
+    if num_tasks is None:
+        size = multiprocessing.cpu_count()
+    else:
+        size = num_tasks
+    logger.info("Using %s threads for parallel processing.", size)
+    # Use the batch size stored by autotune.
+    if getattr(sim.settings, "autotune", False):
+        apply_tuned_settings(sim, num_tasks=size)
+    # Cap the batch size to fit the memory budget of each batch.
+    if getattr(sim.settings, "memory_budget", None) is not None:
+        sim.settings.batch_size = plan_batch_size(sim)
+    # Determine the number of batches required to execute the total number
+    # of trajectories.
+    if num_trajs % sim.settings.batch_size == 0:
+        num_batches = num_trajs // sim.settings.batch_size
+    else:
+        num_batches = num_trajs // sim.settings.batch_size + 1
+    logger.info(
+        "Running %s batches with %s seeds in each batch.",
+        num_batches,
+        sim.settings.batch_size,
+    )
+    batch_seeds_list = [
+        seeds[n * sim.settings.batch_size : (n + 1) * sim.settings.batch_size]
+        for n in range(num_batches)
+    ]
+    # Create the input data for each local simulation.
+    sim.initialize_timesteps()
+    local_input_data = []
+    for n, batch_seeds in enumerate(batch_seeds_list):
+        logger.info("Running batch %s with seeds %s.", n + 1, SeedSummary(batch_seeds))
+        local_input_data.append(
+            (
+                _batch_sim(sim, len(batch_seeds)),
+                {"seed": batch_seeds},
+                {},
+                Data(batch_seeds),
+            )
+        )
+    # Compile the jit functions before the threads start using them.
+    functions.warm_up_jit_functions()
+    # Store the outputs of every trajectory in memory-mapped arrays.
+    if getattr(sim.settings, "trajectory_outputs", None):
+        TrajectoryStore.create(
+            sim.settings.trajectory_dir, sim, seeds, sim.settings.trajectory_outputs
+        )
+    # Stream the outputs to the output file as the batches complete.
+    if getattr(sim.settings, "output_file", None) is not None:
+        data.open_stream(sim.settings.output_file, sim)
+    logger.info("Starting dynamics calculation.")
+    new_data = Data()
+    new_data.stream = data.stream
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = [
+            executor.submit(dynamics.run_dynamics, *input_data)
+            for input_data in local_input_data
+        ]
+        # Merge the results as the batches complete.
+        for future in as_completed(futures):
+            new_data.add_data(future.result())
+    logger.info("Dynamics calculation completed.")
+    logger.info("Collecting results from all tasks.")
+    # Restore the order of the seeds, which were merged in order of completion.
+    new_data.data_dict["seed"] = np.concatenate(batch_seeds_list)
+    data.add_data(new_data)
+    logger.info("Simulation complete.")
+    # Attach collected log output.
+    data.log = get_log_output()
+    data.close_stream()
+    return data
@@ -5,7 +5,10 @@ This module contains the serial driver.
 import logging
 import numpy as np
 import qclab.dynamics as dynamics
-from qclab.utils import get_log_output, reset_log_output
+from qclab.dynamics.memory_planner import plan_batch_size
+from qclab.dynamics.tuning_cache import apply_tuned_settings
+from qclab.utils import get_log_output, reset_log_output, SeedSummary
+from qclab.trajectory_store import TrajectoryStore
 from qclab import Data
 
 logger = logging.getLogger(__name__)
@@ -37,7 +40,7 @@ def serial_driver(sim, seeds=None, data=None):
         data = Data()
     if seeds is None:
         if len(data.data_dict["seed"]) > 0:
-            offset = np.max(data.data_dict["seed"]) + 1
+            offset = data.seed_runs.max() + 1
         else:
             offset = 0
         seeds = offset + np.arange(sim.settings.num_trajs, dtype=int)
@@ -49,12 +52,28 @@ def serial_driver(sim, seeds=None, data=None):
             num_trajs,
         )
         sim.settings.num_trajs = num_trajs
+    # Use the batch size stored by autotune.
+    if getattr(sim.settings, "autotune", False):
+        apply_tuned_settings(sim, num_tasks=1)
+    # Cap the batch size to fit the memory budget of each batch.
+    if getattr(sim.settings, "memory_budget", None) is not None:
+        sim.settings.batch_size = plan_batch_size(sim)
     # Determine the number of batches required to execute the total number
     # of trajectories.
     if num_trajs % sim.settings.batch_size == 0:
         num_batches = num_trajs // sim.settings.batch_size
     else:
         num_batches = int(num_trajs / sim.settings.batch_size) + 1
+    # Stream the outputs to the output file.
+    if getattr(sim.settings, "output_file", None) is not None:
+        sim.initialize_timesteps()
+        data.open_stream(sim.settings.output_file, sim)
+    # Store the outputs of every trajectory in memory-mapped arrays.
+    if getattr(sim.settings, "trajectory_outputs", None):
+        sim.initialize_timesteps()
+        TrajectoryStore.create(
+            sim.settings.trajectory_dir, sim, seeds, sim.settings.trajectory_outputs
+        )
 
     logger.info(
         "Running %s batches with %s seeds in each batch.",
@@ -67,12 +86,13 @@ def serial_driver(sim, seeds=None, data=None):
         ]
         if len(batch_seeds) == 0:
             break
-        logger.info("Running batch %s with seeds %s.", n + 1, batch_seeds)
+        logger.info("Running batch %s with seeds %s.", n + 1, SeedSummary(batch_seeds))
         sim.settings.batch_size = len(batch_seeds)
         sim.initialize_timesteps()
         parameters = {}
         state = {"seed": batch_seeds}
         new_data = Data(batch_seeds)
+        new_data.stream = data.stream
         logger.info("Starting dynamics calculation.")
         new_data = dynamics.run_dynamics(sim, state, parameters, new_data)
         logger.info("Dynamics calculation completed.")
@@ -81,4 +101,5 @@ def serial_driver(sim, seeds=None, data=None):
     logger.info("Simulation complete.")
     # Attach the collected log output to the data object before returning.
     data.log = get_log_output()
+    data.close_stream()
     return data
@@ -0,0 +1,216 @@
+"""
+This module contains the local cache of the batch sizes and worker counts chosen
+by ``autotune``.
+"""
+
+import os
+import json
+import socket
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_file():
+    """
+    Returns the default file of the autotune cache, ``qclab/autotune.json`` in the
+    directory given by the environment variable ``XDG_CACHE_HOME`` or in
+    ``~/.cache``.
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_dir, "qclab", "autotune.json")
+
+
+def _scalar_items(constants, keys):
+    """
+    Returns a dictionary of the entries of ``constants`` named in ``keys`` that
+    hold strings, numbers or booleans.
+    """
+    items = {}
+    for key in sorted(keys):
+        val = constants.get(key)
+        if isinstance(val, np.generic):
+            val = val.item()
+        if val is None or isinstance(val, (str, int, float, bool)):
+            items[key] = val
+    return items
+
+
+def simulation_signature(sim):
+    """
+    Returns the signature identifying the configurations of ``sim`` that share the
+    same tuned batch size and worker count.
+
+    The signature consists of the classes of the model and algorithm, the model
+    constants and algorithm settings that are strings, numbers or booleans, the
+    number of quantum states and classical coordinates, and the host name and
+    number of CPU cores of the machine.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model and algorithm.
+
+    .. rubric:: Returns
+    signature: dict
+        The signature of the simulation.
+    """
+    model_keys = getattr(sim.model, "default_constants", {}).keys()
+    return {
+        "model": type(sim.model).__name__,
+        "model_constants": _scalar_items(sim.model.constants, model_keys),
+        "num_quantum_states": int(sim.model.constants.num_quantum_states),
+        "num_classical_coordinates": int(sim.model.constants.num_classical_coordinates),
+        "algorithm": type(sim.algorithm).__name__,
+        "algorithm_settings": _scalar_items(
+            sim.algorithm.settings,
+            [key for key in vars(sim.algorithm.settings) if not key.startswith("_")],
+        ),
+        "host": socket.gethostname(),
+        "cpu_count": multiprocessing.cpu_count(),
+    }
+
+
+def _signature_key(signature):
+    """
+    Returns the key of a signature in the cache.
+    """
+    return hashlib.sha1(
+        json.dumps(signature, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def load_cache(cache_file=None):
+    """
+    Returns the contents of the autotune cache, or an empty dictionary if the cache
+    does not exist or cannot be read.
+
+    .. rubric:: Args
+    cache_file: str, optional
+        The cache file. If None, ``default_cache_file()`` is used.
+
+    .. rubric:: Returns
+    cache: dict
+        Dictionary mapping the key of each signature to its cache entry.
+    """
+    if cache_file is None:
+        cache_file = default_cache_file()
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable autotune cache %s.", cache_file)
+        return {}
+
+
+def save_to_cache(sim, entry, cache_file=None):
+    """
+    Stores ``entry`` as the cache entry of the signature of ``sim``.
+
+    The cache is first written to a temporary file which then replaces the previous
+    cache, so that concurrent jobs do not leave a partially written cache behind.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model and algorithm.
+    entry: dict
+        The cache entry, as produced by ``autotune``.
+    cache_file: str, optional
+        The cache file. If None, ``default_cache_file()`` is used.
+    """
+    if cache_file is None:
+        cache_file = default_cache_file()
+    signature = simulation_signature(sim)
+    cache = load_cache(cache_file)
+    cache[_signature_key(signature)] = {"signature": signature, **entry}
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_file, cache_file)
+    logger.info("Saved autotuned configuration to %s.", cache_file)
+
+
+def get_tuned_settings(sim, num_tasks=None, cache_file=None):
+    """
+    Returns the batch size and number of tasks stored by ``autotune`` for the
+    signature of ``sim``.
+
+    If ``num_tasks`` is given, the batch size with the highest throughput measured
+    with that number of tasks is returned, or the overall best batch size if no
+    probe was run with that number of tasks.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model and algorithm.
+    num_tasks: int, optional
+        The number of tasks that the simulation will be run with.
+    cache_file: str, optional
+        The cache file. If None, ``default_cache_file()`` is used.
+
+    .. rubric:: Returns
+    tuned_settings: dict | None
+        Dictionary with the tuned "batch_size" and "num_tasks", or None if the
+        signature of ``sim`` is not in the cache.
+    """
+    entry = load_cache(cache_file).get(_signature_key(simulation_signature(sim)))
+    if entry is None:
+        return None
+    tuned_settings = {
+        "batch_size": entry["batch_size"],
+        "num_tasks": entry["num_tasks"],
+    }
+    if num_tasks is not None:
+        results = [
+            result for result in entry["results"] if result["num_tasks"] == num_tasks
+        ]
+        if results:
+            best = max(results, key=lambda result: result["throughput"])
+            tuned_settings["batch_size"] = best["batch_size"]
+        tuned_settings["num_tasks"] = num_tasks
+    return tuned_settings
+
+
+def apply_tuned_settings(sim, num_tasks=None):
+    """
+    Sets ``sim.settings.batch_size`` to the batch size stored by ``autotune`` for
+    the signature of ``sim`` in the cache file ``sim.settings.autotune_cache``, or
+    in ``default_cache_file()`` if it is None, and returns the tuned number of
+    tasks. Used by the drivers if ``sim.settings.autotune`` is True.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+    num_tasks: int, optional
+        The number of tasks that the simulation will be run with, if fixed.
+
+    .. rubric:: Returns
+    num_tasks: int | None
+        The tuned number of tasks, or ``num_tasks`` if the signature of ``sim``
+        is not in the cache.
+    """
+    cache_file = getattr(sim.settings, "autotune_cache", None)
+    tuned_settings = get_tuned_settings(sim, num_tasks=num_tasks, cache_file=cache_file)
+    if tuned_settings is None:
+        logger.warning(
+            "No autotuned configuration found for %s with %s in %s; keeping "
+            "batch_size=%s. Run qclab.dynamics.autotune to tune it.",
+            type(sim.model).__name__,
+            type(sim.algorithm).__name__,
+            cache_file or default_cache_file(),
+            sim.settings.batch_size,
+        )
+        return num_tasks
+    logger.info(
+        "Using the autotuned batch_size=%s and num_tasks=%s.",
+        tuned_settings["batch_size"],
+        tuned_settings["num_tasks"],
+    )
+    sim.settings.batch_size = tuned_settings["batch_size"]
+    return tuned_settings["num_tasks"]
@@ -0,0 +1,162 @@
+"""
+This module contains the WorkerPool class used by the multiprocessing driver.
+"""
+
+import multiprocessing
+import logging
+from qclab import functions
+
+logger = logging.getLogger(__name__)
+
+# Lock shared by the worker processes of a pool, set by _initialize_worker.
+_worker_lock = None
+
+
+def _initialize_worker(lock):
+    """
+    Initializes a worker process by storing the lock shared by the workers of the
+    pool and compiling the jit functions of the dynamics core.
+    """
+    global _worker_lock
+    _worker_lock = lock
+    functions.warm_up_jit_functions()
+
+
+def _indexed_starcall(indexed_args):
+    """
+    Calls ``func(*args)`` for a tuple ``(index, func, args)`` and returns the index
+    along with the result.
+    """
+    index, func, args = indexed_args
+    return index, func(*args)
+
+
+def get_worker_lock():
+    """
+    Returns the lock shared by the worker processes of the pool that the calling
+    process belongs to, or None if it is not a pool worker.
+    """
+    return _worker_lock
+
+
+class WorkerPool:
+    """
+    Persistent pool of worker processes for ``parallel_driver_multiprocessing``.
+
+    Starting a ``multiprocessing.Pool`` requires each worker to import QC Lab and
+    compile its numba kernels. A ``WorkerPool`` pays this cost once and keeps the
+    workers alive so that it can be passed to any number of driver calls, for
+    example when sweeping over model constants:
+
+    .. code-block:: python
+
+        with WorkerPool(num_tasks=4) as pool:
+            for l_reorg in l_reorg_list:
+                sim.model.constants.l_reorg = l_reorg
+                data = parallel_driver_multiprocessing(sim, pool=pool)
+
+    The workers are started on entering the context (or on calling ``start``) and
+    terminated on leaving it (or on calling ``close``).
+
+    .. rubric:: Args
+    num_tasks: int, optional
+        The number of worker processes. If None, the number of available CPU cores
+        will be used.
+    """
+
+    def __init__(self, num_tasks=None):
+        if num_tasks is None:
+            num_tasks = multiprocessing.cpu_count()
+        self.num_tasks = num_tasks
+        self._pool = None
+        self._lock = None
+
+    def start(self):
+        """
+        Starts the worker processes if they are not already running.
+
+        The jit functions are compiled in the parent process first so that
+        workers created by forking inherit the compiled code.
+
+        .. rubric:: Returns
+        pool: WorkerPool
+            The started worker pool.
+        """
+        if self._pool is None:
+            functions.warm_up_jit_functions()
+            logger.info("Starting worker pool with %s tasks.", self.num_tasks)
+            self._lock = multiprocessing.Lock()
+            self._pool = multiprocessing.Pool(
+                processes=self.num_tasks,
+                initializer=_initialize_worker,
+                initargs=(self._lock,),
+            )
+        return self
+
+    def close(self):
+        """
+        Terminates the worker processes.
+        """
+        if self._pool is not None:
+            logger.info("Closing worker pool.")
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._lock = None
+
+    @property
+    def lock(self):
+        """
+        The lock shared by the worker processes, or None if the pool is not running.
+        """
+        return self._lock
+
+    @property
+    def running(self):
+        """
+        Whether the worker processes are running.
+        """
+        return self._pool is not None
+
+    def starmap(self, func, iterable):
+        """
+        Applies ``func`` to each tuple of arguments in ``iterable`` using the workers.
+
+        .. rubric:: Args
+        func: callable
+            The function to apply.
+        iterable: iterable
+            An iterable of argument tuples.
+
+        .. rubric:: Returns
+        results: list
+            The results in the order of ``iterable``.
+        """
+        return self.start()._pool.starmap(func, iterable)
+
+    def starmap_unordered(self, func, iterable):
+        """
+        Applies ``func`` to each tuple of arguments in ``iterable`` using the workers
+        and yields the results as they complete.
+
+        .. rubric:: Args
+        func: callable
+            The function to apply.
+        iterable: iterable
+            An iterable of argument tuples.
+
+        .. rubric:: Returns
+        results: generator
+            A generator of tuples ``(index, result)`` in the order of completion,
+            where ``index`` is the position of the arguments in ``iterable``.
+        """
+        return self.start()._pool.imap_unordered(
+            _indexed_starcall,
+            ((index, func, args) for index, args in enumerate(iterable)),
+        )
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -102,7 +102,7 @@ def transform_mat(mat, basis, adb_to_db=False):
     return out
 
 
-@njit
+@njit(nogil=True)
 def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_update):
     """
     Low-level function to calculate the intermediate z coordinate and k values
@@ -134,7 +134,7 @@ def update_z_rk4_k123_sum(z_k, classical_force, quantum_classical_force, dt_upda
     return out, k
 
 
-@njit
+@njit(nogil=True)
 def update_z_rk4_k4_sum(
     z_0, k1, k2, k3, classical_force, quantum_classical_force, dt_update
 ):
@@ -172,7 +172,7 @@ def update_z_rk4_k4_sum(
     return z_0
 
 
-@njit
+@njit(nogil=True)
 def dqdp_to_dzc(dq, dp, m, h):
     """
     Convert derivatives w.r.t. q and p (``dq`` and ``dp``, respectively) to
@@ -203,7 +203,7 @@ def dqdp_to_dzc(dq, dp, m, h):
     raise ValueError("At least one of dq or dp must be provided.")
 
 
-@njit
+@njit(nogil=True)
 def dzdzc_to_dqdp(dz, dzc, m, h):
     """
     Convert derivatives w.r.t. z and zc (``dz`` and ``dzc``) to derivatives w.r.t.
@@ -243,7 +243,7 @@ def dzdzc_to_dqdp(dz, dzc, m, h):
     raise ValueError("At least one of dz or dzc must be provided.")
 
 
-@njit
+@njit(nogil=True)
 def z_to_q(z, m, h):
     """
     Convert complex coordinates to position coordinate.
@@ -263,7 +263,7 @@ def z_to_q(z, m, h):
     return np.sqrt(2.0 / (m * h)) * z.real
 
 
-@njit
+@njit(nogil=True)
 def z_to_p(z, m, h):
     """
     Convert complex coordinates to momentum coordinate.
@@ -283,7 +283,7 @@ def z_to_p(z, m, h):
     return np.sqrt(2.0 * m * h) * z.imag
 
 
-@njit
+@njit(nogil=True)
 def qp_to_z(q, p, m, h):
     """
     Convert real coordinates to complex coordinates.
@@ -380,7 +380,7 @@ def vectorize_ingredient(ingredient):
     return vectorized_ingredient
 
 
-@njit
+@njit(nogil=True)
 def dh_c_dzc_harmonic_jit(z, h, w):
     """
     Derivative of the harmonic oscillator classical Hamiltonian function with respect to
@@ -411,7 +411,7 @@ def dh_c_dzc_harmonic_jit(z, h, w):
     return out
 
 
-@njit
+@njit(nogil=True)
 def h_qc_diagonal_linear_jit(z, gamma):
     """
     Low-level function to generate the diagonal linear quantum-classical Hamiltonian.
@@ -441,6 +441,118 @@ def h_qc_diagonal_linear_jit(z, gamma):
     return h_qc
 
 
+@njit(nogil=True)
+def update_mean_field_harmonic_diagonal_linear_jit(
+    z, wf_db, h_q, gamma, h, w, dt_update, h_qc, h_q_tot, classical_force, qc_force
+):
+    """
+    Low-level function to carry out a full mean-field time step for a harmonic
+    classical Hamiltonian with a diagonal linear quantum-classical coupling.
+
+    Evolves the classical coordinates and the diabatic wavefunction with the RK4
+    method in the same order of operations as the generic mean-field update recipe,
+    and then updates the quantum-classical and total quantum Hamiltonians. All
+    arrays except ``h_q``, ``gamma``, ``h`` and ``w`` are updated in place.
+
+    .. rubric:: Args
+    z : ndarray
+        Complex coordinates.
+    wf_db : ndarray
+        Diabatic wavefunction.
+    h_q : ndarray
+        Quantum Hamiltonian.
+    gamma : ndarray
+        Classical coordinate coupling strengths.
+    h : ndarray
+        Classical coordinate weight.
+    w : ndarray
+        Harmonic frequency.
+    dt_update : float
+        Time step for the update.
+    h_qc : ndarray
+        Quantum-classical Hamiltonian.
+    h_q_tot : ndarray
+        Total quantum Hamiltonian at the start of the time step.
+    classical_force : ndarray
+        Classical force, set to its value at the final RK4 stage.
+    qc_force : ndarray
+        Quantum-classical force, set to its value at the start of the time step.
+    """
+    batch_size, num_classical_coordinates = z.shape
+    num_sites = gamma.shape[0]
+    w2_over_h = (w**2) / h
+    dt_half = 0.5 * dt_update
+    z_k = np.empty(num_classical_coordinates, dtype=np.complex128)
+    k_sum = np.empty(num_classical_coordinates, dtype=np.complex128)
+    wf_k = np.empty(num_sites, dtype=np.complex128)
+    wf_0 = np.empty(num_sites, dtype=np.complex128)
+    wf_in = np.empty(num_sites, dtype=np.complex128)
+    for b in range(batch_size):
+        # The quantum-classical force is constant during the RK4 steps because
+        # the wavefunction and the coupling do not change.
+        for j in range(num_classical_coordinates):
+            qc_force[b, j] = 0.0j
+        for i in range(num_sites):
+            wf_i = wf_db[b, i]
+            for j in range(num_classical_coordinates):
+                if gamma[i, j] != 0:
+                    qc_force[b, j] += wf_i.conjugate() * gamma[i, j] * wf_i
+        # RK4 integration of the classical coordinates.
+        for j in range(num_classical_coordinates):
+            zij = z[b, j]
+            force = complex(w2_over_h[j] * zij.real, h[j] * zij.imag)
+            k = -1j * (force + qc_force[b, j])
+            k_sum[j] = k
+            z_k[j] = zij + dt_half * k
+        for j in range(num_classical_coordinates):
+            zij = z_k[j]
+            force = complex(w2_over_h[j] * zij.real, h[j] * zij.imag)
+            k = -1j * (force + qc_force[b, j])
+            k_sum[j] += 2.0 * k
+            z_k[j] = z[b, j] + dt_half * k
+        for j in range(num_classical_coordinates):
+            zij = z_k[j]
+            force = complex(w2_over_h[j] * zij.real, h[j] * zij.imag)
+            k = -1j * (force + qc_force[b, j])
+            k_sum[j] += 2.0 * k
+            z_k[j] = z[b, j] + dt_update * k
+        for j in range(num_classical_coordinates):
+            zij = z_k[j]
+            classical_force[b, j] = complex(w2_over_h[j] * zij.real, h[j] * zij.imag)
+            z[b, j] = z[b, j] + (dt_update / 6.0) * (
+                k_sum[j] - 1j * (classical_force[b, j] + qc_force[b, j])
+            )
+        # RK4 integration of the wavefunction.
+        for i in range(num_sites):
+            wf_0[i] = wf_db[b, i]
+            wf_in[i] = wf_db[b, i]
+        for stage in range(4):
+            for i in range(num_sites):
+                acc = 0.0j
+                for n in range(num_sites):
+                    acc += h_q_tot[b, i, n] * wf_in[n]
+                wf_k[i] = -1j * acc
+            for i in range(num_sites):
+                if stage < 2:
+                    wf_in[i] = wf_0[i] + 0.5 * dt_update * wf_k[i]
+                else:
+                    wf_in[i] = wf_0[i] + dt_update * wf_k[i]
+                if stage == 0 or stage == 3:
+                    wf_db[b, i] += dt_update * 0.16666666666666666 * wf_k[i]
+                else:
+                    wf_db[b, i] += dt_update * 0.3333333333333333 * wf_k[i]
+        # Update the quantum-classical and total quantum Hamiltonians.
+        for i in range(num_sites):
+            acc_re = 0.0
+            for j in range(num_classical_coordinates):
+                acc_re += gamma[i, j] * 2.0 * z[b, j].real
+            for n in range(num_sites):
+                h_qc[b, i, n] = 0.0j
+                h_q_tot[b, i, n] = h_q[b, i, n]
+            h_qc[b, i, i] = acc_re
+            h_q_tot[b, i, i] = h_q[b, i, i] + acc_re
+
+
 def gen_sample_gaussian(constants, z_initial=None, seed=None, separable=True):
     """
     Generates a complex number sampled from a Gaussian distribution.
@@ -496,7 +608,7 @@ def gen_sample_gaussian(constants, z_initial=None, seed=None, separable=True):
     return z, rand
 
 
-@njit
+@njit(nogil=True)
 def calc_sparse_inner_product(inds, mels, shape, vec_l_conj, vec_r, out=None):
     """
     Take a sparse gradient matrix with shape ``(batch_size, num_classical_coordinates,
@@ -828,3 +940,42 @@ def numerical_fssh_hop(model, parameters, **kwargs):
     if min_energy > thresh:
         return np.zeros_like(z), False
     return -1j * min_gamma * resc_dir_z, True
+
+
+def warm_up_jit_functions():
+    """
+    Compiles the jit-compiled functions used in the dynamics core by calling them
+    once on small arrays with the argument types used by the tasks and ingredients.
+
+    This moves the one-time numba compilation cost out of the first batch of a
+    simulation. It is called by ``qclab.dynamics.WorkerPool`` when its worker
+    processes start and is a cheap no-op once the functions have been compiled.
+    """
+    z = np.zeros((1, 1), dtype=np.complex128)
+    vec = np.zeros((1, 1), dtype=np.complex128)
+    mass = np.ones((1, 1))
+    weight = np.ones(1)
+    update_z_rk4_k123_sum(z, z, z, 0.0)
+    update_z_rk4_k4_sum(np.copy(z), z, z, z, z, z, 0.0)
+    dh_c_dzc_harmonic_jit(z, weight, weight)
+    h_qc_diagonal_linear_jit(z, np.zeros((1, 1)))
+    z_to_q(z, mass, mass)
+    z_to_p(z, mass, mass)
+    qp_to_z(weight, weight, weight, weight)
+    dzdzc_to_dqdp(z, z, mass, mass)
+    dqdp_to_dzc(weight, None, weight, weight)
+    dqdp_to_dzc(weight.astype(np.complex128), None, weight, weight)
+    # Sparse indices are contiguous when obtained from np.where and
+    # non-contiguous when sliced from a larger index array.
+    inds_contiguous = np.where(np.ones((1, 1, 1, 1)) != 0)
+    inds_strided = tuple(np.zeros((4, 4), dtype=np.int64)[:, ::2])
+    for inds in (inds_contiguous, inds_strided):
+        calc_sparse_inner_product(
+            inds,
+            np.ones(len(inds[0]), dtype=np.complex128),
+            (1, 1, 1, 1),
+            vec,
+            vec,
+            out=np.zeros(1, dtype=np.complex128),
+        )
+    logger.info("Compiled jit functions.")
@@ -0,0 +1,210 @@
+"""
+This module contains the lazy loading of saved data objects, whose outputs are
+read from disk on demand, and the out-of-core merging of saved data objects.
+"""
+
+import struct
+import logging
+import zipfile
+import numpy as np
+from qclab.utils import DISABLE_H5PY, SeedRuns
+from qclab.streaming import STAGED_GROUP
+
+if not DISABLE_H5PY:
+    import h5py
+
+logger = logging.getLogger(__name__)
+
+
+class LazyDataset:
+    """
+    Read-only proxy of a dataset in an HDF5 file that reads the requested slices
+    from the file on demand, for example ``dataset[100:200]`` for a time window.
+
+    The file is opened for each read, so the proxy holds no open file handle and
+    can be pickled. ``np.asarray(dataset)`` reads the whole dataset.
+
+    .. rubric:: Args
+    filename: str
+        The file name of the HDF5 file.
+    path: str
+        The path of the dataset in the file.
+    shape: tuple
+        The shape of the dataset.
+    dtype: np.dtype
+        The dtype of the dataset.
+    """
+
+    def __init__(self, filename, path, shape, dtype):
+        self.filename = filename
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def ndim(self):
+        """
+        The number of dimensions of the dataset.
+        """
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        with h5py.File(self.filename, "r") as h5file:
+            return h5file[self.path][index]
+
+    def __array__(self, dtype=None, copy=None):
+        val = self[()]
+        if dtype is not None:
+            val = val.astype(dtype)
+        return val
+
+    def __repr__(self):
+        return (
+            f"LazyDataset({self.filename!r}, {self.path!r}, shape={self.shape}, "
+            f"dtype={self.dtype})"
+        )
+
+
+def _load_h5py_lazy(h5file, filename, path, data_dict):
+    """
+    Recursively fills ``data_dict`` with ``LazyDataset`` proxies of the datasets
+    in the group ``path`` of ``h5file``. Scalars and seeds are read directly, and
+    the rows staged by an output stream for a batch that was not completed are
+    skipped.
+    """
+    for key, item in h5file[path].items():
+        if path + key == "/" + STAGED_GROUP:
+            continue
+        if isinstance(item, h5py.Group):
+            data_dict[key] = {}
+            _load_h5py_lazy(h5file, filename, path + key + "/", data_dict[key])
+        elif item.ndim == 0 or path + key == "/seed":
+            data_dict[key] = item[()]
+        else:
+            data_dict[key] = LazyDataset(filename, path + key, item.shape, item.dtype)
+
+
+def _npz_member(archive, f, info):
+    """
+    Returns the array stored in the member ``info`` of the npz archive ``archive``
+    memory-mapped from the open file ``f``, or read into memory if it cannot be
+    memory-mapped because it is compressed, a scalar or an array of objects.
+    """
+    if info.compress_type == zipfile.ZIP_STORED:
+        # Skip the local file header of the member to reach the npy file.
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if len(shape) > 0 and not dtype.hasobject:
+            return np.memmap(
+                f.name,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    with archive.open(info) as member:
+        return np.lib.format.read_array(member, allow_pickle=True)
+
+
+def load_lazy(filename, disable_h5py=DISABLE_H5PY):
+    """
+    Returns the data dictionary and log saved with ``Data.save`` in ``filename``
+    without reading the outputs into memory.
+
+    Outputs in an HDF5 file are returned as ``LazyDataset`` proxies and outputs in
+    an npz file as read-only ``np.memmap`` arrays, so that only the slices that
+    are accessed are read. The seeds and scalars such as ``norm_factor`` are read
+    directly.
+
+    .. rubric:: Args
+    filename: str
+        The file name to load the data from.
+    disable_h5py: bool, default: qclab.utils.DISABLE_H5PY
+        If True, the file is read as an npz file.
+
+    .. rubric:: Returns
+    data_dict: dict
+        The data dictionary.
+    log: str
+        The saved log.
+    """
+    data_dict = {}
+    if disable_h5py:
+        with zipfile.ZipFile(filename) as archive, open(filename, "rb") as f:
+            for info in archive.infolist():
+                key = info.filename[: -len(".npy")]
+                data_dict[key] = _npz_member(archive, f, info)
+        log = str(data_dict.pop("log", ""))
+    else:
+        with h5py.File(filename, "r") as h5file:
+            _load_h5py_lazy(h5file, filename, "/", data_dict)
+            log = h5file.attrs["log"]
+    data_dict["seed"] = np.array(data_dict.get("seed", []), dtype=int).reshape(-1)
+    return data_dict, log
+
+
+def merge_files(filenames, output_filename, disable_h5py=DISABLE_H5PY):
+    """
+    Merges the data objects saved in ``filenames`` into the HDF5 file
+    ``output_filename`` without loading their outputs into memory.
+
+    The files are loaded lazily and added to the output file with a
+    ``StreamWriter``, which merges each output as a ``norm_factor``-weighted
+    average one chunk of collect times at a time, so that only a chunk of each
+    output is held in memory. The variance kept with ``sim.settings.variance``
+    is not merged. The merged data can be loaded with ``Data().load``.
+
+    .. rubric:: Args
+    filenames: iterable of str
+        The file names of the data objects to merge.
+    output_filename: str
+        The file name of the merged HDF5 file, which is overwritten.
+    disable_h5py: bool, default: qclab.utils.DISABLE_H5PY
+        If True, the input files are read as npz files. The output file is always
+        an HDF5 file.
+    """
+    # Imported here since the data module imports this module.
+    from qclab.data import Data, _is_variance_key
+    from qclab.streaming import StreamWriter
+
+    writer = None
+    seeds = SeedRuns()
+    log = ""
+    try:
+        for filename in filenames:
+            data = Data().load(filename, disable_h5py=disable_h5py, lazy=True)
+            variance_keys = [key for key in data.data_dict if _is_variance_key(key)]
+            if variance_keys:
+                logger.warning(
+                    "Discarding the variance in %s, which is not merged.", filename
+                )
+                for key in variance_keys:
+                    del data.data_dict[key]
+            if writer is None:
+                num_collect = max(
+                    (
+                        len(val)
+                        for key, val in data.data_dict.items()
+                        if key not in ("seed", "norm_factor") and np.ndim(val) > 0
+                    ),
+                    default=0,
+                )
+                writer = StreamWriter(output_filename, num_collect)
+            writer.add_data(data)
+            seeds.append(data.data_dict["seed"])
+            log += data.log
+            logger.info("Merged %s into %s.", filename, output_filename)
+    finally:
+        if writer is not None:
+            writer.close(seeds, log)
@@ -6,6 +6,75 @@ import copy
 from qclab.constants import Constants
 
 
+class IngredientList(list):
+    """
+    List of ingredients that counts its modifications in the ``version`` attribute
+    so that ``Model.get`` can detect when its index of the ingredients is outdated.
+    """
+
+    version = 0
+
+    def __setitem__(self, index, value):
+        out = super().__setitem__(index, value)
+        self.version += 1
+        return out
+
+    def __delitem__(self, index):
+        out = super().__delitem__(index)
+        self.version += 1
+        return out
+
+    def __iadd__(self, other):
+        out = super().__iadd__(other)
+        self.version += 1
+        return out
+
+    def __imul__(self, n):
+        out = super().__imul__(n)
+        self.version += 1
+        return out
+
+    def append(self, ingredient):
+        out = super().append(ingredient)
+        self.version += 1
+        return out
+
+    def extend(self, ingredients):
+        out = super().extend(ingredients)
+        self.version += 1
+        return out
+
+    def insert(self, index, ingredient):
+        out = super().insert(index, ingredient)
+        self.version += 1
+        return out
+
+    def pop(self, index=-1):
+        out = super().pop(index)
+        self.version += 1
+        return out
+
+    def remove(self, ingredient):
+        out = super().remove(ingredient)
+        self.version += 1
+        return out
+
+    def clear(self):
+        out = super().clear()
+        self.version += 1
+        return out
+
+    def sort(self, **kwargs):
+        out = super().sort(**kwargs)
+        self.version += 1
+        return out
+
+    def reverse(self):
+        out = super().reverse()
+        self.version += 1
+        return out
+
+
 class Model:
     """
     Model class for defining model constants and ingredients.
@@ -28,6 +97,7 @@ class Model:
         # Mark the constants as initialized.
         self.constants._init_complete = True
         # Copy the ingredients to ensure they are not shared across instances.
+        # The copy is stored as an IngredientList by __setattr__.
         self.ingredients = copy.deepcopy(self.ingredients)
         # Flags to indicate if the quantum Hamiltonian and quantum-classical
         # gradients need to be updated.
@@ -35,12 +105,27 @@ class Model:
         self.update_dh_qc_dzc = True
         self.initialize_constants()
 
+    def __setattr__(self, name, value):
+        """
+        Stores assigned ingredients as an IngredientList and resets the index of
+        the ingredients.
+        """
+        if name == "ingredients":
+            if not isinstance(value, IngredientList):
+                value = IngredientList(value)
+            super().__setattr__("_ingredient_index", None)
+        super().__setattr__(name, value)
+
     def get(self, ingredient_name):
         """
         Retrieve an ingredient by name.
         If the ingredient is not found or is None, returns (None, False).
         If the ingredient is found and not None, returns (ingredient, True).
 
+        If several ingredients have the same name, the last one in
+        ``self.ingredients`` is used. The ingredients are looked up in an index
+        that is rebuilt whenever ``self.ingredients`` is modified.
+
         Args
         -----------
         ingredient_name : str
@@ -51,12 +136,28 @@ class Model:
         tuple[callable | None, bool]: The ingredient function (or None if
             not found) and a flag indicating whether it exists.
         """
-        for ingredient in self.ingredients[::-1]:
-            if ingredient[0] == ingredient_name and not (ingredient[1] is None):
-                return ingredient[1], True
-            if ingredient[0] == ingredient_name and (ingredient[1] is None):
+        ingredients = self.ingredients
+        index = self._ingredient_index
+        if (
+            index is None
+            or index[0] is not ingredients
+            or index[1] != ingredients.version
+        ):
+            if not isinstance(ingredients, IngredientList):
+                # The class-level ingredients of a model that was not initialized.
+                for ingredient in ingredients[::-1]:
+                    if ingredient[0] == ingredient_name:
+                        return ingredient[1], ingredient[1] is not None
                 return None, False
-        return None, False
+            # Later ingredients override earlier ones with the same name.
+            index = (
+                ingredients,
+                ingredients.version,
+                {ingredient[0]: ingredient[1] for ingredient in ingredients},
+            )
+            super().__setattr__("_ingredient_index", index)
+        ingredient = index[2].get(ingredient_name)
+        return ingredient, ingredient is not None
 
     def initialize_constants(self):
         """
@@ -69,3 +170,6 @@ class Model:
         return
 
     ingredients = []
+    # Tuple (ingredients, version, index) of the ingredient list that the index of
+    # ingredient names was built from, set by get.
+    _ingredient_index = None
@@ -0,0 +1,273 @@
+"""
+This module contains the Profiler class, which records the cost of each task
+executed by the dynamics core.
+"""
+
+import os
+import json
+import time
+import threading
+import logging
+from functools import partial
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default maximum number of trace events kept in a profile.
+MAX_EVENTS = 100000
+
+
+def task_name(task):
+    """
+    Returns a name identifying a task by its function and keyword arguments, for
+    example ``update_classical_force(z_name=z_1)``.
+
+    Compiled tasks are named after the task they were compiled from.
+
+    .. rubric:: Args
+    task: callable
+        The task to name.
+
+    .. rubric:: Returns
+    name: str
+        The name of the task.
+    """
+    task = getattr(task, "__wrapped__", task)
+    kwargs = {}
+    while isinstance(task, partial):
+        kwargs = {**task.keywords, **kwargs}
+        task = getattr(task.func, "__wrapped__", task.func)
+    name = getattr(task, "__name__", type(task).__name__)
+    # Only keyword arguments holding names or numbers identify the task.
+    kwargs = {
+        key: val
+        for key, val in kwargs.items()
+        if val is None or isinstance(val, (str, int, float, bool))
+    }
+    if kwargs:
+        name += (
+            "(" + ", ".join(f"{key}={val}" for key, val in sorted(kwargs.items())) + ")"
+        )
+    return name
+
+
+def _nbytes(val):
+    """
+    Returns the number of bytes held by the arrays in ``val``.
+    """
+    if isinstance(val, np.ndarray):
+        return val.nbytes
+    if isinstance(val, (tuple, list)):
+        return sum(_nbytes(item) for item in val)
+    return 0
+
+
+def merge_profiles(profile_a, profile_b, max_events=MAX_EVENTS):
+    """
+    Merges two profiles by summing the statistics of each task and concatenating
+    the trace events up to ``max_events`` events. The number of trace events that
+    did not fit is added to the dropped events of the merged profile.
+
+    .. rubric:: Args
+    profile_a: dict | None
+        The first profile.
+    profile_b: dict | None
+        The second profile.
+    max_events: int, default: MAX_EVENTS
+        The maximum number of trace events of the merged profile.
+
+    .. rubric:: Returns
+    profile: dict | None
+        The merged profile, or None if both profiles are None.
+    """
+    if profile_a is None:
+        return profile_b
+    if profile_b is None:
+        return profile_a
+    tasks = {key: dict(val) for key, val in profile_a["tasks"].items()}
+    for key, val in profile_b["tasks"].items():
+        if key in tasks:
+            for stat in ("calls", "time", "bytes"):
+                tasks[key][stat] += val[stat]
+        else:
+            tasks[key] = dict(val)
+    events = profile_a["events"]
+    num_kept = min(max(max_events - len(events), 0), len(profile_b["events"]))
+    if num_kept > 0:
+        events = events + profile_b["events"][:num_kept]
+    dropped_events = (
+        profile_a.get("dropped_events", 0)
+        + profile_b.get("dropped_events", 0)
+        + len(profile_b["events"])
+        - num_kept
+    )
+    return {"tasks": tasks, "events": events, "dropped_events": dropped_events}
+
+
+def profile_summary(profile):
+    """
+    Returns a table of the statistics of each task in ``profile``, sorted by the
+    total time spent in the task.
+
+    .. rubric:: Args
+    profile: dict
+        The profile to summarize.
+
+    .. rubric:: Returns
+    summary: str
+        The table as a string.
+    """
+    rows = sorted(profile["tasks"].values(), key=lambda row: row["time"], reverse=True)
+    total_time = sum(row["time"] for row in rows)
+    width = max([len(row["task"]) for row in rows] + [4]) + 2
+    lines = [
+        f"{'recipe':<16}{'task':<{width}}{'calls':>10}{'time (s)':>12}"
+        f"{'time (%)':>10}{'us/call':>10}{'MB':>10}"
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['recipe']:<16}{row['task']:<{width}}{row['calls']:>10}"
+            f"{row['time']:>12.4f}"
+            f"{100 * row['time'] / max(total_time, 1e-300):>10.1f}"
+            f"{1e6 * row['time'] / max(row['calls'], 1):>10.1f}"
+            f"{row['bytes'] / 1e6:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def save_chrome_trace(profile, filename):
+    """
+    Saves the trace events of ``profile`` as a JSON file in the Chrome trace event
+    format, which can be opened in ``chrome://tracing`` or Perfetto.
+
+    .. rubric:: Args
+    profile: dict
+        The profile to save.
+    filename: str
+        The file name to save the trace to.
+    """
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": profile["events"]}, f)
+
+
+class Profiler:
+    """
+    Records the wall time, number of calls and number of bytes newly stored in the
+    state by each task of the recipes executed by the dynamics core.
+
+    The dynamics core creates a profiler for each batch if
+    ``sim.settings.profile`` is True and instruments the recipes with
+    ``instrument_recipe``. The resulting profile is stored in ``data.profile``.
+
+    .. rubric:: Args
+    max_events: int, default: MAX_EVENTS
+        The maximum number of trace events to record. Once reached, the statistics
+        of the tasks are still recorded but further trace events are only counted.
+    """
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self.max_events = max_events
+        self.tasks = {}
+        self.events = []
+        self.dropped_events = 0
+        self.pid = os.getpid()
+        # Offset converting perf_counter readings to the epoch so that the events
+        # of different processes share a time axis.
+        self._time_offset = time.time() - time.perf_counter()
+
+    def instrument_task(self, task, recipe_name):
+        """
+        Returns a task that executes ``task`` and records its cost.
+
+        .. rubric:: Args
+        task: callable
+            The task to instrument.
+        recipe_name: str
+            The name of the recipe that the task belongs to.
+
+        .. rubric:: Returns
+        profiled_task: callable
+            The instrumented task.
+        """
+        name = task_name(task)
+        key = f"{recipe_name}: {name}"
+        if key not in self.tasks:
+            self.tasks[key] = {
+                "recipe": recipe_name,
+                "task": name,
+                "calls": 0,
+                "time": 0.0,
+                "bytes": 0,
+            }
+        stats = self.tasks[key]
+
+        def profiled_task(sim, state, parameters):
+            val_ids = {key: id(val) for key, val in state.items()}
+            start = time.perf_counter()
+            state, parameters = task(sim, state, parameters)
+            end = time.perf_counter()
+            stats["calls"] += 1
+            stats["time"] += end - start
+            stats["bytes"] += sum(
+                _nbytes(val)
+                for key, val in state.items()
+                if val_ids.get(key) != id(val)
+            )
+            if len(self.events) < self.max_events:
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": recipe_name,
+                        "ph": "X",
+                        "ts": 1e6 * (start + self._time_offset),
+                        "dur": 1e6 * (end - start),
+                        "pid": self.pid,
+                        "tid": threading.get_ident(),
+                        "args": {"t_ind": int(sim.t_ind)},
+                    }
+                )
+            else:
+                self.dropped_events += 1
+            return state, parameters
+
+        profiled_task.__wrapped__ = task
+        return profiled_task
+
+    def instrument_recipe(self, recipe, recipe_name):
+        """
+        Returns the recipe with each task instrumented by ``instrument_task``.
+
+        .. rubric:: Args
+        recipe: list
+            The recipe to instrument.
+        recipe_name: str
+            The name of the recipe.
+
+        .. rubric:: Returns
+        profiled_recipe: list
+            The instrumented recipe.
+        """
+        return [self.instrument_task(task, recipe_name) for task in recipe]
+
+    def get_profile(self):
+        """
+        Returns the recorded statistics and trace events.
+
+        .. rubric:: Returns
+        profile: dict
+            Dictionary with the statistics of each task under "tasks", the trace
+            events under "events" and the number of trace events that were not
+            recorded under "dropped_events".
+        """
+        if self.dropped_events > 0:
+            logger.info(
+                "Recorded the maximum of %s trace events; %s later events were "
+                "dropped.",
+                self.max_events,
+                self.dropped_events,
+            )
+        return {
+            "tasks": {key: dict(val) for key, val in self.tasks.items()},
+            "events": list(self.events),
+            "dropped_events": self.dropped_events,
+        }
@@ -25,6 +25,20 @@ class Simulation:
             "batch_size": 25,
             "progress_bar": True,
             "debug": False,
+            "checkpoint_dir": None,
+            "checkpoint_interval": None,
+            "adaptive_tol": None,
+            "adaptive_dt_max": None,
+            "stop_condition": None,
+            "profile": False,
+            "memory_budget": None,
+            "autotune": False,
+            "autotune_cache": None,
+            "worker_logs": False,
+            "output_file": None,
+            "trajectory_outputs": None,
+            "trajectory_dir": None,
+            "variance": False,
         }
         # Merge default settings with user-provided settings.
         settings = {**self.default_settings, **settings}
@@ -0,0 +1,203 @@
+"""
+This module contains the StreamWriter class, which writes the output of a
+simulation to an HDF5 file while the simulation is running.
+"""
+
+import logging
+import numpy as np
+from qclab.utils import DISABLE_H5PY
+
+if not DISABLE_H5PY:
+    import h5py
+
+logger = logging.getLogger(__name__)
+
+# Target size in bytes of a chunk of an output dataset.
+CHUNK_BYTES = 2**16
+
+# Group of the file holding the rows of the batch being streamed until the batch
+# is completed.
+STAGED_GROUP = "_staged"
+
+
+class StreamWriter:
+    """
+    Writes the outputs of a simulation to an HDF5 file as they are collected.
+
+    Each output is stored in a chunked dataset whose first axis runs over the
+    collect times ``sim.settings.t_collect`` and which is created with room for
+    all of them when the output first arrives. Rows can be streamed one collect
+    time at a time with ``write_row`` and completed batches can be merged with
+    ``add_data``, in both cases as a ``norm_factor``-weighted average with the
+    batches already in the file. Streamed rows are staged in the group
+    ``STAGED_GROUP`` of the file and only merged by ``commit_batch`` together
+    with the seeds and ``norm_factor`` of the batch, so the outputs, seeds and
+    ``norm_factor`` in the file always describe the same completed batches. The
+    file is flushed after every collect time and every merged batch, so that it
+    can be read with ``Data.load`` at any point, which ignores the staged rows of
+    a batch that was not completed.
+
+    .. rubric:: Args
+    filename: str
+        The file name of the HDF5 file, which is overwritten.
+    num_collect: int
+        The number of collect times, ``len(sim.settings.t_collect)``.
+    """
+
+    def __init__(self, filename, num_collect):
+        if DISABLE_H5PY:
+            logger.error("Streaming output requires h5py.")
+            raise ValueError("Streaming output requires h5py.")
+        self.filename = filename
+        self.num_collect = num_collect
+        # Sum of the norm factors of the completed batches in the file.
+        self.norm_factor = 0
+        # Norm factor of the batch whose rows are being staged, if any.
+        self.batch_norm_factor = 0
+        self.h5file = h5py.File(filename, "w")
+        self.h5file.attrs["log"] = ""
+        self.h5file.create_dataset(
+            "seed", shape=(0,), maxshape=(None,), dtype=int, chunks=(4096,)
+        )
+        self.h5file.create_dataset("norm_factor", data=0.0)
+        logger.info("Streaming output to %s.", filename)
+
+    def _dataset(self, key, row):
+        """
+        Returns the dataset at the path ``key``, creating it for rows like ``row``
+        if it does not exist.
+        """
+        if key not in self.h5file:
+            row = np.asarray(row)
+            rows_per_chunk = int(
+                np.clip(CHUNK_BYTES // max(row.nbytes, 1), 1, self.num_collect)
+            )
+            self.h5file.create_dataset(
+                key,
+                shape=(0, *row.shape),
+                maxshape=(self.num_collect, *row.shape),
+                dtype=row.dtype,
+                chunks=(rows_per_chunk, *row.shape),
+            )
+        return self.h5file[key]
+
+    def _merge_output(self, key, val, new_norm_factor):
+        """
+        Merges the rows ``val`` of output ``key`` of a batch with norm factor
+        ``new_norm_factor`` into the file, a chunk of rows at a time.
+        """
+        dataset = self._dataset(key, val[0])
+        if self.norm_factor == 0 or dataset.shape[0] == 0:
+            dataset.resize(len(val), axis=0)
+            for start in range(0, len(val), dataset.chunks[0]):
+                end = min(start + dataset.chunks[0], len(val))
+                dataset[start:end] = val[start:end]
+            return
+        rows_per_chunk = dataset.chunks[0]
+        for start in range(0, len(val), rows_per_chunk):
+            end = min(start + rows_per_chunk, len(val))
+            dataset[start:end] = (
+                dataset[start:end] * self.norm_factor + val[start:end] * new_norm_factor
+            ) / (self.norm_factor + new_norm_factor)
+
+    def _append_seeds(self, seeds):
+        """
+        Appends ``seeds`` to the seeds in the file.
+        """
+        seeds = np.asarray(seeds)
+        dataset = self.h5file["seed"]
+        num_seeds = dataset.shape[0]
+        dataset.resize((num_seeds + len(seeds),))
+        dataset[num_seeds:] = seeds
+
+    def write_row(self, key, collect_ind, row, norm_factor):
+        """
+        Stages the output ``key`` of the batch being streamed at the collect time
+        with index ``collect_ind`` in the file until ``commit_batch`` merges it.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+        collect_ind: int
+            The index of the collect time.
+        row: ndarray
+            The output of the batch at the collect time, averaged over the batch.
+        norm_factor: float
+            The norm factor of the batch.
+        """
+        dataset = self._dataset(f"{STAGED_GROUP}/{key}", row)
+        self.batch_norm_factor = norm_factor
+        if collect_ind >= dataset.shape[0]:
+            dataset.resize(collect_ind + 1, axis=0)
+        dataset[collect_ind] = row
+
+    def flush(self):
+        """
+        Flushes the file to disk.
+        """
+        self.h5file["norm_factor"][()] = self.norm_factor
+        self.h5file.flush()
+
+    def commit_batch(self, seeds):
+        """
+        Merges the staged rows of the batch being streamed into the file and adds
+        its seeds and norm factor, if there is such a batch.
+
+        .. rubric:: Args
+        seeds: ndarray
+            The seeds of the batch.
+        """
+        if self.batch_norm_factor == 0:
+            return
+        for key, val in self.h5file[STAGED_GROUP].items():
+            if val.shape[0] > 0:
+                self._merge_output(key, val, self.batch_norm_factor)
+            # Empty the staged rows, whose datasets are reused by the next batch.
+            val.resize(0, axis=0)
+        self.norm_factor += self.batch_norm_factor
+        self.batch_norm_factor = 0
+        self._append_seeds(seeds)
+        self.flush()
+
+    def add_data(self, data):
+        """
+        Merges the outputs of a completed batch into the file.
+
+        The datasets are updated a chunk at a time so that only one chunk of each
+        output in the file and in ``data`` is read into memory at once, which
+        allows merging data loaded with ``Data.load(..., lazy=True)``.
+
+        .. rubric:: Args
+        data: Data
+            The data object of the batch.
+        """
+        new_norm_factor = data.data_dict["norm_factor"]
+        if new_norm_factor == 0:
+            return
+        for key, val in data.data_dict.items():
+            if key in ("seed", "norm_factor") or isinstance(val, dict):
+                continue
+            self._merge_output(key, val, new_norm_factor)
+        self.norm_factor += new_norm_factor
+        self._append_seeds(data.data_dict["seed"])
+        self.flush()
+
+    def close(self, seeds, log=""):
+        """
+        Writes the final seeds and log to the file and closes it.
+
+        .. rubric:: Args
+        seeds: ndarray
+            The seeds of all trajectories in the file, in their final order.
+        log: str, default: ""
+            The log to store in the file.
+        """
+        if STAGED_GROUP in self.h5file:
+            del self.h5file[STAGED_GROUP]
+        dataset = self.h5file["seed"]
+        dataset.resize((len(seeds),))
+        dataset[...] = np.asarray(seeds)
+        self.h5file.attrs["log"] = log
+        self.flush()
+        self.h5file.close()
+        logger.info("Closed output stream %s.", self.filename)
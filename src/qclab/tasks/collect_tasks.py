@@ -52,6 +52,32 @@ def collect_dm_db(sim, state, parameters, **kwargs):
     return state, parameters
 
 
+def collect_dm_db_elements(sim, state, parameters, **kwargs):
+    """
+    Collects the selected elements of the diabatic density matrix from the state
+    object and stores them in the output dictionary.
+
+    .. rubric:: Required Constants
+    None
+
+    .. rubric:: Keyword Arguments
+    dm_db_elements_name : str, default : "dm_db_elements"
+        Name of the density matrix elements in the state object.
+    dm_db_elements_output_name : str, default : "dm_db_elements"
+        Name of the density matrix elements in the output dictionary.
+
+    .. rubric:: Modifications
+    state["output_dict"][dm_db_elements_output_name] : ndarray
+        Stores the density matrix elements.
+    """
+    dm_db_elements_name = kwargs.get("dm_db_elements_name", "dm_db_elements")
+    dm_db_elements_output_name = kwargs.get(
+        "dm_db_elements_output_name", "dm_db_elements"
+    )
+    state["output_dict"][dm_db_elements_output_name] = state[dm_db_elements_name]
+    return state, parameters
+
+
 def collect_classical_energy(sim, state, parameters, **kwargs):
     """
     Collects the classical energy from the state object and stores it in the
@@ -0,0 +1,225 @@
+"""
+This module contains the recipe compiler, which replaces tasks in a recipe by
+equivalent tasks with their keyword arguments, ingredients and settings resolved
+ahead of time.
+"""
+
+import logging
+from functools import partial
+import numpy as np
+from qclab import functions
+from qclab.tasks import update_tasks
+
+logger = logging.getLogger(__name__)
+
+
+def _unwrap_task(task):
+    """
+    Returns the function and keyword arguments of a task, flattening nested
+    partials. Returns None for the function if the task binds positional
+    arguments.
+    """
+    kwargs = {}
+    while isinstance(task, partial):
+        if task.args:
+            return None, {}
+        kwargs = {**task.keywords, **kwargs}
+        task = task.func
+    return task, kwargs
+
+
+def _compile_update_classical_force(sim, **kwargs):
+    """
+    Compiles ``update_classical_force`` for a model with a ``dh_c_dzc`` ingredient.
+    """
+    z_name = kwargs.get("z_name", "z")
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    dh_c_dzc, has_dh_c_dzc = sim.model.get("dh_c_dzc")
+    if not has_dh_c_dzc:
+        return None
+    model = sim.model
+
+    def compiled_task(sim, state, parameters):
+        state[classical_force_name] = dh_c_dzc(model, parameters, z=state[z_name])
+        return state, parameters
+
+    return compiled_task
+
+
+def _compile_update_quantum_classical_force(sim, **kwargs):
+    """
+    Compiles ``update_quantum_classical_force`` for a model with a ``dh_qc_dzc``
+    ingredient and an algorithm without the gauge field force.
+    """
+    if sim.algorithm.settings.get("use_gauge_field_force"):
+        return None
+    z_name = kwargs.get("z_name", "z")
+    wf_db_name = kwargs.get("wf_db_name", "wf_db")
+    dh_qc_dzc_name = kwargs.get("dh_qc_dzc_name", "dh_qc_dzc")
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    wf_changed = kwargs.get("wf_changed", True)
+    dh_qc_dzc, has_dh_qc_dzc = sim.model.get("dh_qc_dzc")
+    if not has_dh_qc_dzc:
+        return None
+    model = sim.model
+    update_dh_qc_dzc = sim.model.update_dh_qc_dzc
+    update_force = wf_changed or update_dh_qc_dzc
+
+    def compiled_task(sim, state, parameters):
+        z = state[z_name]
+        if update_dh_qc_dzc or not (dh_qc_dzc_name in state):
+            state[dh_qc_dzc_name] = dh_qc_dzc(model, parameters, z=z)
+        if update_force or not (quantum_classical_force_name in state):
+            if not (quantum_classical_force_name in state):
+                state[quantum_classical_force_name] = np.zeros_like(z)
+            wf_db = state[wf_db_name]
+            state[quantum_classical_force_name] = functions.calc_sparse_inner_product(
+                *state[dh_qc_dzc_name],
+                wf_db.conj(),
+                wf_db,
+                out=state[quantum_classical_force_name].reshape(-1),
+            ).reshape(np.shape(z))
+        return state, parameters
+
+    return compiled_task
+
+
+def _compile_update_z_rk4_k123(sim, **kwargs):
+    """
+    Compiles ``update_z_rk4_k123`` with the time step of the simulation.
+    """
+    if sim.settings.debug:
+        return None
+    z_name = kwargs.get("z_name", "z")
+    z_k_name = kwargs.get("z_k_name", "z_1")
+    k_name = kwargs.get("k_name", "z_rk4_k1")
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    dt = kwargs.get("dt_factor", 0.5) * sim.settings.dt_update
+
+    def compiled_task(sim, state, parameters):
+        state[z_k_name], state[k_name] = functions.update_z_rk4_k123_sum(
+            state[z_name],
+            state[classical_force_name],
+            state[quantum_classical_force_name],
+            dt,
+        )
+        return state, parameters
+
+    return compiled_task
+
+
+def _compile_update_z_rk4_k4(sim, **kwargs):
+    """
+    Compiles ``update_z_rk4_k4`` with the time step of the simulation.
+    """
+    z_name = kwargs.get("z_name", "z")
+    k1_name = kwargs.get("k1_name", "z_rk4_k1")
+    k2_name = kwargs.get("k2_name", "z_rk4_k2")
+    k3_name = kwargs.get("k3_name", "z_rk4_k3")
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    dt_update = sim.settings.dt_update
+
+    def compiled_task(sim, state, parameters):
+        state[z_name] = functions.update_z_rk4_k4_sum(
+            state[z_name],
+            state[k1_name],
+            state[k2_name],
+            state[k3_name],
+            state[classical_force_name],
+            state[quantum_classical_force_name],
+            dt_update,
+        )
+        return state, parameters
+
+    return compiled_task
+
+
+def _compile_update_h_q_tot(sim, **kwargs):
+    """
+    Compiles ``update_h_q_tot`` with the ``h_q`` and ``h_qc`` ingredients of the model.
+    """
+    z_name = kwargs.get("z_name", "z")
+    h_q_name = kwargs.get("h_q_name", "h_q")
+    h_qc_name = kwargs.get("h_qc_name", "h_qc")
+    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
+    h_q, _ = sim.model.get("h_q")
+    h_qc, _ = sim.model.get("h_qc")
+    model = sim.model
+    update_h_q = sim.model.update_h_q
+
+    def compiled_task(sim, state, parameters):
+        if update_h_q or not (h_q_name in state):
+            state[h_q_name] = h_q(model, parameters, batch_size=sim.settings.batch_size)
+        state[h_qc_name] = h_qc(model, parameters, z=state[z_name])
+        state[h_q_tot_name] = state[h_q_name] + state[h_qc_name]
+        return state, parameters
+
+    return compiled_task
+
+
+def _compile_fssh_task(task, sim, **kwargs):
+    """
+    Compiles an FSSH task by binding the number of branches determined by
+    ``sim.algorithm.settings.fssh_deterministic``.
+    """
+    if "num_branches" not in kwargs:
+        if sim.algorithm.settings.fssh_deterministic:
+            kwargs["num_branches"] = sim.model.constants.num_quantum_states
+        else:
+            kwargs["num_branches"] = 1
+    return partial(task, **kwargs)
+
+
+_task_compilers = {
+    update_tasks.update_classical_force: _compile_update_classical_force,
+    update_tasks.update_quantum_classical_force: _compile_update_quantum_classical_force,
+    update_tasks.update_z_rk4_k123: _compile_update_z_rk4_k123,
+    update_tasks.update_z_rk4_k4: _compile_update_z_rk4_k4,
+    update_tasks.update_h_q_tot: _compile_update_h_q_tot,
+    update_tasks.update_hop_prob_fssh: partial(
+        _compile_fssh_task, update_tasks.update_hop_prob_fssh
+    ),
+    update_tasks.update_hop_inds_fssh: partial(
+        _compile_fssh_task, update_tasks.update_hop_inds_fssh
+    ),
+}
+
+
+def compile_task(sim, task):
+    """
+    Compiles a task for the simulation ``sim``.
+
+    Tasks from ``qclab.tasks`` that are called at every timestep are replaced by
+    equivalent tasks that look up their keyword arguments, ingredients and settings
+    once, when the task is compiled, instead of on every call. All other tasks are
+    returned unchanged. The compiled task is only valid as long as the model,
+    algorithm and settings of ``sim`` are not changed.
+
+    .. rubric:: Args
+    sim: Simulation
+        The simulation object containing the model, algorithm, and settings.
+    task: callable
+        The task to compile.
+
+    .. rubric:: Returns
+    compiled_task: callable
+        The compiled task.
+    """
+    func, kwargs = _unwrap_task(task)
+    compiler = _task_compilers.get(func)
+    if compiler is None:
+        return task
+    compiled_task = compiler(sim, **kwargs)
+    if compiled_task is None:
+        return task
+    # Keep a reference to the original task, for example to name it in profiles.
+    compiled_task.__wrapped__ = task
+    return compiled_task
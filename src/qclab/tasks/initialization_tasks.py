@@ -456,6 +456,10 @@ def initialize_random_values_fssh(sim, state, parameters, **kwargs):
         np.random.seed(seed[int(nt * num_branches)])
         hop_prob_rand_vals[nt] = np.random.rand(len(sim.settings.t_update))
         init_act_surf_rand_vals[nt] = np.random.rand(num_branches)
+    # The random numbers are never modified, which lets them be shared rather than
+    # copied when the state is copied.
+    hop_prob_rand_vals.flags.writeable = False
+    init_act_surf_rand_vals.flags.writeable = False
     state[hop_prob_rand_vals_name] = hop_prob_rand_vals
     state[init_act_surf_rand_vals_name] = init_act_surf_rand_vals
     return state, parameters
@@ -632,6 +632,9 @@ def update_hop_prob_fssh(sim, state, parameters, **kwargs):
         Name of the previous eigenvectors in the state object.
     hop_prob_name : str, default: "hop_prob"
         Name under which to store the hopping probabilities in the state object.
+    num_branches : int, optional
+        Number of branches per trajectory. If not provided, it is determined from
+        ``sim.algorithm.settings.fssh_deterministic``.
 
     .. rubric:: Modifications
     state[hop_prob_name] : ndarray
@@ -646,10 +649,12 @@ def update_hop_prob_fssh(sim, state, parameters, **kwargs):
     wf_adb = state[wf_adb_name]
     eigvecs = state[eigvecs_name]
     eigvecs_previous = state[eigvecs_previous_name]
-    if sim.algorithm.settings.fssh_deterministic:
-        num_branches = sim.model.constants.num_quantum_states
-    else:
-        num_branches = 1
+    num_branches = kwargs.get("num_branches")
+    if num_branches is None:
+        if sim.algorithm.settings.fssh_deterministic:
+            num_branches = sim.model.constants.num_quantum_states
+        else:
+            num_branches = 1
     num_trajs = sim.settings.batch_size // num_branches
     # Check if any of the coefficients on the active surface are zero.
     if sim.settings.debug:
@@ -693,7 +698,9 @@ def update_hop_inds_fssh(sim, state, parameters, **kwargs):
         Name under which to store the destination indices of the hopping trajectories in the state object.
 
     .. rubric:: Keyword Arguments
-    None
+    num_branches : int, optional
+        Number of branches per trajectory. If not provided, it is determined from
+        ``sim.algorithm.settings.fssh_deterministic``.
 
     .. rubric:: Modifications
     state[hop_ind_name] : ndarray
@@ -707,10 +714,12 @@ def update_hop_inds_fssh(sim, state, parameters, **kwargs):
     )
     hop_ind_name = kwargs.get("hop_ind_name", "hop_ind")
     hop_dest_name = kwargs.get("hop_dest_name", "hop_dest")
-    if sim.algorithm.settings.fssh_deterministic:
-        num_branches = sim.model.constants.num_quantum_states
-    else:
-        num_branches = 1
+    num_branches = kwargs.get("num_branches")
+    if num_branches is None:
+        if sim.algorithm.settings.fssh_deterministic:
+            num_branches = sim.model.constants.num_quantum_states
+        else:
+            num_branches = 1
     num_trajs = sim.settings.batch_size // num_branches
     hop_prob = state[hop_prob_name]
     rand = state[hop_prob_rand_vals_name][:, sim.t_ind]
@@ -1142,6 +1151,80 @@ def update_z_rk4_k4(sim, state, parameters, **kwargs):
     return state, parameters
 
 
+def update_mean_field_harmonic_diagonal_linear(sim, state, parameters, **kwargs):
+    """
+    Carries out a full mean-field time step in a single compiled kernel for models
+    with the ``h_c_harmonic``, ``dh_c_dzc_harmonic``, ``h_qc_diagonal_linear`` and
+    ``dh_qc_dzc_diagonal_linear`` ingredients and a constant quantum Hamiltonian.
+
+    This is equivalent to the update recipe of ``MeanField`` except that the
+    intermediate RK4 coordinates and slopes are not stored in the state object.
+
+    .. rubric:: Required Constants
+    diagonal_linear_coupling : ndarray
+        Coupling constants :math:`\\gamma`.
+    harmonic_frequency : ndarray
+        Harmonic frequency of each classical coordinate.
+
+    .. rubric:: Keyword Arguments
+    z_name : str, default: "z"
+        Name of classical coordinates in the state object.
+    wf_db_name : str, default: "wf_db"
+        Name of the diabatic wavefunction in the state object.
+    h_q_name : str, default: "h_q"
+        Name of the quantum Hamiltonian in the state object.
+    h_qc_name : str, default: "h_qc"
+        Name of the quantum-classical coupling Hamiltonian in the state object.
+    h_q_tot_name : str, default: "h_q_tot"
+        Name of the total Hamiltonian of the quantum subsystem in the state object.
+    classical_force_name : str, default: "classical_force"
+        Name of the classical force in the state object.
+    quantum_classical_force_name : str, default: "quantum_classical_force"
+        Name of the quantum-classical force in the state object.
+
+    .. rubric:: Modifications
+    state[z_name] : ndarray
+        Updated classical coordinates.
+    state[wf_db_name] : ndarray
+        Updated diabatic wavefunction.
+    state[h_qc_name] : ndarray
+        Quantum-classical coupling matrix.
+    state[h_q_tot_name] : ndarray
+        Total Hamiltonian of the quantum subsystem.
+    state[classical_force_name] : ndarray
+        Classical force at the last RK4 stage.
+    state[quantum_classical_force_name] : ndarray
+        Quantum-classical force.
+    """
+    z_name = kwargs.get("z_name", "z")
+    wf_db_name = kwargs.get("wf_db_name", "wf_db")
+    h_q_name = kwargs.get("h_q_name", "h_q")
+    h_qc_name = kwargs.get("h_qc_name", "h_qc")
+    h_q_tot_name = kwargs.get("h_q_tot_name", "h_q_tot")
+    classical_force_name = kwargs.get("classical_force_name", "classical_force")
+    quantum_classical_force_name = kwargs.get(
+        "quantum_classical_force_name", "quantum_classical_force"
+    )
+    z = state[z_name]
+    for name in (classical_force_name, quantum_classical_force_name):
+        if not (name in state):
+            state[name] = np.zeros_like(z)
+    functions.update_mean_field_harmonic_diagonal_linear_jit(
+        z,
+        state[wf_db_name],
+        state[h_q_name],
+        sim.model.constants.diagonal_linear_coupling,
+        sim.model.constants.classical_coordinate_weight,
+        sim.model.constants.harmonic_frequency,
+        sim.settings.dt_update,
+        state[h_qc_name],
+        state[h_q_tot_name],
+        state[classical_force_name],
+        state[quantum_classical_force_name],
+    )
+    return state, parameters
+
+
 def update_dm_db_wf(sim, state, parameters, **kwargs):
     """
     Updates the diabatic density matrix based on the wavefunction.
@@ -1168,6 +1251,43 @@ def update_dm_db_wf(sim, state, parameters, **kwargs):
     return state, parameters
 
 
+def update_dm_db_elements_wf(sim, state, parameters, **kwargs):
+    """
+    Updates selected elements of the diabatic density matrix based on the
+    wavefunction, without forming the full density matrix.
+
+    If ``elements`` is None, the diabatic populations (the real diagonal of the
+    density matrix) are computed. Otherwise the elements ``(i, j)`` in
+    ``elements`` are computed in the given order.
+
+    .. rubric:: Required Constants
+    None
+
+    .. rubric:: Keyword Arguments
+    wf_db_name : str, default: "wf_db"
+        Name of the diabatic wavefunction in the state object.
+    dm_db_elements_name : str, default: "dm_db_elements"
+        Name of the density matrix elements in the state object.
+    elements : list of tuple of int, default: None
+        Row and column indices of the density matrix elements to compute.
+
+    .. rubric:: Modifications
+    state[dm_db_elements_name] : ndarray
+        Diabatic populations of shape ``(batch_size, num_quantum_states)`` or
+        density matrix elements of shape ``(batch_size, len(elements))``.
+    """
+    wf_db_name = kwargs.get("wf_db_name", "wf_db")
+    dm_db_elements_name = kwargs.get("dm_db_elements_name", "dm_db_elements")
+    elements = kwargs.get("elements", None)
+    wf_db = state[wf_db_name]
+    if elements is None:
+        state[dm_db_elements_name] = np.abs(wf_db) ** 2
+    else:
+        rows, cols = np.asarray(elements, dtype=int).reshape((-1, 2)).T
+        state[dm_db_elements_name] = wf_db[:, rows] * np.conj(wf_db[:, cols])
+    return state, parameters
+
+
 def update_classical_energy(sim, state, parameters, **kwargs):
     """
     Updates the classical energy.
@@ -1410,3 +1530,93 @@ def update_dm_db_fssh(sim, state, parameters, **kwargs):
     state[dm_adb_name] = dm_adb
     state[dm_db_name] = dm_db
     return state, parameters
+
+
+def update_dm_db_elements_fssh(sim, state, parameters, **kwargs):
+    """
+    Updates selected elements of the diabatic density matrix for FSSH, without
+    forming the adiabatic or diabatic density matrices.
+
+    Gives the same elements as ``update_dm_db_fssh``. The adiabatic density matrix
+    of FSSH is the outer product of the adiabatic wavefunction with its diagonal
+    replaced by the active surface, so each diabatic element is the element of the
+    outer product of the diabatic wavefunction plus a correction from the
+    populations, which together take ``O(num_quantum_states)`` operations per
+    element rather than the two matrix products of the basis transformation.
+
+    If ``elements`` is None, the diabatic populations (the real diagonal of the
+    density matrix) are computed. Otherwise the elements ``(i, j)`` in
+    ``elements`` are computed in the given order.
+
+    .. rubric:: Required Constants
+    None
+
+    .. rubric:: Keyword Arguments
+    wf_adb_name : str, default: "wf_adb"
+        Name of the adiabatic wavefunction in the state object.
+    dm_adb_0_name : str, default: "dm_adb_0"
+        Name of the initial adiabatic density matrix in the state object.
+    act_surf_name : str, default: "act_surf"
+        Name of the active surface wavefunction in the state object.
+    eigvecs_name : str, default: "eigvecs"
+        Name of the eigenvectors in the state object.
+    dm_db_elements_name : str, default: "dm_db_elements"
+        Name of the density matrix elements in the state object.
+    elements : list of tuple of int, default: None
+        Row and column indices of the density matrix elements to compute.
+
+    .. rubric:: Modifications
+    state[dm_db_elements_name] : ndarray
+        Diabatic populations of shape ``(batch_size, num_quantum_states)`` or
+        density matrix elements of shape ``(batch_size, len(elements))``.
+    """
+    wf_adb_name = kwargs.get("wf_adb_name", "wf_adb")
+    dm_adb_0_name = kwargs.get("dm_adb_0_name", "dm_adb_0")
+    act_surf_name = kwargs.get("act_surf_name", "act_surf")
+    eigvecs_name = kwargs.get("eigvecs_name", "eigvecs")
+    dm_db_elements_name = kwargs.get("dm_db_elements_name", "dm_db_elements")
+    elements = kwargs.get("elements", None)
+    wf_adb = state[wf_adb_name]
+    dm_adb_0 = state[dm_adb_0_name]
+    act_surf = state[act_surf_name]
+    eigvecs = state[eigvecs_name]
+    wf_db = np.einsum("tij,tj->ti", eigvecs, wf_adb)
+    # Replaces the adiabatic populations of the wavefunction by the active surface.
+    pops_correction = act_surf - np.abs(wf_adb) ** 2
+    if elements is None:
+        # Sums |eigvecs|^2 * pops_correction using views of the real and imaginary
+        # parts, so that no array of the size of eigvecs is created.
+        dm_db_elements = np.abs(wf_db) ** 2 + np.einsum(
+            "tij,tij,tj->ti", eigvecs.real, eigvecs.real, pops_correction
+        )
+        if np.iscomplexobj(eigvecs):
+            dm_db_elements += np.einsum(
+                "tij,tij,tj->ti", eigvecs.imag, eigvecs.imag, pops_correction
+            )
+    else:
+        rows, cols = np.asarray(elements, dtype=int).reshape((-1, 2)).T
+        dm_db_elements = wf_db[:, rows] * np.conj(wf_db[:, cols]) + np.einsum(
+            "tkj,tj,tkj->tk",
+            eigvecs[:, rows],
+            pops_correction,
+            np.conj(eigvecs[:, cols]),
+        )
+    if sim.algorithm.settings.fssh_deterministic:
+        num_branches = sim.model.constants.num_quantum_states
+        batch_size = sim.settings.batch_size // num_branches
+        num_quantum_states = sim.model.constants.num_quantum_states
+        # This reweighting by num_branches simplifies the subsequent averaging.
+        weights = (
+            num_branches
+            * np.einsum(
+                "tbbb->tb",
+                dm_adb_0.reshape(
+                    (batch_size, num_branches, num_quantum_states, num_quantum_states)
+                ),
+            ).flatten()
+        )
+        if elements is None:
+            weights = np.real(weights)
+        dm_db_elements = weights[:, np.newaxis] * dm_db_elements
+    state[dm_db_elements_name] = dm_db_elements
+    return state, parameters
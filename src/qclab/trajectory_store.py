@@ -0,0 +1,200 @@
+"""
+This module contains the TrajectoryStore class, which stores selected outputs of
+every trajectory in memory-mapped arrays on disk.
+"""
+
+import os
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Name of the file describing the arrays of a trajectory store.
+INDEX_FILE = "index.json"
+
+
+class TrajectoryStore:
+    """
+    Stores the outputs named in ``keys`` of every trajectory of a simulation in
+    the directory ``directory``.
+
+    Each output is stored in a ``.npy`` file holding an array of shape
+    ``(num_trajs, len(sim.settings.t_collect), ...)`` whose rows are the
+    trajectories in the order of the seeds in ``seed.npy``. The arrays are
+    memory-mapped, so the drivers and their worker processes write the rows of
+    each batch directly to disk rather than holding them in memory. A store is
+    created by the drivers with ``TrajectoryStore.create`` and opened for writing
+    by the data object of each batch. Only the directory and the names of the
+    outputs are pickled, so the store adds little to the data objects sent
+    between processes.
+
+    .. rubric:: Args
+    directory: str
+        The directory of an existing trajectory store.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE), "r", encoding="utf-8") as f:
+            self.keys = json.load(f)["keys"]
+        self._reset()
+
+    def _reset(self):
+        """
+        Discards the seeds and arrays loaded by this process.
+        """
+        self._seeds = None
+        self._sorter = None
+        self._arrays = {}
+
+    def __getstate__(self):
+        return {"directory": self.directory, "keys": self.keys}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    @property
+    def seeds(self):
+        """
+        The seeds of the trajectories in the order of the rows of the arrays.
+        """
+        if self._seeds is None:
+            self._seeds = np.load(os.path.join(self.directory, "seed.npy"))
+            self._sorter = np.argsort(self._seeds)
+        return self._seeds
+
+    @classmethod
+    def create(cls, directory, sim, seeds, keys):
+        """
+        Creates a trajectory store for the trajectories with seeds ``seeds`` and
+        returns it.
+
+        The shape and dtype of each output are determined by executing the
+        initialization and collect recipes for the first batch. Existing arrays
+        in ``directory`` are overwritten.
+
+        .. rubric:: Args
+        directory: str
+            The directory of the store, which is created if it does not exist.
+        sim: Simulation
+            The simulation object with initialized timesteps.
+        seeds: ndarray
+            The seeds of all trajectories of the simulation.
+        keys: list of str
+            The names of the outputs to store.
+
+        .. rubric:: Returns
+        store: TrajectoryStore
+            The trajectory store.
+        """
+        # Imported here since the drivers import the data module.
+        from qclab.dynamics.parallel_driver_multiprocessing import (
+            _probe_output_specs,
+        )
+
+        if directory is None:
+            logger.error("No directory was given for the trajectory outputs.")
+            raise ValueError("No directory was given for the trajectory outputs.")
+        seeds = np.asarray(seeds, dtype=int)
+        output_specs = _probe_output_specs(sim, seeds[: sim.settings.batch_size])
+        for key in keys:
+            if key not in output_specs:
+                logger.error("The output %s is not collected by the algorithm.", key)
+                raise ValueError(f"The output {key} is not collected by the algorithm.")
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "seed.npy"), seeds)
+        for key in keys:
+            shape, dtype = output_specs[key]
+            array = np.lib.format.open_memmap(
+                os.path.join(directory, f"{key}.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(len(seeds), *shape),
+            )
+            del array
+        with open(os.path.join(directory, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump({"keys": list(keys)}, f)
+        logger.info(
+            "Storing %s of %s trajectories in %s.", list(keys), len(seeds), directory
+        )
+        return cls(directory)
+
+    def rows(self, seeds):
+        """
+        Returns the row indices of the trajectories with seeds ``seeds``.
+
+        .. rubric:: Args
+        seeds: ndarray
+            Seeds of trajectories in the store.
+
+        .. rubric:: Returns
+        rows: ndarray
+            The row of each seed in the arrays of the store.
+        """
+        sorted_rows = np.searchsorted(self.seeds, seeds, sorter=self._sorter)
+        return self._sorter[sorted_rows]
+
+    def array(self, key, mode="r+"):
+        """
+        Returns the memory-mapped array of output ``key``.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+        mode: str, default: "r+"
+            The mode the array is opened with, "r+" for writing or "r" for reading.
+
+        .. rubric:: Returns
+        array: np.memmap
+            The array of shape ``(num_trajs, len(sim.settings.t_collect), ...)``.
+        """
+        if (key, mode) not in self._arrays:
+            self._arrays[(key, mode)] = np.load(
+                os.path.join(self.directory, f"{key}.npy"), mmap_mode=mode
+            )
+        return self._arrays[(key, mode)]
+
+    def write(self, key, rows, collect_ind, val):
+        """
+        Writes the output ``key`` of a batch at the collect time with index
+        ``collect_ind`` to the rows ``rows``. An output with one row per trajectory
+        rather than per branch, such as the classical energy in deterministic
+        surface hopping, is written to the rows of each of its branches.
+
+        .. rubric:: Args
+        key: str
+            The name of the output.
+        rows: ndarray
+            The rows of the trajectories of the batch, as given by ``rows``.
+        collect_ind: int
+            The index of the collect time.
+        val: ndarray
+            The output of every trajectory of the batch.
+        """
+        if len(val) != len(rows):
+            val = np.repeat(val, len(rows) // len(val), axis=0)
+        self.array(key)[rows, collect_ind] = val
+
+
+def load_trajectories(directory):
+    """
+    Returns the arrays of a trajectory store, memory-mapped read-only.
+
+    .. rubric:: Args
+    directory: str
+        The directory of the trajectory store, ``sim.settings.trajectory_dir``
+        of the simulation that created it.
+
+    .. rubric:: Returns
+    trajectories: dict
+        Dictionary mapping "seed" to the seed of each row and the name of each
+        stored output to its array of shape
+        ``(num_trajs, len(sim.settings.t_collect), ...)``.
+    """
+    store = TrajectoryStore(directory)
+    trajectories = {"seed": store.seeds}
+    for key in store.keys:
+        trajectories[key] = store.array(key, mode="r")
+    return trajectories
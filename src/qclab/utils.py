@@ -3,7 +3,8 @@ This module contains utility helpers for optional jit compilation and in-memory
 """
 
 import logging
-from io import StringIO
+from collections import deque
+import numpy as np
 
 DISABLE_NUMBA = False
 try:
@@ -62,23 +63,48 @@ else:
         njit = qc_lab_custom_njit
 
 
-_log_stream = StringIO()
+# Maximum number of log messages kept in memory by default.
+DEFAULT_MAX_LOG_RECORDS = 10000
+
+_log_records = deque(maxlen=DEFAULT_MAX_LOG_RECORDS)
+_num_dropped_records = 0
 
 
 class QCDataHandler(logging.Handler):
     """
-    Logging handler that stores logs in memory.
+    Logging handler that stores logs in a bounded in-memory buffer.
+
+    Once the buffer is full, each new message replaces the oldest one, so that the
+    memory used by the log of a long run is bounded.
     """
 
     def emit(self, record):
+        global _num_dropped_records
         msg = self.format(record)
-        _log_stream.write(msg + "\n")
+        if len(_log_records) == _log_records.maxlen:
+            _num_dropped_records += 1
+        _log_records.append(msg)
+
 
+def set_log_capacity(max_records):
+    """
+    Set the maximum number of log messages kept in memory.
 
-def configure_memory_logger(level=logging.INFO):
+    .. rubric:: Args
+    max_records: int
+        The maximum number of log messages.
+    """
+    global _log_records
+    _log_records = deque(_log_records, maxlen=max_records)
+
+
+def configure_memory_logger(level=logging.INFO, max_records=DEFAULT_MAX_LOG_RECORDS):
     """
     Configure root logger to store logs without printing.
+
+    At most ``max_records`` of the most recent log messages are kept.
     """
+    set_log_capacity(max_records)
     root_logger = logging.getLogger()
     root_logger.setLevel(level)
     for handler in list(root_logger.handlers):
@@ -93,20 +119,261 @@ def configure_memory_logger(level=logging.INFO):
 def get_log_output() -> str:
     """
     Return all collected log messages.
+
+    If older messages were dropped from the bounded buffer, the output starts with
+    a message stating how many.
     """
-    return _log_stream.getvalue()
+    header = ""
+    if _num_dropped_records > 0:
+        header = (
+            f"WARNING:{__name__}:{_num_dropped_records} earlier log messages were "
+            "dropped from the in-memory log.\n"
+        )
+    return header + "".join(msg + "\n" for msg in _log_records)
 
 
 def reset_log_output() -> None:
     """
     Clear all collected log messages.
 
-    Resets the in-memory log stream so that subsequent calls to
+    Resets the in-memory log buffer so that subsequent calls to
     :func:`get_log_output` return only the messages emitted after this
     function is called.
     """
-    _log_stream.seek(0)
-    _log_stream.truncate(0)
+    global _num_dropped_records
+    _log_records.clear()
+    _num_dropped_records = 0
+
+
+class SeedSummary:
+    """
+    Summary of an array of seeds for log messages, such as ``0-99 (100 seeds)``.
+
+    The summary is only computed when the message is formatted, so passing a
+    ``SeedSummary`` as a logging argument costs nothing if the message is not
+    emitted and never writes the full array into the log.
+
+    .. rubric:: Args
+    seeds: ndarray
+        The seeds to summarize.
+    """
+
+    def __init__(self, seeds):
+        self.seeds = seeds
+
+    def __str__(self):
+        if isinstance(self.seeds, SeedRuns) and self.seeds.num_runs == 1:
+            return f"{self.seeds.min()}-{self.seeds.max()} ({len(self.seeds)} seeds)"
+        seeds = np.asarray(self.seeds)
+        if len(seeds) == 0:
+            return "none"
+        if np.array_equal(seeds, seeds[0] + np.arange(len(seeds))):
+            return f"{seeds[0]}-{seeds[-1]} ({len(seeds)} seeds)"
+        return f"{len(seeds)} seeds between {np.min(seeds)} and {np.max(seeds)}"
+
+
+class SeedRuns:
+    """
+    Compact sequence of seeds stored as runs of consecutive integers.
+
+    The drivers run batches of consecutive seeds, so the seeds of a simulation
+    form a few runs no matter how many batches were merged. Appending the seeds of
+    a batch extends the last run if they continue it, so ``Data.seed_runs`` keeps
+    the number of seeds, the largest seed and the membership of the seeds of a
+    data object available without scanning its seed array. The order of the
+    seeds, including repeated seeds, is kept, so ``np.asarray(seed_runs)``
+    returns the same array as concatenating the appended seeds.
+
+    .. rubric:: Args
+    seeds: ndarray | SeedRuns, optional
+        The initial seeds.
+    """
+
+    def __init__(self, seeds=None):
+        self._starts = np.zeros(0, dtype=int)
+        self._lengths = np.zeros(0, dtype=int)
+        self._num_runs = 0
+        self._num_seeds = 0
+        self._max = None
+        self._min = None
+        # Sorted disjoint intervals covering the seeds, computed on demand.
+        self._intervals = None
+        if seeds is not None:
+            self.append(seeds)
+
+    @staticmethod
+    def _runs(seeds):
+        """
+        Returns the starts and lengths of the runs of consecutive integers in the
+        array ``seeds``.
+        """
+        seeds = np.asarray(seeds, dtype=int).flatten()
+        if len(seeds) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        breaks = np.flatnonzero(np.diff(seeds) != 1) + 1
+        first_ind = np.concatenate(([0], breaks))
+        lengths = np.diff(np.concatenate((first_ind, [len(seeds)])))
+        return seeds[first_ind], lengths
+
+    @property
+    def num_runs(self):
+        """
+        The number of runs of consecutive seeds.
+        """
+        return self._num_runs
+
+    def runs(self):
+        """
+        Returns the starts and lengths of the runs of consecutive seeds.
+
+        .. rubric:: Returns
+        starts: ndarray
+            The first seed of each run.
+        lengths: ndarray
+            The number of seeds in each run.
+        """
+        return (
+            self._starts[: self._num_runs].copy(),
+            self._lengths[: self._num_runs].copy(),
+        )
+
+    def append(self, seeds):
+        """
+        Appends ``seeds`` to the end of the sequence.
+
+        .. rubric:: Args
+        seeds: ndarray | SeedRuns
+            The seeds to append.
+        """
+        if isinstance(seeds, SeedRuns):
+            starts, lengths = seeds.runs()
+        else:
+            starts, lengths = self._runs(seeds)
+        if len(starts) == 0:
+            return
+        runs_max = int(np.max(starts + lengths)) - 1
+        runs_min = int(np.min(starts))
+        if (
+            self._num_runs > 0
+            and self._starts[self._num_runs - 1] + self._lengths[self._num_runs - 1]
+            == starts[0]
+        ):
+            # Extend the last run by the first appended run.
+            self._lengths[self._num_runs - 1] += lengths[0]
+            self._num_seeds += int(lengths[0])
+            starts, lengths = starts[1:], lengths[1:]
+        num_runs = self._num_runs + len(starts)
+        if num_runs > len(self._starts):
+            # Grow the arrays geometrically so that appending is amortized.
+            capacity = max(num_runs, 2 * len(self._starts))
+            self._starts = np.resize(self._starts, capacity)
+            self._lengths = np.resize(self._lengths, capacity)
+        self._starts[self._num_runs : num_runs] = starts
+        self._lengths[self._num_runs : num_runs] = lengths
+        self._num_runs = num_runs
+        self._num_seeds += int(np.sum(lengths))
+        self._max = runs_max if self._max is None else max(self._max, runs_max)
+        self._min = runs_min if self._min is None else min(self._min, runs_min)
+        self._intervals = None
+
+    @classmethod
+    def concatenate(cls, seeds_list):
+        """
+        Returns the seeds of ``seeds_list`` in order as a single ``SeedRuns``.
+
+        .. rubric:: Args
+        seeds_list: iterable of ndarray | SeedRuns
+            The seeds to concatenate.
+
+        .. rubric:: Returns
+        seed_runs: SeedRuns
+            The concatenated seeds.
+        """
+        seed_runs = cls()
+        for seeds in seeds_list:
+            seed_runs.append(seeds)
+        return seed_runs
+
+    def __len__(self):
+        return self._num_seeds
+
+    def max(self):
+        """
+        Returns the largest seed.
+        """
+        if self._num_seeds == 0:
+            raise ValueError("The sequence of seeds is empty.")
+        return self._max
+
+    def min(self):
+        """
+        Returns the smallest seed.
+        """
+        if self._num_seeds == 0:
+            raise ValueError("The sequence of seeds is empty.")
+        return self._min
+
+    def _sorted_intervals(self):
+        """
+        Returns the starts and ends of the sorted disjoint intervals of seeds
+        covered by the runs.
+        """
+        if self._intervals is None:
+            starts, lengths = self.runs()
+            order = np.argsort(starts, kind="stable")
+            starts, ends = starts[order], (starts + lengths)[order]
+            # Merge overlapping and adjacent runs.
+            ends = np.maximum.accumulate(ends) if len(ends) > 0 else ends
+            new_interval = np.ones(len(starts), dtype=bool)
+            new_interval[1:] = starts[1:] > ends[:-1]
+            last_in_interval = np.append(new_interval[1:], True)
+            self._intervals = (starts[new_interval], ends[last_in_interval])
+        return self._intervals
+
+    def contains(self, seeds):
+        """
+        Returns whether each of ``seeds`` is in the sequence.
+
+        .. rubric:: Args
+        seeds: ndarray
+            The seeds to look up.
+
+        .. rubric:: Returns
+        contained: ndarray
+            Boolean array that is True for each seed in the sequence.
+        """
+        starts, ends = self._sorted_intervals()
+        seeds = np.asarray(seeds, dtype=int)
+        interval_ind = np.searchsorted(starts, seeds, side="right") - 1
+        valid = interval_ind >= 0
+        contained = np.zeros(np.shape(seeds), dtype=bool)
+        contained[valid] = seeds[valid] < ends[interval_ind[valid]]
+        return contained
+
+    def __contains__(self, seed):
+        return bool(self.contains(np.array([seed]))[0])
+
+    def to_array(self):
+        """
+        Returns the seeds as an array.
+        """
+        starts, lengths = self.runs()
+        if len(starts) == 0:
+            return np.zeros(0, dtype=int)
+        # Offset of each seed from the start of its run.
+        offsets = np.arange(self._num_seeds) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        return np.repeat(starts, lengths) + offsets
+
+    def __array__(self, dtype=None, copy=None):
+        seeds = self.to_array()
+        if dtype is not None:
+            seeds = seeds.astype(dtype)
+        return seeds
+
+    def __repr__(self):
+        return f"SeedRuns({SeedSummary(self)})"
 
 
 __all__ = [
@@ -115,6 +382,9 @@ __all__ = [
     "configure_memory_logger",
     "get_log_output",
     "reset_log_output",
+    "set_log_capacity",
+    "SeedSummary",
+    "SeedRuns",
     "DISABLE_NUMBA",
     "DISABLE_H5PY",
 ]
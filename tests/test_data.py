@@ -152,7 +152,397 @@ def test_load_sum():
     os.remove("test_data.h5")
 
 
+def test_profile(tmp_path):
+    """
+    Checks that the profile recorded with sim.settings.profile counts the calls of
+    each task over all batches and can be exported as a table and a Chrome trace.
+    """
+    import json
+    import numpy as np
+    from qclab import Simulation
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver, parallel_driver_multiprocessing
+    from qclab.profiler import merge_profiles
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 20
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.settings.profile = True
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    for driver in [serial_driver, parallel_driver_multiprocessing]:
+        sim.settings.batch_size = 10
+        data = driver(sim)
+        tasks = data.profile["tasks"]
+        num_steps = 2 * len(sim.settings.t_update_n)
+        num_collects = 2 * len(sim.settings.t_collect_n)
+        assert tasks["update: update_z_rk4_k4"]["calls"] == num_steps
+        assert tasks["update: update_classical_force(z_name=z_1)"]["calls"] == num_steps
+        assert tasks["collect: collect_dm_db"]["calls"] == num_collects
+        assert tasks["initialization: initialize_z"]["calls"] == 2
+        assert (
+            "update_quantum_classical_force(wf_changed=False" in data.profile_summary()
+        )
+        data.save_profile_trace(tmp_path / "trace.json")
+        with open(tmp_path / "trace.json", encoding="utf-8") as f:
+            events = json.load(f)["traceEvents"]
+        assert len(events) == sum(val["calls"] for val in tasks.values())
+        assert data.profile["dropped_events"] == 0
+    # Merging keeps at most max_events trace events and counts the others.
+    num_events = len(data.profile["events"])
+    profile = merge_profiles(data.profile, data.profile, max_events=num_events + 5)
+    assert len(profile["events"]) == num_events + 5
+    assert profile["dropped_events"] == num_events - 5
+    assert profile["tasks"]["initialization: initialize_z"]["calls"] == 4
+
+
+def test_log():
+    """
+    Checks that the in-memory log is bounded, summarizes the seeds of each batch
+    and only includes the logs of worker processes on request.
+    """
+    import numpy as np
+    from qclab import Simulation
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver, parallel_driver_multiprocessing
+    from qclab.utils import (
+        set_log_capacity,
+        get_log_output,
+        SeedSummary,
+        DEFAULT_MAX_LOG_RECORDS,
+    )
+
+    assert str(SeedSummary(np.arange(5, 15))) == "5-14 (10 seeds)"
+    assert str(SeedSummary(np.array([3, 7, 5]))) == "3 seeds between 3 and 7"
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 0.1
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data = serial_driver(sim)
+    assert "Running batch 4 with seeds 30-39 (10 seeds)." in data.log
+    try:
+        set_log_capacity(5)
+        data = serial_driver(sim)
+        lines = data.log.splitlines()
+        assert len(lines) == 6
+        assert "earlier log messages were dropped" in lines[0]
+        assert lines[-1].endswith("Simulation complete.")
+    finally:
+        set_log_capacity(DEFAULT_MAX_LOG_RECORDS)
+    assert get_log_output().count("\n") <= DEFAULT_MAX_LOG_RECORDS
+
+    sim.settings.worker_logs = False
+    data = parallel_driver_multiprocessing(sim, num_tasks=2)
+    assert data.worker_logs == {}
+    assert "Starting dynamics calculation." in data.log
+    sim.settings.worker_logs = True
+    data = parallel_driver_multiprocessing(sim, num_tasks=2)
+    assert len(data.worker_logs) == 4
+    assert "Initializing data_dict" not in data.log
+    assert "Initializing data_dict" in data.get_log(include_workers=True)
+    assert all(
+        "seeds" in key and "Initializing data_dict" in log
+        for key, log in data.worker_logs.items()
+    )
+
+
+def test_output_file(tmp_path):
+    """
+    Checks that the outputs streamed to sim.settings.output_file match the outputs
+    kept in memory, and that a file left open after some batches holds the average
+    over those batches.
+    """
+    import numpy as np
+    from qclab import Simulation, Data
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver, parallel_driver_multiprocessing
+    from qclab.streaming import StreamWriter
+
+    try:
+        import h5py as _
+    except ImportError:
+        pytest.skip("h5py not available, skipping test.")
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 30
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_memory = serial_driver(sim)
+    for driver in [serial_driver, parallel_driver_multiprocessing]:
+        sim.settings.batch_size = 10
+        sim.settings.output_file = str(tmp_path / "output.h5")
+        data = driver(sim)
+        assert set(data.data_dict) == {"seed", "norm_factor"}
+        assert np.array_equal(data.data_dict["seed"], data_memory.data_dict["seed"])
+        loaded = Data().load(sim.settings.output_file)
+        assert np.array_equal(loaded.data_dict["seed"], data_memory.data_dict["seed"])
+        assert loaded.data_dict["norm_factor"] == data_memory.data_dict["norm_factor"]
+        for key in ["dm_db", "quantum_energy", "classical_energy"]:
+            assert np.allclose(loaded.data_dict[key], data_memory.data_dict[key])
+        assert "Simulation complete." in loaded.log
+    sim.settings.output_file = None
+
+    # Merge two batches and close the file without finalizing it.
+    sim.settings.batch_size = 10
+    batches = [serial_driver(sim, seeds=np.arange(n, n + 10)) for n in (0, 10)]
+    sim.initialize_timesteps()
+    stream = StreamWriter(str(tmp_path / "partial.h5"), len(sim.settings.t_collect))
+    for batch in batches:
+        stream.add_data(batch)
+    stream.h5file.close()
+    partial = Data().load(str(tmp_path / "partial.h5"))
+    assert np.array_equal(partial.data_dict["seed"], np.arange(20))
+    expected = Data()
+    for batch in batches:
+        expected.add_data(batch)
+    assert np.allclose(partial.data_dict["dm_db"], expected.data_dict["dm_db"])
+
+    # Stream half of the rows of a batch after a completed batch and close the
+    # file without completing it, as a crash would.
+    stream = StreamWriter(str(tmp_path / "crash.h5"), len(sim.settings.t_collect))
+    stream.add_data(batches[0])
+    for collect_ind in range(len(sim.settings.t_collect) // 2):
+        stream.write_row(
+            "dm_db", collect_ind, batches[1].data_dict["dm_db"][collect_ind], 10
+        )
+        stream.flush()
+    stream.h5file.close()
+    for lazy in [False, True]:
+        crashed = Data().load(str(tmp_path / "crash.h5"), lazy=lazy)
+        assert set(crashed.data_dict) == set(batches[0].data_dict)
+        assert np.array_equal(crashed.data_dict["seed"], np.arange(10))
+        assert crashed.data_dict["norm_factor"] == 10
+        assert np.allclose(crashed.data_dict["dm_db"], batches[0].data_dict["dm_db"])
+
+
+def test_trajectory_outputs(tmp_path):
+    """
+    Checks that the outputs stored for every trajectory average to the collected
+    outputs and are indexed by the seeds of the trajectories.
+    """
+    import numpy as np
+    from qclab import Simulation
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver, parallel_driver_multiprocessing
+    from qclab.trajectory_store import load_trajectories
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    sim.settings.batch_size = 1
+    data_single = serial_driver(sim, seeds=np.array([7]))
+    seeds = np.arange(30)[::-1]
+    sim.settings.trajectory_outputs = ["dm_db", "quantum_energy"]
+    for driver in [serial_driver, parallel_driver_multiprocessing]:
+        sim.settings.batch_size = 10
+        sim.settings.trajectory_dir = str(tmp_path / driver.__name__)
+        data = driver(sim, seeds=seeds)
+        trajectories = load_trajectories(sim.settings.trajectory_dir)
+        assert np.array_equal(trajectories["seed"], seeds)
+        assert trajectories["dm_db"].shape == (30, *data.data_dict["dm_db"].shape)
+        for key in sim.settings.trajectory_outputs:
+            assert np.allclose(np.mean(trajectories[key], axis=0), data.data_dict[key])
+        row = np.flatnonzero(trajectories["seed"] == 7)[0]
+        assert np.allclose(trajectories["dm_db"][row], data_single.data_dict["dm_db"])
+
+    # Freeze the trajectories with even seeds, which moves them to the end of
+    # the batch.
+    sim.settings.batch_size = 10
+    sim.settings.stop_condition = lambda sim, state, parameters: state["seed"] % 2 == 0
+    data = serial_driver(sim, seeds=seeds)
+    trajectories = load_trajectories(sim.settings.trajectory_dir)
+    row = np.flatnonzero(trajectories["seed"] == 7)[0]
+    assert np.allclose(trajectories["dm_db"][row], data_single.data_dict["dm_db"])
+    row = np.flatnonzero(trajectories["seed"] == 4)[0]
+    assert np.allclose(trajectories["dm_db"][row], trajectories["dm_db"][row, 0])
+
+
+def test_variance(tmp_path):
+    """
+    Checks that the variance merged over batches and worker processes matches the
+    variance of the outputs stored for every trajectory, also after saving and
+    loading the data.
+    """
+    import numpy as np
+    from qclab import Simulation, Data
+    from qclab.models import SpinBoson
+    from qclab.algorithms import MeanField
+    from qclab.dynamics import serial_driver, parallel_driver_multiprocessing
+    from qclab.trajectory_store import load_trajectories
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 30
+    sim.settings.tmax = 1
+    sim.settings.dt_update = 0.01
+    sim.settings.variance = True
+    sim.settings.trajectory_outputs = ["dm_db", "classical_energy"]
+    sim.settings.trajectory_dir = str(tmp_path / "trajectories")
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    for driver in [serial_driver, parallel_driver_multiprocessing]:
+        sim.settings.batch_size = 7
+        data = driver(sim)
+        assert data.data_dict["num_samples"] == 30
+        trajectories = load_trajectories(sim.settings.trajectory_dir)
+        for key in sim.settings.trajectory_outputs:
+            samples = np.asarray(trajectories[key])
+            variance = np.sum(np.abs(samples - samples.mean(axis=0)) ** 2, axis=0)
+            assert np.allclose(data.get_variance(key), variance / 29)
+            assert np.allclose(
+                data.get_standard_error(key), np.sqrt(variance / 29 / 30)
+            )
+    data.save(str(tmp_path / "data.h5"))
+    loaded = Data().load(str(tmp_path / "data.h5"))
+    assert np.allclose(loaded.get_variance("dm_db"), data.get_variance("dm_db"))
+    with pytest.raises(ValueError):
+        loaded.get_variance("quantum_energy_total")
+
+
+def test_seed_runs(tmp_path):
+    """
+    Checks that the seeds merged from many batches are kept as an array that
+    equals the concatenated seeds, are tracked as runs, and are saved and loaded
+    as plain arrays.
+    """
+    import pickle
+    import numpy as np
+    from qclab import Data
+
+    data = Data()
+    for n in range(1000):
+        batch = Data(np.arange(10 * n, 10 * (n + 1)))
+        batch.data_dict["norm_factor"] = 10
+        data.add_data(batch)
+    assert isinstance(data.data_dict["seed"], np.ndarray)
+    assert np.array_equal(data.data_dict["seed"], np.arange(10000))
+    seed_runs = data.seed_runs
+    assert seed_runs.num_runs == 1
+    assert len(seed_runs) == 10000 and seed_runs.max() == 9999
+    assert 9999 in seed_runs and 10000 not in seed_runs
+    data.add_data(Data(np.array([20005, 20001, 20002, 5])))
+    seeds = np.concatenate((np.arange(10000), [20005, 20001, 20002, 5]))
+    assert np.array_equal(data.data_dict["seed"], seeds)
+    assert data.seed_runs.num_runs == 4
+    assert np.array_equal(
+        data.seed_runs.contains(np.array([-1, 5, 10000, 20000, 20002, 20003])),
+        [False, True, False, False, True, False],
+    )
+    # The runs follow seeds that are replaced or unpickled.
+    data.data_dict["seed"] = np.arange(5)
+    assert data.seed_runs.max() == 4
+    data = pickle.loads(pickle.dumps(data))
+    data.add_data(Data(np.arange(5, 8)))
+    assert np.array_equal(data.data_dict["seed"], np.arange(8))
+    assert data.seed_runs.num_runs == 1
+    data.data_dict["seed"] = seeds
+    for disable_h5py in [True, False]:
+        if not disable_h5py:
+            pytest.importorskip("h5py")
+        filename = str(tmp_path / ("data.npz" if disable_h5py else "data.h5"))
+        data.save(filename, disable_h5py=disable_h5py)
+        loaded = Data().load(filename, disable_h5py=disable_h5py)
+        assert np.array_equal(loaded.data_dict["seed"], seeds)
+        assert loaded.seed_runs.num_runs == 4
+
+
+def test_lazy_load(tmp_path):
+    """
+    Checks that lazily loaded data reads slices from disk on demand and that
+    merging files chunk by chunk matches merging them in memory.
+    """
+    import numpy as np
+    from qclab import Data
+    from qclab.utils import DISABLE_H5PY
+    from qclab.lazy_data import LazyDataset, merge_files
+
+    rng = np.random.default_rng(0)
+    batches = []
+    for n, norm_factor in enumerate([10, 30]):
+        batch = Data(np.arange(10 * n, 10 * (n + 1)))
+        batch.data_dict["norm_factor"] = norm_factor
+        batch.data_dict["dm_db"] = rng.random((500, 2, 2)) + 1j * rng.random(
+            (500, 2, 2)
+        )
+        batch.data_dict["t"] = np.arange(500, dtype=float)
+        batch.log = f"batch {n}\n"
+        batches.append(batch)
+    expected = Data()
+    for batch in batches:
+        expected.add_data(batch)
+    for disable_h5py in [True, False]:
+        if not disable_h5py:
+            pytest.importorskip("h5py")
+        suffix = ".npz" if disable_h5py else ".h5"
+        filenames = [str(tmp_path / f"batch_{n}{suffix}") for n in range(2)]
+        for batch, filename in zip(batches, filenames):
+            batch.save(filename, disable_h5py=disable_h5py)
+        lazy = Data().load(filenames[0], disable_h5py=disable_h5py, lazy=True)
+        dm_db = lazy.data_dict["dm_db"]
+        if disable_h5py:
+            assert isinstance(dm_db, np.memmap)
+        else:
+            assert isinstance(dm_db, LazyDataset)
+        assert dm_db.shape == (500, 2, 2)
+        assert np.array_equal(dm_db[100:200], batches[0].data_dict["dm_db"][100:200])
+        assert np.array_equal(lazy.data_dict["seed"], np.arange(10))
+        assert lazy.data_dict["norm_factor"] == 10
+        assert lazy.log == "batch 0\n"
+        with pytest.raises(ValueError):
+            lazy.load(filenames[1], disable_h5py=disable_h5py, lazy=True)
+        if disable_h5py and DISABLE_H5PY:
+            continue
+        merge_files(filenames, str(tmp_path / "merged.h5"), disable_h5py=disable_h5py)
+        merged = Data().load(str(tmp_path / "merged.h5"))
+        assert np.array_equal(merged.data_dict["seed"], np.arange(20))
+        assert merged.data_dict["norm_factor"] == 40
+        for key in ["dm_db", "t"]:
+            assert np.allclose(merged.data_dict[key], expected.data_dict[key])
+        assert merged.log == "batch 0\nbatch 1\n"
+
+
 if __name__ == "__main__":
     test_save_load_h5py()
     test_save_load_no_h5py()
     test_load_sum()
+    test_log()
@@ -105,18 +105,210 @@ def test_drivers_spinboson_mpi():
         print("Running serial driver... on rank", rank)
         data_serial = serial_driver(sim)
         print("Comparing results...")
+        assert np.array_equal(
+            data_parallel_mpi.data_dict["seed"],
+            data_serial.data_dict["seed"],
+        )
         for key, val in data_serial.data_dict.items():
             if isinstance(val, np.ndarray):
-                if key == "seed":
-                    # Need to sort seeds since batches are returned in different orders.
-                    data_parallel_mpi.data_dict[key] = np.sort(
-                        data_parallel_mpi.data_dict[key]
-                    )
                 assert np.allclose(val, data_parallel_mpi.data_dict[key])
         print("parallel and serial results match!")
     return
 
 
+@pytest.mark.mpi
+def test_dynamic_scheduling_mpi():
+    """
+    This test runs the MPI driver with dynamic scheduling for the SpinBoson model
+    using FSSH and compares the results to the serial driver.
+
+    This test requires MPI to be set up and run with a command like:
+    mpirun -n 4 pytest -m mpi -s tests/test_drivers.py
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import FewestSwitchesSurfaceHopping  # import algorithm class
+
+    pytest.importorskip("mpi4py")
+    from mpi4py import MPI  # import MPI for parallel processing
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_mpi,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 50
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = FewestSwitchesSurfaceHopping()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    data_parallel_mpi = parallel_driver_mpi(sim, scheduling="dynamic")
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    if rank == 0:
+        sim.settings.batch_size = 10
+        data_serial = serial_driver(sim)
+        assert data_parallel_mpi.data_dict["norm_factor"] == 50
+        assert np.array_equal(
+            data_parallel_mpi.data_dict["seed"],
+            data_serial.data_dict["seed"],
+        )
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel_mpi.data_dict[key])
+    return
+
+
+@pytest.mark.mpi
+def test_collective_reduction_mpi(tmp_path):
+    """
+    This test runs the MPI driver with collective reduction for both scheduling
+    modes for the SpinBoson model using MeanField and compares the results to the
+    serial driver. It then writes the results to an output file, in parallel if
+    h5py was built with MPI support.
+
+    This test requires MPI to be set up and run with a command like:
+    mpirun -n 4 pytest -m mpi -s tests/test_drivers.py
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+
+    pytest.importorskip("mpi4py")
+    from mpi4py import MPI  # import MPI for parallel processing
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_mpi,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 50
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    data_serial = serial_driver(sim) if rank == 0 else None
+    for scheduling in ["static", "dynamic"]:
+        sim.settings.batch_size = 10
+        data_parallel_mpi = parallel_driver_mpi(
+            sim, scheduling=scheduling, reduction="collective"
+        )
+        if rank == 0:
+            assert data_parallel_mpi.data_dict["norm_factor"] == 50
+            assert np.array_equal(
+                data_parallel_mpi.data_dict["seed"],
+                data_serial.data_dict["seed"],
+            )
+            for key, val in data_serial.data_dict.items():
+                if isinstance(val, np.ndarray):
+                    assert np.allclose(val, data_parallel_mpi.data_dict[key])
+    pytest.importorskip("h5py")
+    from qclab import Data
+
+    sim.settings.output_file = comm.bcast(str(tmp_path / "output.h5"), root=0)
+    data_parallel_mpi = parallel_driver_mpi(sim, reduction="collective")
+    if rank == 0:
+        assert set(data_parallel_mpi.data_dict) == {"seed", "norm_factor"}
+        loaded = Data().load(sim.settings.output_file)
+        assert np.array_equal(loaded.data_dict["seed"], np.arange(50))
+        assert loaded.data_dict["norm_factor"] == 50
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, loaded.data_dict[key])
+        assert "Simulation complete." in loaded.log
+    return
+
+
+def test_checkpoint_restart_serial(tmp_path):
+    """
+    This test interrupts a simulation with checkpointing enabled, resumes it from
+    the checkpoints and compares the results to an uninterrupted simulation. It
+    then checks that the multiprocessing driver reuses the completed checkpoints.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import FewestSwitchesSurfaceHopping  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+    )  # import dynamics driver
+
+    def interrupt(sim, state, parameters):
+        if sim.t_ind == 150:
+            raise KeyboardInterrupt
+        return state, parameters
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 20
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = FewestSwitchesSurfaceHopping()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+
+    sim.settings.batch_size = 10
+    sim.settings.checkpoint_dir = str(tmp_path)
+    sim.settings.checkpoint_interval = 0.5
+    sim.algorithm.update_recipe.append(interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        serial_driver(sim)
+    sim.algorithm.update_recipe.remove(interrupt)
+    sim.settings.batch_size = 10
+    data_resumed = serial_driver(sim)
+    assert "Resuming from checkpoint" in data_resumed.log
+    sim.settings.batch_size = 10
+    data_parallel = parallel_driver_multiprocessing(sim, num_tasks=2)
+    for data in [data_resumed, data_parallel]:
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data.data_dict[key])
+
+    # Changing a model constant invalidates the completed checkpoints.
+    sim.model = SpinBoson({"A": 50})
+    sim.settings.batch_size = 10
+    data_changed = serial_driver(sim)
+    assert "does not match the simulation" in data_changed.log
+    sim.settings.checkpoint_dir = None
+    sim.settings.batch_size = 10
+    data_expected = serial_driver(sim)
+    assert not np.allclose(
+        data_changed.data_dict["classical_energy"],
+        data_serial.data_dict["classical_energy"],
+    )
+    for key, val in data_expected.data_dict.items():
+        if isinstance(val, np.ndarray):
+            assert np.allclose(val, data_changed.data_dict[key])
+    return
+
+
 def test_incommensurate_batch_size_serial():
     """
     This test checks that the drivers work correctly when the number of trajectories
@@ -217,7 +409,575 @@ def test_incommensurate_batch_size_multiprocessing():
     return
 
 
+def test_worker_pool_multiprocessing():
+    """
+    This test checks that a persistent worker pool can be reused across calls
+    to the multiprocessing driver and gives the same results as the serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+        WorkerPool,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 40
+    sim.settings.batch_size = 10
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    with WorkerPool(num_tasks=2) as pool:
+        for l_reorg in [0.005, 0.05]:
+            sim.model.constants.l_reorg = l_reorg
+            data_parallel = parallel_driver_multiprocessing(sim, pool=pool)
+            assert pool.running
+            data_serial = serial_driver(sim)
+            for key, val in data_serial.data_dict.items():
+                if isinstance(val, np.ndarray):
+                    assert np.allclose(val, data_parallel.data_dict[key])
+    assert not pool.running
+    return
+
+
+def test_shared_memory_multiprocessing():
+    """
+    This test checks that the shared memory reduction of the multiprocessing driver
+    gives the same results as the serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import (
+        MeanField,
+        FewestSwitchesSurfaceHopping,
+    )  # import algorithm classes
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+    )  # import dynamics driver
+
+    for algorithm in [MeanField(), FewestSwitchesSurfaceHopping()]:
+        sim = Simulation()
+        sim.settings.progress_bar = False
+        sim.settings.num_trajs = 30
+        sim.settings.batch_size = 8
+        sim.settings.tmax = 2
+        sim.settings.dt_update = 0.01
+
+        sim.model = SpinBoson()
+        sim.algorithm = algorithm
+        sim.initial_state["wf_db"] = np.zeros(
+            (sim.model.constants.num_quantum_states), dtype=complex
+        )
+        sim.initial_state["wf_db"][0] += 1.0
+        data_serial = serial_driver(sim)
+        sim.settings.batch_size = 8
+        data_parallel = parallel_driver_multiprocessing(
+            sim, num_tasks=2, use_shared_memory=True
+        )
+        assert data_parallel.data_dict["norm_factor"] == 30
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel.data_dict[key])
+    return
+
+
+def test_callback_multiprocessing():
+    """
+    This test checks that the multiprocessing driver calls the callback with the
+    merged results after each batch, with and without shared memory, and that the
+    final results match the serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+    )  # import dynamics driver
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 30
+    sim.settings.batch_size = 8
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+    data_serial = serial_driver(sim)
+    for use_shared_memory in [False, True]:
+        partial_results = []
+
+        def callback(new_data):
+            partial_results.append(
+                (
+                    new_data.data_dict["norm_factor"],
+                    new_data.data_dict["classical_energy"],
+                )
+            )
+
+        sim.settings.batch_size = 8
+        data_parallel = parallel_driver_multiprocessing(
+            sim, num_tasks=2, use_shared_memory=use_shared_memory, callback=callback
+        )
+        assert len(partial_results) == 4
+        norms = [norm for norm, _ in partial_results]
+        assert np.all(np.diff(norms) > 0) and norms[-1] == 30
+        assert np.allclose(
+            partial_results[-1][1], data_serial.data_dict["classical_energy"]
+        )
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_parallel.data_dict[key])
+    return
+
+
+def test_threads_driver():
+    """
+    This test checks that the thread-pool driver gives the same results as the
+    serial driver.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import (
+        MeanField,
+        FewestSwitchesSurfaceHopping,
+    )  # import algorithm classes
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_threads,
+    )  # import dynamics driver
+
+    for algorithm in [MeanField(), FewestSwitchesSurfaceHopping()]:
+        sim = Simulation()
+        sim.settings.progress_bar = False
+        sim.settings.num_trajs = 30
+        sim.settings.batch_size = 8
+        sim.settings.tmax = 2
+        sim.settings.dt_update = 0.01
+
+        sim.model = SpinBoson()
+        sim.algorithm = algorithm
+        sim.initial_state["wf_db"] = np.zeros(
+            (sim.model.constants.num_quantum_states), dtype=complex
+        )
+        sim.initial_state["wf_db"][0] += 1.0
+        data_serial = serial_driver(sim)
+        sim.settings.batch_size = 8
+        data_threads = parallel_driver_threads(sim, num_tasks=4)
+        assert data_threads.data_dict["norm_factor"] == 30
+        for key, val in data_serial.data_dict.items():
+            if isinstance(val, np.ndarray):
+                assert np.allclose(val, data_threads.data_dict[key])
+    return
+
+
+def test_convergence_driver():
+    """
+    This test checks that the convergence driver stops once the target error is
+    reached, that it stops at max_trajs otherwise, that its results match a
+    serial run over the same seeds, that it falls back to the round means with
+    shared memory, and that it restores the settings if a round raises.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+        convergence_driver,
+    )  # import dynamics drivers
+
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 10
+    sim.settings.batch_size = 5
+    sim.settings.tmax = 2
+    sim.settings.dt_update = 0.01
+
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.zeros(
+        (sim.model.constants.num_quantum_states), dtype=complex
+    )
+    sim.initial_state["wf_db"][0] += 1.0
+
+    observables = ["dm_db", "quantum_energy"]
+    data = convergence_driver(sim, observables, 0.05, max_trajs=100)
+    norm_factor = data.data_dict["norm_factor"]
+    assert norm_factor < 100
+    assert sim.settings.num_trajs == 10
+    assert not sim.settings.variance
+    for key in observables:
+        assert np.max(data.standard_error[key]) <= 0.05
+        # The error is estimated from the variance over the trajectories.
+        assert np.allclose(data.standard_error[key], data.get_standard_error(key))
+    assert "Converged after" in data.log
+    # Check that the merged results equal those of a single serial run.
+    sim.settings.num_trajs = norm_factor
+    data_serial = serial_driver(sim)
+    assert np.array_equal(data_serial.data_dict["seed"], data.data_dict["seed"])
+    for key in observables:
+        assert np.allclose(data_serial.data_dict[key], data.data_dict[key])
+    # An unreachable tolerance stops at max_trajs, continuing the seeds.
+    sim.settings.num_trajs = 10
+    data = convergence_driver(sim, observables, 1e-8, max_trajs=25, data=data)
+    assert data.data_dict["norm_factor"] == norm_factor + 25
+    assert len(np.unique(data.data_dict["seed"])) == norm_factor + 25
+    assert "Not converged" in data.log
+    # Shared memory falls back to the error estimated from the round means.
+    sim.settings.num_trajs = 10
+    data = convergence_driver(
+        sim,
+        observables,
+        1e-8,
+        max_trajs=20,
+        driver=parallel_driver_multiprocessing,
+        num_tasks=2,
+        use_shared_memory=True,
+    )
+    assert data.data_dict["norm_factor"] == 20
+    assert "num_samples" not in data.data_dict
+    for key in observables:
+        assert data.standard_error[key].shape == data.data_dict[key].shape
+    assert not sim.settings.variance
+    # The settings are restored if a round raises.
+    with pytest.raises(KeyError):
+        convergence_driver(sim, ["dm_bd"], 0.05, max_trajs=20)
+    assert sim.settings.num_trajs == 10
+    assert sim.settings.batch_size == 5
+    assert not sim.settings.variance
+    return
+
+
+def test_adaptive_timestep_serial():
+    """
+    This test checks that adaptive time stepping takes fewer steps than the fixed
+    time step while collecting the output at the same times with a small error.
+    """
+    import re
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import (
+        MeanField,
+        FewestSwitchesSurfaceHopping,
+    )  # import algorithm classes
+    from qclab.dynamics import serial_driver  # import dynamics driver
+
+    for algorithm in [MeanField, FewestSwitchesSurfaceHopping]:
+        sim = Simulation()
+        sim.settings.progress_bar = False
+        sim.settings.num_trajs = 10
+        sim.settings.batch_size = 10
+        sim.settings.tmax = 5
+        sim.settings.dt_update = 0.01
+        sim.settings.dt_collect = 0.1
+
+        sim.model = SpinBoson()
+        sim.algorithm = algorithm()
+        sim.initial_state["wf_db"] = np.zeros(
+            (sim.model.constants.num_quantum_states), dtype=complex
+        )
+        sim.initial_state["wf_db"][0] += 1.0
+        data_fixed = serial_driver(sim)
+        sim.settings.adaptive_tol = 1e-4
+        data_adaptive = serial_driver(sim)
+        assert np.array_equal(data_fixed.data_dict["t"], data_adaptive.data_dict["t"])
+        num_steps = int(re.search(r"took (\d+) steps", data_adaptive.log).group(1))
+        assert num_steps < sim.settings.tmax_n
+        # Total energy is conserved to within the tolerance per step.
+        energy = (
+            data_adaptive.data_dict["classical_energy"]
+            + data_adaptive.data_dict["quantum_energy"]
+        )
+        assert np.all(np.abs(energy - energy[0]) < num_steps * 1e-4)
+        if algorithm is MeanField:
+            assert np.allclose(
+                data_fixed.data_dict["dm_db"],
+                data_adaptive.data_dict["dm_db"],
+                atol=1e-3,
+            )
+    return
+
+
+def test_stop_condition_serial():
+    """
+    This test checks that freezing the trajectories that have left the interaction
+    region of Tully's first problem does not change the populations and energies.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import TullyProblemOne  # import model class
+    from qclab.algorithms import (
+        MeanField,
+        FewestSwitchesSurfaceHopping,
+    )  # import algorithm classes
+    from qclab.dynamics import serial_driver, position_window  # import dynamics driver
+
+    for algorithm_settings in [
+        None,
+        {"fssh_deterministic": False},
+        {"fssh_deterministic": True},
+    ]:
+        data_list = []
+        for stop_condition in [None, position_window(-10.0, 10.0)]:
+            sim = Simulation()
+            sim.settings.progress_bar = False
+            sim.settings.num_trajs = 10
+            sim.settings.batch_size = 10
+            sim.settings.tmax = 3000
+            sim.settings.dt_update = 1.0
+            sim.settings.dt_collect = 50
+            sim.settings.stop_condition = stop_condition
+
+            sim.model = TullyProblemOne({"init_momentum": 30.0})
+            if algorithm_settings is None:
+                sim.algorithm = MeanField()
+            else:
+                sim.algorithm = FewestSwitchesSurfaceHopping(algorithm_settings)
+            sim.initial_state["wf_db"] = np.zeros(
+                (sim.model.constants.num_quantum_states), dtype=complex
+            )
+            sim.initial_state["wf_db"][0] += 1.0
+            data_list.append(serial_driver(sim))
+        data, data_compacted = data_list
+        assert "Froze" in data_compacted.log
+        assert np.array_equal(data.data_dict["t"], data_compacted.data_dict["t"])
+        assert np.allclose(
+            np.einsum("tii->ti", data.data_dict["dm_db"]),
+            np.einsum("tii->ti", data_compacted.data_dict["dm_db"]),
+        )
+        for key in ["classical_energy", "quantum_energy"]:
+            assert np.allclose(data.data_dict[key], data_compacted.data_dict[key])
+    return
+
+
+def test_compaction_trajectory_keys():
+    """
+    This test checks that compaction selects the arrays of the state and the
+    outputs by the trajectory keys of the algorithm, selects sparse arrays, keeps
+    arrays that do not run over the batch and rejects unknown ones.
+    """
+    import numpy as np
+    from qclab.algorithms import FewestSwitchesSurfaceHopping
+    from qclab.dynamics.compaction import _select_trajectories, _concatenate_states
+    from qclab import Simulation
+
+    sim = Simulation()
+    sim.algorithm = FewestSwitchesSurfaceHopping({"fssh_deterministic": True})
+    dense = np.arange(8.0).reshape((4, 2)) * (np.arange(8.0).reshape((4, 2)) > 2)
+    inds = np.where(dense != 0)
+    # Two trajectories with two branches each.
+    state = {
+        "seed": np.array([0, 0, 1, 1]),
+        "z": np.arange(4.0),
+        "classical_energy": np.array([10.0, 20.0]),
+        "hop_ind": np.array([3]),
+        "dh_qc_dzc": (inds, dense[inds], dense.shape),
+        "output_dict": {
+            "dm_db": np.arange(4.0),
+            "classical_energy": np.array([1.0, 2.0]),
+        },
+        "norm_factor": 2,
+    }
+    branch_mask = np.array([False, False, True, True])
+    traj_mask = np.array([False, True])
+    state_b = _select_trajectories(sim, state, branch_mask, traj_mask)
+    assert np.array_equal(state_b["z"], [2.0, 3.0])
+    assert np.array_equal(state_b["classical_energy"], [20.0])
+    assert np.array_equal(state_b["hop_ind"], [3])
+    assert np.array_equal(state_b["output_dict"]["dm_db"], [2.0, 3.0])
+    assert np.array_equal(state_b["output_dict"]["classical_energy"], [2.0])
+    sparse_inds, sparse_mels, sparse_shape = state_b["dh_qc_dzc"]
+    sparse = np.zeros(sparse_shape)
+    sparse[sparse_inds] = sparse_mels
+    assert np.array_equal(sparse, dense[2:])
+    # Concatenating the two parts of the batch restores it.
+    state_a = _select_trajectories(sim, state, ~branch_mask, ~traj_mask)
+    state_ab = _concatenate_states(sim, state_a, state_b)
+    for key in ["z", "classical_energy"]:
+        assert np.array_equal(state_ab[key], state[key])
+    for key in ["dm_db", "classical_energy"]:
+        assert np.array_equal(state_ab["output_dict"][key], state["output_dict"][key])
+    sparse_inds, sparse_mels, sparse_shape = state_ab["dh_qc_dzc"]
+    sparse = np.zeros(sparse_shape)
+    sparse[sparse_inds] = sparse_mels
+    assert np.array_equal(sparse, dense)
+    # An array that runs over neither the entries nor the trajectories.
+    state["unknown"] = np.zeros(3)
+    with pytest.raises(ValueError):
+        _select_trajectories(sim, state, branch_mask, traj_mask)
+    return
+
+
+def test_memory_budget_serial():
+    """
+    This test checks that a memory budget reduces the batch size of deterministic
+    surface hopping to whole trajectories without changing the results.
+    """
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import FMOComplex  # import model class
+    from qclab.algorithms import FewestSwitchesSurfaceHopping  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        estimate_batch_memory,
+        plan_batch_size,
+    )  # import dynamics driver
+
+    data_list = []
+    for use_budget in [False, True]:
+        sim = Simulation()
+        sim.settings.progress_bar = False
+        sim.settings.tmax = 1.0
+        sim.settings.dt_update = 0.01
+        sim.settings.dt_collect = 0.1
+        sim.model = FMOComplex({"N": 20})
+        sim.model.initialize_constants()
+        num_states = sim.model.constants.num_quantum_states
+        sim.settings.num_trajs = 4 * num_states
+        sim.settings.batch_size = 4 * num_states
+        sim.algorithm = FewestSwitchesSurfaceHopping({"fssh_deterministic": True})
+        sim.initial_state["wf_db"] = np.zeros(num_states, dtype=complex)
+        sim.initial_state["wf_db"][0] += 1.0
+        if use_budget:
+            fixed_bytes, bytes_per_traj = estimate_batch_memory(sim)
+            assert bytes_per_traj > 0
+            sim.settings.memory_budget = fixed_bytes + 2.5 * bytes_per_traj
+            assert plan_batch_size(sim) == 2 * num_states
+        data_list.append(serial_driver(sim))
+    data, data_budget = data_list
+    assert "Reducing batch_size" in data_budget.log
+    assert np.array_equal(data.data_dict["seed"], data_budget.data_dict["seed"])
+    for key in ["dm_db", "classical_energy", "quantum_energy"]:
+        assert np.allclose(data.data_dict[key], data_budget.data_dict[key])
+    return
+
+
+def test_estimate_batch_memory_fallback(monkeypatch):
+    """
+    This test checks that the memory per trajectory falls back to the size of the
+    arrays in the state when the traced peak memory does not grow with the batch
+    size.
+    """
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import memory_planner
+    from qclab.utils import get_log_output, reset_log_output
+
+    sim = Simulation()
+    sim.settings.tmax = 1.0
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson()
+    sim.algorithm = MeanField()
+    # The traced peak shrinks from 10000 to 9000 bytes, while the state grows by
+    # 300 bytes per trajectory.
+    monkeypatch.setattr(
+        memory_planner,
+        "_probe_memory",
+        lambda sim, num_trajs: (10000 - 1000 * (num_trajs > 1), 300 * num_trajs),
+    )
+    reset_log_output()
+    fixed_bytes, bytes_per_traj = memory_planner.estimate_batch_memory(sim)
+    assert bytes_per_traj == 300
+    assert fixed_bytes == 9700
+    assert "does not grow with the batch size" in get_log_output()
+    return
+
+
+def test_autotune(tmp_path, monkeypatch):
+    """
+    This test checks that autotune stores the fastest configuration in the cache
+    and that the drivers use it.
+    """
+    import os
+    import numpy as np
+    from qclab import Simulation  # import simulation class
+    from qclab.models import SpinBoson  # import model class
+    from qclab.algorithms import MeanField  # import algorithm class
+    from qclab.dynamics import (
+        serial_driver,
+        parallel_driver_multiprocessing,
+        autotune,
+    )  # import dynamics drivers
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    sim = Simulation()
+    sim.settings.progress_bar = False
+    sim.settings.num_trajs = 8
+    sim.settings.batch_size = 8
+    sim.settings.tmax = 1.0
+    sim.settings.dt_update = 0.01
+    sim.model = SpinBoson({"A": 10})
+    sim.algorithm = MeanField()
+    sim.initial_state["wf_db"] = np.array([1.0, 0.0], dtype=complex)
+    sim.settings.autotune = True
+    data = serial_driver(sim)
+    assert "No autotuned configuration" in data.log
+    tuned = autotune(sim, batch_sizes=(2, 4), num_tasks_list=(1, 2), probe_steps=10)
+    assert os.path.exists(os.path.join(tmp_path, "qclab", "autotune.json"))
+    assert len(tuned["results"]) == 4
+    best_serial = max(
+        (result for result in tuned["results"] if result["num_tasks"] == 1),
+        key=lambda result: result["throughput"],
+    )
+    data = serial_driver(sim)
+    assert "Using the autotuned" in data.log
+    assert sim.settings.batch_size == best_serial["batch_size"]
+    data = parallel_driver_multiprocessing(sim)
+    assert f"Using {tuned['num_tasks']} tasks" in data.log
+    assert len(data.data_dict["seed"]) == sim.settings.num_trajs
+    # A different model has a different signature.
+    sim.model = SpinBoson({"A": 20})
+    data = serial_driver(sim)
+    assert "No autotuned configuration" in data.log
+    # A cache file other than the default one.
+    sim.settings.autotune_cache = str(tmp_path / "other" / "autotune.json")
+    sim.settings.batch_size = 8
+    tuned = autotune(sim, batch_sizes=(2, 4), num_tasks_list=(1,), probe_steps=10)
+    assert os.path.exists(sim.settings.autotune_cache)
+    data = serial_driver(sim)
+    assert "Using the autotuned" in data.log
+    assert sim.settings.batch_size == tuned["batch_size"]
+    sim.settings.autotune_cache = None
+    sim.settings.batch_size = 8
+    data = serial_driver(sim)
+    assert "No autotuned configuration" in data.log
+    assert sim.settings.batch_size == 8
+    return
+
+
 if __name__ == "__main__":
     test_drivers_spinboson()
     test_incommensurate_batch_size_serial()
     test_incommensurate_batch_size_multiprocessing()
+    test_worker_pool_multiprocessing()
+    test_shared_memory_multiprocessing()
+    test_callback_multiprocessing()
+    test_threads_driver()
+    test_convergence_driver()
+    test_adaptive_timestep_serial()
+    test_stop_condition_serial()
+    test_compaction_trajectory_keys()
+    test_memory_budget_serial()
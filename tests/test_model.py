@@ -0,0 +1,49 @@
+"""
+This module contains tests of the model object methods.
+"""
+
+import copy
+import pickle
+
+
+def test_get_ingredient_overrides():
+    """
+    This test checks that ``Model.get`` returns the last ingredient with a given
+    name and follows modifications of the ingredient list, including overriding
+    an ingredient with None.
+    """
+    from qclab.models import SpinBoson
+    from qclab import ingredients
+
+    model = SpinBoson()
+    assert model.get("h_qc") == (ingredients.h_qc_diagonal_linear, True)
+    assert model.get("not_an_ingredient") == (None, False)
+    # Overriding an ingredient with None removes it.
+    model.ingredients.append(("h_qc", None))
+    assert model.get("h_qc") == (None, False)
+    model.ingredients.pop()
+    assert model.get("h_qc") == (ingredients.h_qc_diagonal_linear, True)
+    # Later ingredients override earlier ones.
+    model.ingredients += [("h_qc", ingredients.h_c_free)]
+    assert model.get("h_qc") == (ingredients.h_c_free, True)
+    model.ingredients[-1] = ("h_qc", ingredients.h_c_harmonic)
+    assert model.get("h_qc") == (ingredients.h_c_harmonic, True)
+    del model.ingredients[-1]
+    assert model.get("h_qc") == (ingredients.h_qc_diagonal_linear, True)
+    # Assigning a new list of ingredients replaces the old ones.
+    model.ingredients = [("h_q", ingredients.h_q_two_level)]
+    assert model.get("h_q") == (ingredients.h_q_two_level, True)
+    assert model.get("h_qc") == (None, False)
+    model.ingredients.insert(0, ("h_qc", ingredients.h_qc_diagonal_linear))
+    assert model.get("h_qc") == (ingredients.h_qc_diagonal_linear, True)
+    # Copies of the model have their own ingredients.
+    for model_copy in [copy.deepcopy(model), pickle.loads(pickle.dumps(model))]:
+        assert model_copy.get("h_q")[1]
+        model_copy.ingredients.append(("h_q", None))
+        assert model_copy.get("h_q") == (None, False)
+        assert model.get("h_q") == (ingredients.h_q_two_level, True)
+    return
+
+
+if __name__ == "__main__":
+    test_get_ingredient_overrides()
@@ -363,6 +363,152 @@ def test_dh_c_dzc_finite_differences():
     return
 
 
+def test_output_mean_field_fused_update():
+    """
+    Tests the output of MeanField with the fused update for the models that
+    support it and checks that the other models fall back to the update recipe.
+    """
+    reference_folder = os.path.join(os.path.dirname(__file__), "reference/")
+    for model_class in [
+        SpinBoson,
+        HolsteinLattice,
+        FMOComplex,
+        TullyProblemOne,
+    ]:
+        print(f"Testing {model_class.__name__} with fused MeanField update")
+
+        sim = Simulation(model_sim_settings[model_class.__name__])
+        model_name = model_class.__name__
+        sim.model = model_class(model_settings[model_class.__name__])
+        sim.model.initialize_constants()
+        sim.algorithm = MeanField({"fused_update": True})
+        sim.initial_state["wf_db"] = np.zeros(
+            sim.model.constants.num_quantum_states, dtype=complex
+        )
+        sim.initial_state["wf_db"][0] = 1j
+        assert sim.algorithm.use_fused_update(sim, sim.algorithm.update_recipe) == (
+            model_class is not TullyProblemOne
+        )
+        data = serial_driver(sim)
+        data_correct = Data().load(
+            os.path.join(reference_folder, f"{model_name}_MeanField.h5")
+        )
+        for key, val in data.data_dict.items():
+            np.testing.assert_allclose(
+                val, data_correct.data_dict[key], rtol=1e-5, atol=1e-8
+            )
+    return
+
+
+def test_compiled_recipe():
+    """
+    Tests that executing the compiled update recipe gives the same state as
+    executing the update recipe itself.
+    """
+    for model_class in [SpinBoson, FMOComplex, TullyProblemTwo]:
+        for algorithm_class in [MeanField, FewestSwitchesSurfaceHopping]:
+            print(f"Testing {model_class.__name__} with {algorithm_class.__name__}")
+            states = []
+            for compiled in [False, True]:
+                sim = Simulation(model_sim_settings[model_class.__name__])
+                sim.model = model_class(model_settings[model_class.__name__])
+                sim.model.initialize_constants()
+                sim.algorithm = algorithm_class()
+                sim.initial_state["wf_db"] = np.zeros(
+                    sim.model.constants.num_quantum_states, dtype=complex
+                )
+                sim.initial_state["wf_db"][0] = 1j
+                sim.settings.batch_size = 4
+                sim.initialize_timesteps()
+                sim.t_ind = 0
+                state, parameters = {"seed": np.arange(4)}, {}
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim, state, parameters, sim.algorithm.initialization_recipe
+                )
+                recipe = sim.algorithm.update_recipe
+                if compiled:
+                    recipe = sim.algorithm.compile_recipe(sim, recipe)
+                for sim.t_ind in range(20):
+                    state, parameters = sim.algorithm.execute_recipe(
+                        sim, state, parameters, recipe
+                    )
+                states.append(state)
+            for key, val in states[0].items():
+                if isinstance(val, np.ndarray):
+                    np.testing.assert_allclose(val, states[1][key], rtol=1e-12)
+    return
+
+
+def test_dm_db_elements():
+    """
+    Tests that the populations and selected elements of the diabatic density
+    matrix agree with the full density matrix computed by the collect recipe.
+    """
+    from functools import partial
+    from qclab import tasks
+
+    elements = [(0, 0), (0, 1), (1, 0)]
+    for model_class in [SpinBoson, FMOComplex, TullyProblemTwo]:
+        for algorithm_class, settings in [
+            (MeanField, {}),
+            (FewestSwitchesSurfaceHopping, {}),
+            (FewestSwitchesSurfaceHopping, {"fssh_deterministic": True}),
+        ]:
+            print(f"Testing {model_class.__name__} with {algorithm_class.__name__}")
+            sim = Simulation(model_sim_settings[model_class.__name__])
+            sim.model = model_class(model_settings[model_class.__name__])
+            sim.model.initialize_constants()
+            sim.algorithm = algorithm_class(settings)
+            sim.initial_state["wf_db"] = np.zeros(
+                sim.model.constants.num_quantum_states, dtype=complex
+            )
+            sim.initial_state["wf_db"][0] = 1j
+            sim.settings.batch_size = 4 * sim.model.constants.num_quantum_states
+            sim.initialize_timesteps()
+            sim.t_ind = 0
+            state, parameters = {"seed": np.arange(sim.settings.batch_size)}, {}
+            state, parameters = sim.algorithm.execute_recipe(
+                sim, state, parameters, sim.algorithm.initialization_recipe
+            )
+            for sim.t_ind in range(20):
+                state, parameters = sim.algorithm.execute_recipe(
+                    sim, state, parameters, sim.algorithm.update_recipe
+                )
+            state, parameters = sim.algorithm.execute_recipe(
+                sim, state, parameters, sim.algorithm.collect_recipe
+            )
+            if algorithm_class is MeanField:
+                update_task = tasks.update_dm_db_elements_wf
+            else:
+                update_task = tasks.update_dm_db_elements_fssh
+            state, parameters = sim.algorithm.execute_recipe(
+                sim,
+                state,
+                parameters,
+                [
+                    partial(update_task, dm_db_elements_name="pops_db"),
+                    partial(update_task, elements=elements),
+                    tasks.collect_dm_db_elements,
+                ],
+            )
+            dm_db = state["dm_db"]
+            assert np.isrealobj(state["pops_db"])
+            np.testing.assert_allclose(
+                state["pops_db"],
+                np.real(np.einsum("tii->ti", dm_db)),
+                rtol=1e-10,
+                atol=1e-12,
+            )
+            rows, cols = np.array(elements).T
+            np.testing.assert_allclose(
+                state["output_dict"]["dm_db_elements"],
+                dm_db[:, rows, cols],
+                rtol=1e-10,
+                atol=1e-12,
+            )
+    return
+
+
 if __name__ == "__main__":
     st = time.time()
     test_output_serial()
@@ -386,4 +532,13 @@ if __name__ == "__main__":
     test_dh_c_dzc_finite_differences()
     et7 = time.time()
     print(f"dh_c_dzc finite difference tests completed in {et7 - et6:.2f} seconds.")
-    print(f"All tests completed in {et7 - st:.2f} seconds.")
+    test_output_mean_field_fused_update()
+    et8 = time.time()
+    print(f"Fused MeanField update tests completed in {et8 - et7:.2f} seconds.")
+    test_compiled_recipe()
+    et9 = time.time()
+    print(f"Compiled recipe tests completed in {et9 - et8:.2f} seconds.")
+    test_dm_db_elements()
+    et10 = time.time()
+    print(f"Density matrix element tests completed in {et10 - et9:.2f} seconds.")
+    print(f"All tests completed in {et10 - st:.2f} seconds.")